@@ -17,6 +17,11 @@ from framework.agent.llmagent.doubao_llmagent import DouBaoLLMAgent
 from coke.prompt.personality_prompt import COKE_PERSONALITY_PROMPT
 from coke.prompt.task_prompt import COKE_TASK_PROMPT
 
+def escape_braces(text):
+    """Escape braces so that text survives a later str.format() unchanged."""
+    return str(text).replace("{", "{{").replace("}", "}}")
+
+
 class CokeResponseAgent(DouBaoLLMAgent):
     """Agent that generates Coke's text responses."""
     
@@ -25,22 +30,28 @@ class CokeResponseAgent(DouBaoLLMAgent):
         Initialize Coke Response Agent.
         
         Args:
-            context: Context dictionary containing user_message, conversation_history, etc.
+            context: Context dictionary containing user_message, conversation_history,
+                relevant_memories (older turns retrieved by ConversationMemory), etc.
             max_retries: Maximum retry attempts
             name: Agent name
         """
         # Build user prompt from context
         user_message = context.get("user_message", "")
         conversation_history = context.get("conversation_history", "")
+        relevant_memories = context.get("relevant_memories", "")
         
+        # The result is formatted again with format(**self.context) in _prehandle,
+        # so braces in user text or retrieved memories must be escaped here
         userp_template = COKE_TASK_PROMPT.format(
-            user_message=user_message,
-            conversation_history=conversation_history or "（暂无历史对话）"
+            user_message=escape_braces(user_message),
+            conversation_history=escape_braces(conversation_history or "（暂无历史对话）"),
+            relevant_memories=escape_braces(relevant_memories or "（无）")
         )
         
         default_input = {
             "user_message": "",
-            "conversation_history": ""
+            "conversation_history": "",
+            "relevant_memories": ""
         }
         
         # Use DeepSeek v3.1 model (better reasoning capabilities)
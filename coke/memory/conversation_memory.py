@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Conversation Memory for Coke
+Embeds completed chat turns in a background thread and retrieves the most
+relevant past turns for a new message, so the prompt stays at a fixed size
+while older context is still available.
+"""
+import sys
+sys.path.append(".")
+
+import queue
+import threading
+import logging
+from logging import getLogger
+from datetime import datetime
+
+from coke.memory.embedding import embed_texts
+
+logger = getLogger(__name__)
+
+MEMORY_COLLECTION = "coke_memories"
+
+def estimate_tokens(text):
+    """
+    Rough token count without a tokenizer: one token per CJK character,
+    about four characters per token for everything else.
+    """
+    cjk = sum(1 for char in text
+              if "\u4e00" <= char <= "\u9fff" or "\u3000" <= char <= "\u303f" or "\uff00" <= char <= "\uffef")
+    return cjk + (len(text) - cjk + 3) // 4
+
+def format_turn(user_message, coke_response):
+    """Text of one conversation turn, as stored and shown in the prompt."""
+    return f"用户: {user_message}\nCoke: {coke_response}"
+
+class ConversationMemory:
+    """Long-term memory of chat turns stored in a MongoDBBase vector collection."""
+
+    def __init__(self, mongo_db, embed_fn=embed_texts, collection_name=MEMORY_COLLECTION,
+                 top_k=5, token_budget=400, min_similarity=0.3, max_pending=1000, batch_size=25):
+        """
+        Initialize conversation memory.
+
+        Args:
+            mongo_db: MongoDBBase instance (vector_partition_field="user_id"
+                keeps each user's memories in their own index)
+            embed_fn: Function taking a list of texts and returning their embeddings
+            collection_name: Vector collection holding the memories
+            top_k: Maximum number of memories retrieved per message
+            token_budget: Maximum estimated tokens of memories put in the prompt
+            min_similarity: Memories less similar than this are ignored
+            max_pending: Turns waiting to be embedded before new ones are dropped
+            batch_size: Maximum turns embedded in one request
+        """
+        self.mongo_db = mongo_db
+        self.embed_fn = embed_fn
+        self.collection_name = collection_name
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.min_similarity = min_similarity
+        self.batch_size = batch_size
+        self._pending = queue.Queue(maxsize=max_pending)
+        self.running = False
+        self.thread = None
+
+    def create_collection(self):
+        """Create the memory collection and its indexes."""
+        self.mongo_db.create_vector_collection(self.collection_name)
+        self.mongo_db.create_index(self.collection_name, [("metadata.user_id", 1), ("metadata.timestamp", -1)])
+
+    def start(self):
+        """Start the background embedding thread."""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+        logger.info(f"🧠 Conversation memory started ({self.collection_name})")
+
+    def stop(self):
+        """Stop the background thread after the turns already queued are stored."""
+        self.running = False
+        self._pending.put(None)
+        if self.thread:
+            self.thread.join(timeout=10)
+
+    def remember_turn(self, user_id, user_message, coke_response, timestamp=None):
+        """
+        Queue a completed turn to be embedded and stored in the background.
+
+        Returns:
+            False if the queue is full and the turn was dropped
+        """
+        turn = {
+            "user_id": user_id,
+            "user": user_message,
+            "coke": coke_response,
+            "timestamp": timestamp or datetime.now()
+        }
+        try:
+            self._pending.put_nowait(turn)
+        except queue.Full:
+            logger.warning(f"Memory queue full, dropping turn of {user_id}")
+            return False
+        return True
+
+    def store_turns(self, turns):
+        """Embed and store turns now (the background thread calls this in batches)."""
+        if not turns:
+            return
+        user_texts = [turn["user"] for turn in turns]
+        turn_texts = [format_turn(turn["user"], turn["coke"]) for turn in turns]
+        embeddings = self.embed_fn(user_texts + turn_texts)
+        for i, turn in enumerate(turns):
+            self.mongo_db.insert_vector(
+                self.collection_name,
+                key=user_texts[i],
+                value=turn_texts[i],
+                key_embedding=embeddings[i],
+                value_embedding=embeddings[len(turns) + i],
+                metadata={"user_id": turn["user_id"], "timestamp": turn["timestamp"]}
+            )
+
+    def recall(self, user_id, query, before=None):
+        """
+        Retrieve the past turns most relevant to a message.
+
+        Args:
+            user_id: Only this user's memories are searched
+            query: The new user message
+            before: Ignore turns at or after this time (e.g. the oldest turn
+                already in the recent history window)
+
+        Returns:
+            List of {"user", "coke", "timestamp", "score"}, most relevant first
+        """
+        query_embedding = self.embed_fn([query])[0]
+        # Over-fetch so that turns dropped by `before` do not shrink the result
+        docs = self.mongo_db.vector_search(
+            self.collection_name,
+            query_embedding,
+            embedding_field="value_embedding",
+            metadata_filters={"user_id": user_id},
+            top_k=self.top_k * 2,
+            similarity_threshold=self.min_similarity,
+            include_embeddings=False
+        )
+
+        memories = []
+        for doc in docs:
+            timestamp = doc.get("metadata", {}).get("timestamp")
+            if before is not None and timestamp is not None and timestamp >= before:
+                continue
+            memories.append({
+                "user": doc.get("key", ""),
+                "coke": doc.get("value", "").split("\nCoke: ", 1)[-1],
+                "timestamp": timestamp,
+                "score": doc.get("similarity", 0.0)
+            })
+            if len(memories) >= self.top_k:
+                break
+        return memories
+
+    def format_memories(self, memories, token_budget=None):
+        """
+        Render memories for the prompt within the token budget.
+
+        The most relevant memories are kept first; the kept ones are shown
+        oldest first so they read like a conversation.
+        """
+        token_budget = self.token_budget if token_budget is None else token_budget
+        kept, used = [], 0
+        for memory in memories:
+            text = format_turn(memory["user"], memory["coke"])
+            if memory.get("timestamp"):
+                text = f"[{memory['timestamp'].strftime('%Y-%m-%d %H:%M')}] {text}"
+            tokens = estimate_tokens(text)
+            if used + tokens > token_budget:
+                continue
+            kept.append((memory.get("timestamp") or datetime.min, text))
+            used += tokens
+        kept.sort(key=lambda item: item[0])
+        return "\n".join(text for _, text in kept)
+
+    def build_context(self, user_id, query, before=None):
+        """
+        Relevant memories for a message, formatted for COKE_TASK_PROMPT.
+        Returns an empty string when nothing relevant is found or retrieval fails.
+        """
+        try:
+            return self.format_memories(self.recall(user_id, query, before))
+        except Exception as e:
+            logger.error(f"Error recalling memories for {user_id}: {e}")
+            return ""
+
+    def _run_loop(self):
+        """Embed queued turns in batches until stopped."""
+        while True:
+            turns, stopping = [], False
+            turn = self._pending.get()
+            # Drain whatever else is waiting so several turns share one embedding request
+            while True:
+                if turn is None:
+                    stopping = True
+                else:
+                    turns.append(turn)
+                if len(turns) >= self.batch_size:
+                    break
+                try:
+                    turn = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                self.store_turns(turns)
+            except Exception as e:
+                logger.error(f"Error storing {len(turns)} memories: {e}")
+            if stopping:
+                break
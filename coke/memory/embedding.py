@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Text embeddings for Coke memory.
+Uses the DashScope text embedding API (requires DASHSCOPE_API_KEY).
+"""
+
+import sys
+sys.path.append(".")
+
+import os
+import logging
+from http import HTTPStatus
+from logging import getLogger
+logging.basicConfig(level=logging.INFO)
+logger = getLogger(__name__)
+
+EMBEDDING_MODEL = "text-embedding-v2"
+EMBEDDING_DIMENSION = 1536
+
+# DashScope accepts at most this many texts per request
+MAX_BATCH_SIZE = 25
+
+def embedding_available():
+    """Whether the embedding API can be called (SDK installed and API key set)."""
+    try:
+        import dashscope  # noqa: F401
+    except ImportError:
+        return False
+    return bool(os.environ.get("DASHSCOPE_API_KEY"))
+
+def embed_texts(texts, model=EMBEDDING_MODEL):
+    """
+    Embed a list of texts.
+    
+    Args:
+        texts: List of strings
+        model: DashScope embedding model name
+    
+    Returns:
+        List of embeddings (lists of floats), in the same order as texts
+    """
+    import dashscope
+    
+    embeddings = []
+    for start in range(0, len(texts), MAX_BATCH_SIZE):
+        batch = texts[start:start + MAX_BATCH_SIZE]
+        resp = dashscope.TextEmbedding.call(model=model, input=batch)
+        if resp.status_code != HTTPStatus.OK:
+            raise RuntimeError(f"Embedding request failed: {resp.code} {resp.message}")
+        items = sorted(resp.output["embeddings"], key=lambda item: item["text_index"])
+        embeddings.extend(item["embedding"] for item in items)
+    return embeddings
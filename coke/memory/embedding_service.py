@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Embedding Service for Coke
+Sits in front of an embedding provider: concurrent requests are micro-batched
+into one provider call, identical texts in flight are embedded once, and
+results are cached by content hash in memory (LRU) and optionally on disk.
+"""
+import sys
+sys.path.append(".")
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future
+from logging import getLogger
+
+import numpy as np
+
+from coke.memory.embedding import EMBEDDING_DIMENSION, EMBEDDING_MODEL, MAX_BATCH_SIZE
+
+logger = getLogger(__name__)
+
+LOCAL_MODEL = "local-hash-v1"
+
+def local_embedding(texts, dimension=EMBEDDING_DIMENSION):
+    """
+    Deterministic offline stand-in for the embedding API.
+
+    Character 1- and 2-grams are hashed into a fixed-size vector (feature
+    hashing), so texts sharing characters get similar embeddings and the same
+    text always gets the same embedding.
+    """
+    embeddings = []
+    for text in texts:
+        vector = np.zeros(dimension, dtype=np.float32)
+        text = text.lower()
+        grams = list(text) + [text[i:i + 2] for i in range(len(text) - 1)]
+        for gram in grams:
+            digest = hashlib.md5(gram.encode("utf-8")).digest()
+            slot = int.from_bytes(digest[:4], "little") % dimension
+            vector[slot] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        embeddings.append(vector.tolist())
+    return embeddings
+
+class DiskEmbeddingCache:
+    """Embeddings stored in a SQLite file, keyed by content hash."""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        """Return {key: np.ndarray} for the keys found."""
+        found = {}
+        with self._lock:
+            # SQLite limits the number of bound parameters per statement
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, items):
+        """Store {key: vector}."""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items.items()]
+            )
+            self._conn.commit()
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
+
+class EmbeddingService:
+    """Batched, cached and deduplicated access to an embedding function."""
+
+    def __init__(self, embed_fn=None, model=EMBEDDING_MODEL, max_batch_size=MAX_BATCH_SIZE,
+                 max_wait_ms=10, cache_size=10000, cache_path=None):
+        """
+        Initialize the embedding service.
+
+        Args:
+            embed_fn: Provider function taking a list of texts and returning
+                their embeddings (defaults to the DashScope API)
+            model: Model name, part of the cache key so switching models
+                never returns stale vectors
+            max_batch_size: Maximum texts per provider call
+            max_wait_ms: How long a request waits for others to join its batch
+            cache_size: Embeddings kept in the in-memory LRU cache
+            cache_path: SQLite file for the on-disk cache (None disables it)
+        """
+        if embed_fn is None:
+            from coke.memory.embedding import embed_texts
+            embed_fn = embed_texts
+        self.embed_fn = embed_fn
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.cache_size = cache_size
+        self.disk_cache = DiskEmbeddingCache(cache_path) if cache_path else None
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._in_flight = {}  # key -> Future, shared by every caller asking for the same text
+        self._pending = []    # (key, text) waiting for the next provider call
+        self._pending_since = None
+        self._condition = threading.Condition()
+        self.running = False
+        self._closed = False
+        self.thread = None
+        self.stats = {"requests": 0, "memory_hits": 0, "disk_hits": 0, "deduplicated": 0,
+                      "embedded": 0, "provider_calls": 0}
+
+    def __call__(self, texts):
+        """Same as embed(), so the service can be passed wherever an embed_fn is expected."""
+        return self.embed(texts)
+
+    def cache_key(self, text):
+        """Content hash of a text under the current model."""
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+    def embed(self, texts):
+        """
+        Embed a list of texts.
+
+        Cached texts are returned immediately; the rest are embedded in a
+        shared provider call together with texts from concurrent callers.
+
+        Returns:
+            List of embeddings (lists of floats), in the same order as texts
+        """
+        keys = [self.cache_key(text) for text in texts]
+        vectors = {}
+        with self._cache_lock:
+            self.stats["requests"] += len(texts)
+            for key in keys:
+                vector = self._cache.get(key)
+                if vector is not None:
+                    self._cache.move_to_end(key)
+                    vectors[key] = vector
+            self.stats["memory_hits"] += sum(1 for key in keys if key in vectors)
+
+        missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+        if missing and self._closed:
+            raise RuntimeError("EmbeddingService is closed")
+        if missing and self.disk_cache:
+            found = self.disk_cache.get_many(missing)
+            if found:
+                self._remember(found)
+                vectors.update(found)
+                with self._cache_lock:
+                    self.stats["disk_hits"] += len(found)
+                missing = [key for key in missing if key not in found]
+
+        if missing:
+            text_by_key = dict(zip(keys, texts))
+            futures = self._submit([(key, text_by_key[key]) for key in missing])
+            for key, future in futures.items():
+                vectors[key] = future.result()
+
+        return [vectors[key].tolist() for key in keys]
+
+    def _submit(self, items):
+        """Queue texts for the batcher, joining requests already in flight."""
+        futures = {}
+        with self._condition:
+            if self._closed:
+                # close() may have run since embed() checked
+                raise RuntimeError("EmbeddingService is closed")
+            if not self.running:
+                self._start()
+            for key, text in items:
+                future = self._in_flight.get(key)
+                if future is not None:
+                    self.stats["deduplicated"] += 1
+                else:
+                    future = Future()
+                    self._in_flight[key] = future
+                    self._pending.append((key, text))
+                    if self._pending_since is None:
+                        self._pending_since = time.monotonic()
+                futures[key] = future
+            self._condition.notify()
+        return futures
+
+    def _start(self):
+        """Start the batcher thread (caller holds the condition)."""
+        self.running = True
+        self.thread = threading.Thread(target=self._run_loop, daemon=True, name="coke-embedding")
+        self.thread.start()
+
+    def close(self):
+        """
+        Embed what is still pending, then stop the batcher and close the disk cache.
+
+        Later calls to embed() raise RuntimeError for texts that are not
+        in the in-memory cache.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self.running = False
+            self._condition.notify()
+        if self.thread:
+            self.thread.join(timeout=10)
+        if self.disk_cache:
+            self.disk_cache.close()
+
+    def _run_loop(self):
+        """Collect pending texts into batches and call the provider."""
+        while True:
+            with self._condition:
+                while self.running and not self._pending:
+                    self._condition.wait()
+                if not self._pending:
+                    break
+                # Wait for more texts until the batch is full or the oldest one has waited long enough
+                deadline = self._pending_since + self.max_wait_ms / 1000
+                while self.running and len(self._pending) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._pending[:self.max_batch_size]
+                self._pending = self._pending[self.max_batch_size:]
+                self._pending_since = time.monotonic() if self._pending else None
+            self._embed_batch(batch)
+
+    def _embed_batch(self, batch):
+        """Call the provider for one batch and resolve its futures."""
+        keys = [key for key, _ in batch]
+        try:
+            embeddings = self.embed_fn([text for _, text in batch])
+            if len(embeddings) != len(batch):
+                raise RuntimeError(f"Provider returned {len(embeddings)} embeddings for {len(batch)} texts")
+            vectors = {key: np.asarray(embedding, dtype=np.float32) for key, embedding in zip(keys, embeddings)}
+            self._remember(vectors)
+            if self.disk_cache:
+                self.disk_cache.put_many(vectors)
+        except Exception as e:
+            logger.error(f"Embedding batch of {len(batch)} texts failed: {e}")
+            with self._condition:
+                for key in keys:
+                    self._in_flight.pop(key).set_exception(e)
+            return
+
+        with self._condition:
+            self.stats["provider_calls"] += 1
+            self.stats["embedded"] += len(batch)
+            for key in keys:
+                self._in_flight.pop(key).set_result(vectors[key])
+
+    def _remember(self, vectors):
+        """Add vectors to the LRU cache, evicting the least recently used."""
+        with self._cache_lock:
+            for key, vector in vectors.items():
+                self._cache[key] = vector
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+# Example: concurrent requests share a few provider calls, repeated texts hit the cache
+if __name__ == "__main__":
+    from concurrent.futures import ThreadPoolExecutor
+
+    calls = []
+    def slow_local_embedding(texts):
+        calls.append(len(texts))
+        time.sleep(0.05)  # Simulated provider latency
+        return local_embedding(texts)
+
+    service = EmbeddingService(slow_local_embedding, model=LOCAL_MODEL)
+    texts = [f"学习英语 {i % 40}" for i in range(200)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        list(executor.map(lambda text: service.embed([text]), texts))
+    print(f"200 concurrent requests: {len(calls)} provider calls, {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    service.embed(texts)
+    print(f"repeat of the same 200 texts: {(time.perf_counter() - start) * 1000:.1f} ms, stats {service.stats}")
+    print(f"unbatched and uncached this would take {200 * 0.05:.0f}s")
+    service.close()
@@ -7,6 +7,9 @@ COKE_TASK_PROMPT = """用户发送了以下消息：
 历史对话：
 {conversation_history}
 
+相关的更早记忆（可能有用，不相关就忽略）：
+{relevant_memories}
+
 请直接回复，不要添加任何前缀或说明，回复语气像朋友。
 
 🔴 回复格式要求：
@@ -6,30 +6,85 @@ Runs in a separate thread to check and send due reminders
 import sys
 sys.path.append(".")
 
+import os
 import time
+import uuid
+import socket
 import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from framework.agent.base_agent import AgentStatus
+from coke.scheduler.reminder_scheduler import shard_query, user_shard
+from coke.scheduler.change_stream_watcher import ChangeStreamWatcher
+from coke.scheduler.delivery_store import DeliveryStore
 
 logger = getLogger(__name__)
 
+def default_worker_id():
+    """Worker ID unique per process: host, pid and a random suffix."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def default_stream_id():
+    """Stable name for resume tokens when no worker ID is configured: the host name."""
+    return socket.gethostname()
+
 class BackgroundReminderRunner:
     """Background thread that checks for due reminders."""
     
-    def __init__(self, reminder_scheduler, check_interval=30):
+    def __init__(self, reminder_scheduler, check_interval=30, worker_id=None,
+                 shard_index=0, shard_count=1, lease_seconds=300, claim_batch_size=10,
+                 event_driven=False, pregenerate_lead_seconds=300):
         """
         Initialize background runner.
         
+        Several runners (threads, processes or hosts) can share the same
+        database: reminders are claimed with a lease before a message is
+        generated, and users can be split across runners by hash.
+        
         Args:
             reminder_scheduler: ReminderScheduler instance
             check_interval: How often to check for due reminders (seconds)
+            worker_id: Unique ID of this runner (generated if omitted). A
+                configured ID is also used to key change stream resume
+                tokens; a generated one changes on every start, so tokens
+                are then keyed on the host name instead
+            shard_index: Shard of users served by this runner
+            shard_count: Total number of shards (1 = serve every user)
+            lease_seconds: How long a claimed reminder is held before another
+                runner may take it over
+            claim_batch_size: Number of reminders claimed per round
+            event_driven: Wake up on MongoDB change streams instead of only
+                polling (falls back to polling when not on a replica set)
+            pregenerate_lead_seconds: Generate reminder messages this long
+                before they fall due, in a separate thread (0 disables)
         """
+        if not 0 <= shard_index < max(shard_count, 1):
+            raise ValueError("shard_index must be in [0, shard_count)")
+        
         self.reminder_scheduler = reminder_scheduler
         self.check_interval = check_interval
+        self.worker_id = worker_id or default_worker_id()
+        self.stream_id = worker_id or default_stream_id()
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.lease_seconds = lease_seconds
+        self.claim_batch_size = claim_batch_size
+        self.event_driven = event_driven
+        self.pregenerate_lead_seconds = pregenerate_lead_seconds
+        self.pregen_thread = None
+        self._pregen_wakeup = threading.Event()
+        self.event_mode = False  # True once change streams are actually running
+        self.watcher = None
         self.running = False
+        self._wakeup = threading.Event()
+        self._wakeup_lock = threading.Lock()
+        self._next_wakeup = None
         self.thread = None
-        self.pending_reminders = []  # Store reminders to be retrieved by frontend
+        self.delivery_store = DeliveryStore(retention_seconds=60)  # Ready messages for the frontend
+        self.checkin_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="coke-checkin")
         
     def start(self):
         """Start the background runner thread."""
@@ -37,50 +92,114 @@ class BackgroundReminderRunner:
             return
         
         self.running = True
+        
+        if self.event_driven:
+            self.watcher = ChangeStreamWatcher(
+                self.reminder_scheduler.mongo_db,
+                on_reminder=self._on_reminder_change,
+                on_activity=self._on_activity_change,
+                stream_id=self.stream_id,
+                stream_suffix=f":{self.shard_index}/{self.shard_count}" if self.shard_count > 1 else ""
+            )
+            self.event_mode = self.watcher.start()
+        
         self.thread = threading.Thread(target=self._run_loop, daemon=True)
         self.thread.start()
-        logger.info(f"📅 Reminder background runner started (checking every {self.check_interval}s)")
+        
+        if self.pregenerate_lead_seconds > 0:
+            self.pregen_thread = threading.Thread(target=self._pregenerate_loop, daemon=True)
+            self.pregen_thread.start()
+        logger.info(f"📅 Reminder background runner {self.worker_id} started "
+                    f"(shard {self.shard_index}/{self.shard_count}, checking every {self.check_interval}s)")
     
     def stop(self):
         """Stop the background runner."""
         self.running = False
+        self._wakeup.set()
+        self._pregen_wakeup.set()
+        if self.watcher:
+            self.watcher.stop()
         if self.thread:
             self.thread.join(timeout=5)
+        if self.pregen_thread:
+            self.pregen_thread.join(timeout=5)
+        self.checkin_executor.shutdown(wait=False)
         logger.info("Reminder background runner stopped")
     
+    def _owns_user(self, user_id):
+        """Whether this runner's shard serves the given user."""
+        return self.shard_count <= 1 or user_shard(user_id) % self.shard_count == self.shard_index
+    
+    def _schedule_wakeup(self, when, notify=True):
+        """
+        Make sure the loop wakes up no later than `when`.
+        
+        The sleeping loop is only interrupted when `when` is earlier than
+        every wake-up it already knows about; later times are picked up
+        when it next computes its sleep.
+        """
+        with self._wakeup_lock:
+            earliest = self._next_wakeup is None or when < self._next_wakeup
+            if earliest:
+                self._next_wakeup = when
+        if notify and earliest:
+            self._wakeup.set()
+    
+    def _on_reminder_change(self, reminder):
+        """Change stream callback: a reminder was created or updated."""
+        if reminder.get("status") != "pending" or not self._owns_user(reminder.get("user_id")):
+            return
+        reminder_time = reminder.get("reminder_time")
+        if isinstance(reminder_time, datetime):
+            logger.info(f"📡 Reminder event: {reminder.get('task_description')} due at {reminder_time}")
+            self._schedule_wakeup(reminder_time)
+            if not reminder.get("message"):
+                self._pregen_wakeup.set()
+    
+    def _on_activity_change(self, activity):
+        """Change stream callback: a user sent a message."""
+        if not self._owns_user(activity.get("user_id")):
+            return
+        last_message_time = activity.get("last_message_time")
+        if isinstance(last_message_time, datetime):
+            # Next possible check-in for this user
+            self._schedule_wakeup(last_message_time + timedelta(hours=4), notify=False)
+    
+    def _wait_for_next_check(self):
+        """Sleep until the next poll, an earlier known due time, or a change event."""
+        timeout = self.check_interval
+        
+        if self.event_mode:
+            next_due = self.reminder_scheduler.get_next_reminder_time(self.shard_index, self.shard_count)
+            if isinstance(next_due, datetime):
+                self._schedule_wakeup(next_due, notify=False)
+        
+        with self._wakeup_lock:
+            next_wakeup = self._next_wakeup
+        if next_wakeup is not None:
+            timeout = max(0, min(timeout, (next_wakeup - datetime.now()).total_seconds()))
+        
+        logger.debug(f"Sleeping for {timeout:.1f}s until next check...")
+        self._wakeup.wait(timeout)
+    
     def _run_loop(self):
         """Main loop that checks for due reminders and inactive users."""
         check_count = 0
         while self.running:
+            # Reset before checking so events arriving mid-check trigger another round;
+            # wake-ups still in the future are kept
+            with self._wakeup_lock:
+                if self._next_wakeup is not None and self._next_wakeup <= datetime.now():
+                    self._next_wakeup = None
+            self._wakeup.clear()
+            
             try:
                 check_count += 1
                 logger.info(f"🔍 Background check #{check_count} running...")
                 
-                # Check for due reminders
-                due_reminders = self.reminder_scheduler.get_due_reminders()
-                
-                if due_reminders:
-                    logger.info(f"📬 Found {len(due_reminders)} due reminder(s)")
-                    
-                    for reminder in due_reminders:
-                        # Generate message NOW (when timer expires)
-                        if not reminder.get('message'):
-                            logger.info(f"🤖 Generating proactive message for: {reminder['task_description']}")
-                            reminder['message'] = self._generate_proactive_message(
-                                reminder['user_id'],
-                                reminder['task_description']
-                            )
-                        
-                        # Add to pending list (will be retrieved by API)
-                        self.pending_reminders.append(reminder)
-                        logger.info(f"   Added to pending list (total pending: {len(self.pending_reminders)})")
-                        
-                        # Mark as sent
-                        self.reminder_scheduler.mark_reminder_sent(reminder["_id"])
-                        
-                        logger.info(f"⏰ Reminder due for {reminder['user_id']}: {reminder['task_description']}")
-                        logger.info(f"   Message: {reminder.get('message', 'N/A')}")
-                else:
+                # Claim and process due reminders until none are left
+                processed = self._process_due_reminders()
+                if not processed:
                     logger.debug(f"No due reminders found in check #{check_count}")
                 
                 # Check for inactive users (every check cycle)
@@ -92,8 +211,118 @@ class BackgroundReminderRunner:
                 traceback.print_exc()
             
             # Wait before next check
-            logger.debug(f"Sleeping for {self.check_interval}s until next check...")
-            time.sleep(self.check_interval)
+            try:
+                self._wait_for_next_check()
+            except Exception as e:
+                logger.error(f"Error computing next check time: {e}")
+                self._wakeup.wait(self.check_interval)
+    
+    def trigger_check(self):
+        """
+        Claim and deliver due reminders right now instead of waiting for the
+        next check (used by the debug endpoint).
+        
+        Returns:
+            The reminders that were delivered, with their generated messages
+        """
+        return self._process_due_reminders()
+    
+    def _process_due_reminders(self):
+        """Claim due reminders in small batches, generate messages and mark them sent; returns them."""
+        processed = []
+        while self.running:
+            due_reminders = self.reminder_scheduler.claim_due_reminders(
+                self.worker_id,
+                lease_seconds=self.lease_seconds,
+                limit=self.claim_batch_size,
+                shard_index=self.shard_index,
+                shard_count=self.shard_count
+            )
+            if not due_reminders:
+                break
+            
+            logger.info(f"📬 Claimed {len(due_reminders)} due reminder(s)")
+            
+            for reminder in due_reminders:
+                # Normally pre-generated; generate NOW only if that didn't happen in time
+                if not reminder.get('message'):
+                    logger.info(f"🤖 Generating proactive message for: {reminder['task_description']}")
+                    reminder['message'] = self._generate_proactive_message(
+                        reminder['user_id'],
+                        reminder['task_description']
+                    )
+                
+                # Add to delivery store (will be retrieved by API)
+                self.delivery_store.add(reminder)
+                
+                logger.info(f"⏰ Reminder due for {reminder['user_id']}: {reminder['task_description']}")
+                logger.info(f"   Message: {reminder.get('message', 'N/A')}")
+            
+            # Mark the whole batch as sent in one update, only while we still hold the lease
+            self.reminder_scheduler.mark_reminders_sent(
+                [reminder["_id"] for reminder in due_reminders],
+                worker_id=self.worker_id
+            )
+            processed.extend(due_reminders)
+        
+        return processed
+    
+    def _pregenerate_loop(self):
+        """Loop that generates messages for reminders about to fall due."""
+        while self.running:
+            self._pregen_wakeup.clear()
+            try:
+                generated = self._pregenerate_messages()
+                if generated:
+                    logger.info(f"🧠 Pre-generated {generated} reminder message(s)")
+            except Exception as e:
+                logger.error(f"Error in pre-generation loop: {e}")
+            
+            self._pregen_wakeup.wait(self.check_interval)
+    
+    def _pregenerate_messages(self):
+        """Generate and store messages for reminders due within the lead window."""
+        generated = 0
+        while self.running:
+            reminder = self.reminder_scheduler.claim_reminder_for_pregeneration(
+                self.worker_id,
+                self.pregenerate_lead_seconds,
+                shard_index=self.shard_index,
+                shard_count=self.shard_count
+            )
+            if reminder is None:
+                break
+            
+            logger.info(f"🤖 Pre-generating message for: {reminder['task_description']} (due {reminder.get('reminder_time')})")
+            message = self._generate_proactive_message(
+                reminder['user_id'],
+                reminder['task_description']
+            )
+            if self.reminder_scheduler.save_pregenerated_message(reminder, message):
+                generated += 1
+        
+        return generated
+    
+    def _get_recent_messages(self, user_id, limit=5):
+        """Get a user's most recent conversation turns, oldest first."""
+        try:
+            recent_messages = self.reminder_scheduler.mongo_db.find_many(
+                "coke_conversations",
+                {"user_id": user_id},
+                limit=limit,
+                sort=[("timestamp", -1)]
+            )
+            return list(reversed(recent_messages))
+        except Exception as e:
+            logger.warning(f"Could not fetch conversation history: {e}")
+            return []
+    
+    def _format_history(self, messages):
+        """Render conversation turns for a prompt."""
+        return "\n".join([
+            f"用户: {msg['user']}\nCoke: {msg['coke']}"
+            for msg in messages
+        ])
     
     def _generate_proactive_message(self, user_id, task_description):
         """Generate a proactive reminder message using AI with recent context."""
@@ -101,30 +330,10 @@ class BackgroundReminderRunner:
             from coke.agent.coke_proactive_agent import CokeProactiveAgent
             
             # Get recent conversation history for context
-            conversation_history = ""
-            try:
-                recent_messages = self.reminder_scheduler.mongo_db.find_many(
-                    "coke_conversations",
-                    {"user_id": user_id},
-                    limit=100
-                )
-                
-                if recent_messages:
-                    # Sort by timestamp and get most recent
-                    sorted_msgs = sorted(
-                        recent_messages, 
-                        key=lambda x: x.get("timestamp", ""), 
-                        reverse=True
-                    )[:5]
-                    sorted_msgs.reverse()  # Oldest first
-                    
-                    conversation_history = "\n".join([
-                        f"用户: {msg['user']}\nCoke: {msg['coke']}"
-                        for msg in sorted_msgs
-                    ])
-                    logger.info(f"   📖 Using recent conversation context ({len(sorted_msgs)} messages)")
-            except Exception as e:
-                logger.warning(f"Could not fetch conversation history: {e}")
+            recent_messages = self._get_recent_messages(user_id, limit=5)
+            conversation_history = self._format_history(recent_messages)
+            if recent_messages:
+                logger.info(f"   📖 Using recent conversation context ({len(recent_messages)} messages)")
             
             # Generate message with CokeProactiveAgent
             context = {
@@ -136,7 +345,7 @@ class BackgroundReminderRunner:
             agent = CokeProactiveAgent(context)
             
             for result in agent.run():
-                if result.get("status") == "finished":
+                if result.get("status") == AgentStatus.FINISHED.value:
                     message = context.get("reminder_message", "")
                     if message:
                         logger.info(f"   ✅ Generated: {message}")
@@ -151,91 +360,113 @@ class BackgroundReminderRunner:
             logger.error(f"Failed to generate proactive message: {e}")
             return f"⏰ 做得怎么样了？{task_description}完成了吗？"
     
+    def _generate_checkin_message(self, user_id):
+        """Generate a contextual check-in message using AI with recent context."""
+        try:
+            from coke.agent.coke_proactive_agent import CokeProactiveAgent
+            
+            # Get recent conversation for context
+            recent_messages = self._get_recent_messages(user_id, limit=3)
+            
+            # Extract last task if any
+            last_task = ""
+            for msg in reversed(recent_messages):
+                if "学" in msg.get('user', '') or "做" in msg.get('user', ''):
+                    last_task = msg.get('user', '')
+                    break
+            
+            context = {
+                "message_type": "checkin",
+                "conversation_history": self._format_history(recent_messages),
+                "last_task": last_task
+            }
+            
+            agent = CokeProactiveAgent(context)
+            
+            for result in agent.run():
+                if result.get("status") == AgentStatus.FINISHED.value:
+                    message = context.get("checkin_message", "")
+                    if message:
+                        logger.info(f"   ✅ Generated check-in: {message}")
+                        return message
+            
+            fallback = "hey，在干嘛呢？"
+            logger.warning(f"   ⚠️  Using fallback: {fallback}")
+            return fallback
+            
+        except Exception as e:
+            logger.error(f"Failed to generate check-in message: {e}")
+            return "hey，还好吗？"
+    
+    def _deliver_checkin(self, checkin_reminder):
+        """Generate a check-in message and hand it to the delivery store (runs in the executor)."""
+        checkin_reminder["message"] = self._generate_checkin_message(checkin_reminder["user_id"])
+        self.delivery_store.add(checkin_reminder)
+    
     def _check_inactive_users(self):
         """Check for users who haven't messaged in 4+ hours."""
         try:
-            from datetime import datetime, timedelta
-            
             # Get mongo_db from reminder_scheduler
             mongo_db = self.reminder_scheduler.mongo_db
             
-            # Find all users
-            all_activity = mongo_db.find_many("user_activity", {}, limit=1000)
+            now = datetime.now()
+            four_hours_ago = now - timedelta(hours=4)
+            one_hour_ago = now - timedelta(hours=1)
             
-            four_hours_ago = (datetime.now() - timedelta(hours=4)).isoformat()
+            # Users whose last message was > 4 hours ago and who haven't
+            # had a check-in in the last hour (don't spam)
+            inactive_query = {
+                "last_message_time": {"$lt": four_hours_ago},
+                "$or": [
+                    {"last_checkin_time": {"$lt": one_hour_ago}},
+                    {"last_checkin_time": None}
+                ],
+                **shard_query(self.shard_index, self.shard_count)
+            }
+            # Streamed in batches so the sweep runs in constant memory however many users match
+            inactive_activity = mongo_db.iter_many(
+                "user_activity",
+                inactive_query,
+                limit=1000,
+                batch_size=100
+            )
             
-            for activity in all_activity:
-                last_time = activity.get("last_message_time", "")
+            for activity in inactive_activity:
                 user_id = activity.get("user_id")
                 
-                # Check if last message was > 4 hours ago
-                if last_time < four_hours_ago:
-                    # Check if we already sent a check-in recently
-                    last_checkin = activity.get("last_checkin_time", "")
-                    one_hour_ago = (datetime.now() - timedelta(hours=1)).isoformat()
-                    
-                    # Don't spam - only check-in if we haven't in the last hour
-                    if last_checkin < one_hour_ago:
-                        # Create a check-in reminder
-                        checkin_reminder = {
-                            "user_id": user_id,
-                            "task_description": "check-in",
-                            "reminder_time": datetime.now().isoformat(),  # Send now
-                            "created_at": datetime.now().isoformat(),
-                            "status": "pending",
-                            "message": "",  # Will be generated by frontend
-                            "is_checkin": True  # Flag to trigger AI generation
-                        }
-                        
-                        self.pending_reminders.append(checkin_reminder)
-                        
-                        # Update last check-in time
-                        mongo_db.update_one(
-                            "user_activity",
-                            {"user_id": user_id},
-                            {"$set": {"last_checkin_time": datetime.now().isoformat()}}
-                        )
-                        
-                        logger.info(f"👋 Check-in triggered for inactive user: {user_id}")
+                # Claim the check-in atomically so only one runner sends it
+                claimed = mongo_db.update_one(
+                    "user_activity",
+                    {"_id": activity["_id"], **inactive_query},
+                    {"$set": {"last_checkin_time": now, "checkin_claimed_by": self.worker_id}}
+                )
+                if not claimed:
+                    continue
+                
+                # Create a check-in reminder
+                checkin_reminder = {
+                    "user_id": user_id,
+                    "task_description": "check-in",
+                    "reminder_time": now,  # Send now
+                    "created_at": now,
+                    "status": "pending",
+                    "message": "",  # Generated in the background below
+                    "is_checkin": True
+                }
+                
+                # Generate off the loop thread so due reminders aren't held up
+                self.checkin_executor.submit(self._deliver_checkin, checkin_reminder)
+                
+                logger.info(f"👋 Check-in triggered for inactive user: {user_id}")
                         
         except Exception as e:
             logger.error(f"Error checking inactive users: {e}")
     
     def get_pending_reminders_for_user(self, user_id):
         """Get pending reminders for a specific user (returns each reminder multiple times until expired)."""
-        from datetime import datetime, timedelta
-        
-        now = datetime.now()
-        
-        # Get reminders for this user
-        user_reminders = []
-        for r in self.pending_reminders:
-            if r.get("user_id") == user_id:
-                # Set first_retrieved timestamp if not set
-                if not r.get('first_retrieved_at'):
-                    r['first_retrieved_at'] = now
-                    logger.info(f"📬 First retrieval of reminder: {r.get('task_description')}")
-                
-                user_reminders.append(r)
+        user_reminders = self.delivery_store.get_for_user(user_id)
         
         if user_reminders:
             logger.info(f"📬 Returning {len(user_reminders)} pending reminder(s) for {user_id}")
-            for reminder in user_reminders:
-                age = (now - reminder.get('first_retrieved_at', now)).total_seconds()
-                logger.debug(f"   → {reminder.get('task_description')} (age: {age:.0f}s)")
-        
-        # Clean up old reminders (60 seconds after FIRST retrieval)
-        cleaned = []
-        for r in self.pending_reminders:
-            first_retrieved_at = r.get('first_retrieved_at')
-            if first_retrieved_at:
-                age = (now - first_retrieved_at).total_seconds()
-                if age > 60:  # Keep for 60 seconds after first retrieval
-                    logger.info(f"🗑️  Removing expired reminder: {r.get('task_description')} for {r.get('user_id')} (age: {age:.0f}s)")
-                    continue
-            cleaned.append(r)
-        
-        self.pending_reminders = cleaned
         
         return user_reminders
-
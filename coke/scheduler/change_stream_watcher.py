@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Change Stream Watcher for Coke Reminders
+Tails MongoDB change streams on coke_reminders and user_activity so the
+background runner is woken up as soon as a reminder or activity is written,
+instead of waiting for the next poll.
+
+Change streams require a replica set. For local testing, a single-node
+replica set is enough:
+
+    mongod --replSet rs0 --dbpath /tmp/coke-rs0
+    mongosh --eval 'rs.initiate()'
+
+On a standalone server the watcher reports itself unavailable and the
+runner keeps polling.
+"""
+import sys
+sys.path.append(".")
+
+import time
+import threading
+import logging
+from logging import getLogger
+from datetime import datetime, timedelta
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = getLogger(__name__)
+
+# Collection holding the last resume token of each stream
+TOKEN_COLLECTION = "coke_stream_tokens"
+
+# Error code returned when a resume token is no longer in the oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+# Only changes that can make something due sooner reach the callbacks:
+# new or replaced documents, a reminder (re)scheduled or set back to pending,
+# a pre-generated message being invalidated, and new user activity. Lease
+# bookkeeping (claims, pre-generation claims, sent marks) is filtered out
+# on the server.
+STREAM_FILTERS = {
+    "coke_reminders": {"$or": [
+        {"operationType": {"$in": ["insert", "replace"]}},
+        {"operationType": "update", "$or": [
+            {"updateDescription.updatedFields.reminder_time": {"$exists": True}},
+            {"updateDescription.updatedFields.status": "pending"},
+            {"updateDescription.updatedFields.message": ""}
+        ]}
+    ]},
+    "user_activity": {"$or": [
+        {"operationType": {"$in": ["insert", "replace"]}},
+        {"operationType": "update",
+         "updateDescription.updatedFields.last_message_time": {"$exists": True}}
+    ]}
+}
+DEFAULT_STREAM_FILTER = {"operationType": {"$in": ["insert", "update", "replace"]}}
+
+class ChangeStreamWatcher:
+    """Tails change streams and forwards changed documents to callbacks."""
+
+    def __init__(self, mongo_db, on_reminder=None, on_activity=None, stream_id="",
+                 stream_suffix="", max_await_time_ms=1000, retry_interval=5,
+                 token_save_interval=5, stale_token_days=7):
+        """
+        Initialize change stream watcher.
+
+        Args:
+            mongo_db: MongoDBBase instance
+            on_reminder: Callback receiving each inserted/updated reminder document
+            on_activity: Callback receiving each inserted/updated user_activity document
+            stream_id: Stable name of this watcher (e.g. host name or a
+                configured worker name) used in resume token keys, so a
+                restarted process resumes where the previous one stopped;
+                must not change between restarts
+            stream_suffix: Suffix for resume token keys, so runners serving
+                different shards keep separate positions
+            max_await_time_ms: How long a getMore waits for new events
+            retry_interval: Seconds to wait before reopening a failed stream
+            token_save_interval: Seconds between resume token writes; the
+                latest token is also written when a stream closes
+            stale_token_days: Resume tokens not written for this long (left
+                behind by renamed or retired watchers) are deleted on start
+        """
+        self.mongo_db = mongo_db
+        self.stream_id = stream_id
+        self.stream_suffix = stream_suffix
+        self.max_await_time_ms = max_await_time_ms
+        self.retry_interval = retry_interval
+        self.token_save_interval = token_save_interval
+        self.stale_token_days = stale_token_days
+        self.running = False
+        self.threads = []
+        self.streams = {}
+
+        self.handlers = {}
+        if on_reminder:
+            self.handlers["coke_reminders"] = on_reminder
+        if on_activity:
+            self.handlers["user_activity"] = on_activity
+
+    def is_available(self):
+        """Check whether the server supports change streams (replica set or sharded)."""
+        try:
+            hello = self.mongo_db.client.admin.command("hello")
+        except PyMongoError as e:
+            logger.warning(f"Could not query server topology: {e}")
+            return False
+        return bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+
+    def start(self):
+        """
+        Start one watcher thread per collection.
+
+        Returns:
+            bool: False if change streams are not available on this server
+        """
+        if self.running:
+            return True
+
+        if not self.is_available():
+            logger.info("📡 Change streams unavailable (not a replica set), falling back to polling")
+            return False
+
+        self._delete_stale_tokens()
+        self.running = True
+        for collection_name, handler in self.handlers.items():
+            thread = threading.Thread(
+                target=self._watch_loop,
+                args=(collection_name, handler),
+                daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+        logger.info(f"📡 Change stream watcher started on {list(self.handlers)}")
+        return True
+
+    def stop(self):
+        """Stop all watcher threads."""
+        self.running = False
+        for stream in list(self.streams.values()):
+            try:
+                stream.close()
+            except PyMongoError:
+                pass
+        for thread in self.threads:
+            thread.join(timeout=5)
+        self.threads = []
+        logger.info("Change stream watcher stopped")
+
+    def _token_key(self, collection_name):
+        """Key of the resume token document for a collection."""
+        stream = f"@{self.stream_id}" if self.stream_id else ""
+        return f"{collection_name}{stream}{self.stream_suffix}"
+
+    def _load_resume_token(self, collection_name):
+        """Load the persisted resume token, or None to start from now."""
+        doc = self.mongo_db.find_one(TOKEN_COLLECTION, {"_id": self._token_key(collection_name)})
+        return doc.get("resume_token") if doc else None
+
+    def _save_resume_token(self, collection_name, token):
+        """Persist the resume token so a restarted runner continues where it stopped."""
+        self.mongo_db.get_collection(TOKEN_COLLECTION).update_one(
+            {"_id": self._token_key(collection_name)},
+            {"$set": {"resume_token": token, "updated_at": datetime.now()}},
+            upsert=True
+        )
+
+    def _delete_stale_tokens(self):
+        """Delete resume tokens nobody has written for stale_token_days (they are past the oplog anyway)."""
+        if not self.stale_token_days:
+            return
+        try:
+            cutoff = datetime.now() - timedelta(days=self.stale_token_days)
+            deleted = self.mongo_db.get_collection(TOKEN_COLLECTION).delete_many(
+                {"updated_at": {"$lt": cutoff}}
+            ).deleted_count
+            if deleted:
+                logger.info(f"📡 Deleted {deleted} stale resume token(s)")
+        except PyMongoError as e:
+            logger.warning(f"Could not delete stale resume tokens: {e}")
+
+    def _clear_resume_token(self, collection_name):
+        """Forget a resume token that can no longer be resumed from."""
+        self.mongo_db.delete_one(TOKEN_COLLECTION, {"_id": self._token_key(collection_name)})
+
+    def _watch_loop(self, collection_name, handler):
+        """Tail one collection, reopening the stream after errors."""
+        pipeline = [{"$match": STREAM_FILTERS.get(collection_name, DEFAULT_STREAM_FILTER)}]
+        collection = self.mongo_db.get_collection(collection_name)
+
+        while self.running:
+            resume_token = self._load_resume_token(collection_name)
+            unsaved_token = None
+            last_saved = time.monotonic()
+            try:
+                with collection.watch(
+                    pipeline,
+                    full_document="updateLookup",
+                    resume_after=resume_token,
+                    max_await_time_ms=self.max_await_time_ms
+                ) as stream:
+                    self.streams[collection_name] = stream
+                    if resume_token:
+                        logger.info(f"📡 Resumed change stream on {collection_name}")
+
+                    while self.running and stream.alive:
+                        change = stream.try_next()
+                        if change is None:
+                            # Idle: write a token held back by the timer
+                            if unsaved_token is not None and \
+                                    time.monotonic() - last_saved >= self.token_save_interval:
+                                self._save_resume_token(collection_name, unsaved_token)
+                                unsaved_token, last_saved = None, time.monotonic()
+                            continue
+
+                        document = change.get("fullDocument")
+                        if document is not None:
+                            try:
+                                handler(document)
+                            except Exception as e:
+                                logger.error(f"Change handler for {collection_name} failed: {e}")
+
+                        # Write the position at most every token_save_interval seconds;
+                        # after a crash the runner's first poll covers the gap
+                        unsaved_token = stream.resume_token
+                        if time.monotonic() - last_saved >= self.token_save_interval:
+                            self._save_resume_token(collection_name, unsaved_token)
+                            unsaved_token, last_saved = None, time.monotonic()
+
+                    if unsaved_token is not None:
+                        self._save_resume_token(collection_name, unsaved_token)
+                        unsaved_token = None
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    # Oplog rolled past our position; the runner's next poll
+                    # covers anything missed in between
+                    logger.warning(f"Resume token for {collection_name} expired, restarting stream from now")
+                    self._clear_resume_token(collection_name)
+                    continue
+                logger.error(f"Change stream on {collection_name} failed: {e}")
+            except PyMongoError as e:
+                logger.error(f"Change stream on {collection_name} failed: {e}")
+            finally:
+                self.streams.pop(collection_name, None)
+
+            if self.running:
+                time.sleep(self.retry_interval)
+
+
+# 使用示例：连接单节点副本集并打印变更事件
+if __name__ == "__main__":
+    from dao.mongo import MongoDBBase
+
+    logging.basicConfig(level=logging.INFO)
+
+    mongo_db = MongoDBBase()
+    watcher = ChangeStreamWatcher(
+        mongo_db,
+        on_reminder=lambda doc: print("reminder:", doc.get("task_description"), doc.get("reminder_time")),
+        on_activity=lambda doc: print("activity:", doc.get("user_id"), doc.get("last_message_time"))
+    )
+
+    if watcher.start():
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            watcher.stop()
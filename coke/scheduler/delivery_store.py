@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Delivery Store for Coke Reminders
+Holds ready reminder/check-in messages until the frontend has picked them up
+"""
+import sys
+sys.path.append(".")
+
+import heapq
+import queue
+import itertools
+import threading
+import logging
+from logging import getLogger
+from collections import deque
+from datetime import datetime, timedelta
+
+logger = getLogger(__name__)
+
+class PendingDelivery:
+    """A ready message waiting for its user."""
+
+    __slots__ = ("user_id", "reminder", "first_retrieved_at")
+
+    def __init__(self, user_id, reminder):
+        self.user_id = user_id
+        self.reminder = reminder
+        self.first_retrieved_at = None
+
+class DeliveryStore:
+    """
+    Thread-safe per-user queue of ready messages.
+
+    Messages are pushed immediately to any open subscriber (SSE connection)
+    of their user; polling clients read them with get_for_user.
+
+    Each message is returned on every poll until `retention_seconds` after its
+    first retrieval, so a page reload inside that window still sees it. Entries
+    are kept in one deque per user, and retrieved entries are also pushed onto
+    an expiry heap, so a poll costs O(messages for that user) plus O(log n)
+    per expired entry.
+    """
+
+    def __init__(self, retention_seconds=60):
+        """
+        Initialize delivery store.
+
+        Args:
+            retention_seconds: How long a message stays retrievable after its first retrieval
+        """
+        self.retention = timedelta(seconds=retention_seconds)
+        self._lock = threading.Lock()
+        self._by_user = {}
+        self._expiry_heap = []  # (expires_at, seq, entry)
+        self._seq = itertools.count()
+        self._count = 0
+        self._subscribers = {}  # user_id -> set of queue.Queue
+
+    def add(self, reminder):
+        """Queue a ready reminder or check-in for its user."""
+        user_id = reminder.get("user_id")
+        entry = PendingDelivery(user_id, reminder)
+        with self._lock:
+            self._by_user.setdefault(user_id, deque()).append(entry)
+            self._count += 1
+            total = self._count
+            
+            subscribers = list(self._subscribers.get(user_id, ()))
+            if subscribers:
+                # Pushed counts as retrieved: keep it only for the retention window
+                self._mark_retrieved(entry, datetime.now())
+
+        for subscriber in subscribers:
+            subscriber.put(reminder)
+
+        logger.info(f"   Added to delivery store (total pending: {total}, pushed to {len(subscribers)} subscriber(s))")
+
+    def subscribe(self, user_id, replay_pending=False):
+        """
+        Open a push channel for a user.
+
+        Args:
+            user_id: User whose messages are pushed
+            replay_pending: Also put the user's already waiting messages on the
+                channel first. Done under the same lock as the registration,
+                so a message added concurrently arrives exactly once
+
+        Returns:
+            queue.Queue: Receives each reminder added for the user from now on
+        """
+        channel = queue.Queue()
+        now = datetime.now()
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(channel)
+            if replay_pending:
+                self._expire(now)
+                for entry in self._by_user.get(user_id, ()):
+                    if entry.first_retrieved_at is None:
+                        self._mark_retrieved(entry, now)
+                    channel.put(entry.reminder)
+        return channel
+
+    def unsubscribe(self, user_id, channel):
+        """Close a push channel opened with subscribe."""
+        with self._lock:
+            channels = self._subscribers.get(user_id)
+            if channels:
+                channels.discard(channel)
+                if not channels:
+                    del self._subscribers[user_id]
+
+    def get_for_user(self, user_id):
+        """
+        Get the ready messages for a user.
+
+        Returns:
+            List[Dict]: Reminder documents, oldest first
+        """
+        now = datetime.now()
+        with self._lock:
+            self._expire(now)
+
+            entries = self._by_user.get(user_id)
+            if not entries:
+                return []
+
+            for entry in entries:
+                if entry.first_retrieved_at is None:
+                    self._mark_retrieved(entry, now)
+                    logger.info(f"📬 First retrieval of reminder: {entry.reminder.get('task_description')}")
+
+            return [entry.reminder for entry in entries]
+
+    def _mark_retrieved(self, entry, now):
+        """Start an entry's retention window. Caller holds the lock."""
+        entry.first_retrieved_at = now
+        heapq.heappush(self._expiry_heap, (now + self.retention, next(self._seq), entry))
+
+    def _expire(self, now):
+        """Drop entries whose retention window has passed. Caller holds the lock."""
+        while self._expiry_heap and self._expiry_heap[0][0] < now:
+            _, _, entry = heapq.heappop(self._expiry_heap)
+            entries = self._by_user.get(entry.user_id)
+            if not entries:
+                continue
+            try:
+                entries.remove(entry)
+            except ValueError:
+                continue
+            self._count -= 1
+            if not entries:
+                del self._by_user[entry.user_id]
+            logger.info(f"🗑️  Removing expired reminder: {entry.reminder.get('task_description')} for {entry.user_id}")
+
+    def snapshot(self):
+        """List every pending message (for debugging)."""
+        with self._lock:
+            return [entry.reminder for entries in self._by_user.values() for entry in entries]
+
+    def __len__(self):
+        with self._lock:
+            return self._count
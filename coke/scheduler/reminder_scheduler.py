@@ -7,79 +7,357 @@ import sys
 sys.path.append(".")
 
 import time
+import zlib
 import logging
 from datetime import datetime, timedelta
 from logging import getLogger
 
+from pymongo import UpdateOne
+
 logger = getLogger(__name__)
 
+# Timestamp fields stored as BSON dates, per collection
+TIMESTAMP_FIELDS = {
+    "coke_reminders": ["reminder_time", "created_at", "sent_at"],
+    "user_activity": ["last_message_time", "last_checkin_time", "updated_at"],
+    "coke_conversations": ["timestamp"],
+}
+
+# Collections whose documents carry a user_shard hash
+SHARDED_COLLECTIONS = ["coke_reminders", "user_activity"]
+
+def user_shard(user_id):
+    """Stable hash of a user ID, identical across processes and hosts."""
+    return zlib.crc32(str(user_id).encode("utf-8"))
+
+def shard_query(shard_index=0, shard_count=1):
+    """Query fragment selecting the documents owned by one shard."""
+    if shard_count <= 1:
+        return {}
+    return {"user_shard": {"$mod": [shard_count, shard_index]}}
+
 class ReminderScheduler:
     """Manages scheduled reminders for Coke."""
     
-    def __init__(self, mongo_db):
+    def __init__(self, mongo_db, batch_size=100):
+        """
+        Initialize reminder scheduler.
+        
+        Args:
+            mongo_db: MongoDBBase instance
+            batch_size: Maximum number of due reminders fetched per check
+        """
         self.mongo_db = mongo_db
+        self.batch_size = batch_size
         logger.info("ReminderScheduler initialized")
     
+    def create_indexes(self):
+        """Create indexes used by the due-reminder and inactivity range queries."""
+        self.mongo_db.create_index(
+            "coke_reminders",
+            [("status", 1), ("reminder_time", 1)]
+        )
+        self.mongo_db.create_index(
+            "coke_reminders",
+            [("user_id", 1), ("status", 1)]
+        )
+        self.mongo_db.create_index(
+            "user_activity",
+            [("last_message_time", 1)]
+        )
+    
+    def migrate_timestamps(self):
+        """
+        Convert legacy ISO-string timestamps to BSON dates.
+        
+        Returns:
+            int: Number of documents updated
+        """
+        migrated = 0
+        for collection_name, fields in TIMESTAMP_FIELDS.items():
+            collection = self.mongo_db.get_collection(collection_name)
+            for field in fields:
+                # Empty strings were used as "never" markers, drop them
+                collection.update_many({field: ""}, {"$unset": {field: ""}})
+                
+                ops = []
+                for doc in collection.find({field: {"$type": "string"}}, {field: 1}):
+                    try:
+                        value = datetime.fromisoformat(doc[field])
+                    except ValueError:
+                        logger.warning(f"Skipping unparsable {collection_name}.{field}: {doc[field]}")
+                        continue
+                    ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {field: value}}))
+                    if len(ops) >= 1000:
+                        migrated += collection.bulk_write(ops, ordered=False).modified_count
+                        ops = []
+                if ops:
+                    migrated += collection.bulk_write(ops, ordered=False).modified_count
+        
+        if migrated:
+            logger.info(f"🔧 Migrated {migrated} timestamp field(s) to BSON dates")
+        return migrated
+    
+    def backfill_user_shards(self):
+        """
+        Add the user_shard hash to documents created before sharding.
+        
+        Returns:
+            int: Number of documents updated
+        """
+        backfilled = 0
+        for collection_name in SHARDED_COLLECTIONS:
+            collection = self.mongo_db.get_collection(collection_name)
+            ops = []
+            for doc in collection.find({"user_shard": {"$exists": False}}, {"user_id": 1}):
+                ops.append(UpdateOne(
+                    {"_id": doc["_id"]},
+                    {"$set": {"user_shard": user_shard(doc.get("user_id"))}}
+                ))
+                if len(ops) >= 1000:
+                    backfilled += collection.bulk_write(ops, ordered=False).modified_count
+                    ops = []
+            if ops:
+                backfilled += collection.bulk_write(ops, ordered=False).modified_count
+        
+        if backfilled:
+            logger.info(f"🔧 Backfilled user_shard on {backfilled} document(s)")
+        return backfilled
+    
     def create_reminder(self, user_id, task_description, duration_minutes):
         """Create a new reminder (message will be generated when due)."""
-        reminder_time = datetime.now() + timedelta(minutes=duration_minutes)
+        now = datetime.now()
+        reminder_time = now + timedelta(minutes=duration_minutes)
         
         reminder = {
             "user_id": user_id,
             "task_description": task_description,
-            "reminder_time": reminder_time.isoformat(),
-            "created_at": datetime.now().isoformat(),
+            "reminder_time": reminder_time,
+            "created_at": now,
             "status": "pending",
-            "message": ""  # Will be generated when due
+            "message": "",  # Generated ahead of time or when due
+            "message_version": 0,  # Bumped whenever a generated message goes stale
+            "user_shard": user_shard(user_id)
         }
         
         reminder_id = self.mongo_db.insert_one("coke_reminders", reminder)
         logger.info(f"📅 Created reminder {reminder_id} for {user_id} at {reminder_time}")
         logger.info(f"   Task: {task_description}")
-        logger.info(f"   ⏰ Message will be generated when timer expires")
+        logger.info(f"   ⏰ Message will be generated shortly before the timer expires")
         
         return reminder_id
     
     def get_due_reminders(self):
-        """Get all reminders that are due now."""
+        """Get reminders that are due now, oldest first."""
         now = datetime.now()
         
-        # Query for due reminders
-        due_reminders = []
-        all_pending = self.mongo_db.find_many(
+        # Range query on the (status, reminder_time) index
+        due_reminders = self.mongo_db.find_many(
             "coke_reminders",
-            {"status": "pending"},
-            limit=100
+            {"status": "pending", "reminder_time": {"$lte": now}},
+            limit=self.batch_size,
+            sort=[("reminder_time", 1)]
         )
         
-        # Filter by time - parse ISO strings and compare datetime objects
-        for reminder in all_pending:
-            reminder_time_str = reminder.get("reminder_time", "")
-            if reminder_time_str:
-                try:
-                    from datetime import datetime as dt
-                    reminder_time = dt.fromisoformat(reminder_time_str)
-                    
-                    if reminder_time <= now:
-                        due_reminders.append(reminder)
-                        logger.info(f"  → Due: {reminder.get('task_description')} (scheduled for {reminder_time_str})")
-                    else:
-                        time_left = (reminder_time - now).total_seconds() / 60
-                        logger.debug(f"  → Not yet: {reminder.get('task_description')} ({time_left:.1f} min left)")
-                except Exception as e:
-                    logger.error(f"Error parsing reminder time {reminder_time_str}: {e}")
-        
-        logger.info(f"Found {len(due_reminders)} due reminders (checked {len(all_pending)} pending, current time: {now.isoformat()})")
+        for reminder in due_reminders:
+            logger.info(f"  → Due: {reminder.get('task_description')} (scheduled for {reminder.get('reminder_time')})")
+        
+        logger.info(f"Found {len(due_reminders)} due reminders (current time: {now.isoformat()})")
         return due_reminders
     
-    def mark_reminder_sent(self, reminder_id):
+    def claim_due_reminders(self, worker_id, lease_seconds=300, limit=None,
+                            shard_index=0, shard_count=1):
+        """
+        Atomically claim due reminders for one worker.
+        
+        A reminder is claimable when it is pending, or when another worker's
+        lease on it has expired (that worker crashed or stalled). Each claim is
+        a single find_one_and_update, so concurrent workers never claim the
+        same reminder while its lease is live.
+        
+        Args:
+            worker_id: Unique ID of the claiming worker
+            lease_seconds: How long the claim is held before it can be taken over
+            limit: Maximum number of reminders to claim (defaults to batch_size)
+            shard_index: Shard served by this worker
+            shard_count: Total number of shards (1 disables sharding)
+            
+        Returns:
+            List[Dict]: Claimed reminder documents, oldest first
+        """
+        if limit is None:
+            limit = self.batch_size
+        
+        now = datetime.now()
+        query = {
+            "reminder_time": {"$lte": now},
+            "$or": [
+                {"status": "pending"},
+                {"status": "claimed", "lease_expires_at": {"$lt": now}}
+            ],
+            **shard_query(shard_index, shard_count)
+        }
+        update = {
+            "$set": {
+                "status": "claimed",
+                "claimed_by": worker_id,
+                "claimed_at": now,
+                "lease_expires_at": now + timedelta(seconds=lease_seconds)
+            },
+            "$inc": {"claim_count": 1}
+        }
+        
+        claimed = []
+        while len(claimed) < limit:
+            reminder = self.mongo_db.find_one_and_update(
+                "coke_reminders", query, update,
+                sort=[("reminder_time", 1)]
+            )
+            if reminder is None:
+                break
+            if reminder.get("claim_count", 1) > 1:
+                logger.warning(f"♻️  Took over expired lease on reminder {reminder['_id']}")
+            claimed.append(reminder)
+        
+        if claimed:
+            logger.info(f"🔒 Worker {worker_id} claimed {len(claimed)} due reminder(s)")
+        return claimed
+    
+    def claim_reminder_for_pregeneration(self, worker_id, lead_seconds, lease_seconds=120,
+                                         shard_index=0, shard_count=1):
+        """
+        Claim the earliest pending reminder that is due within the lead window
+        and has no message yet, so its message can be generated ahead of time.
+        
+        Args:
+            worker_id: Unique ID of the claiming worker
+            lead_seconds: How far ahead of reminder_time messages are generated
+            lease_seconds: How long the generation claim is held
+            shard_index: Shard served by this worker
+            shard_count: Total number of shards (1 disables sharding)
+            
+        Returns:
+            Optional[Dict]: The claimed reminder, or None if nothing needs a message
+        """
+        now = datetime.now()
+        return self.mongo_db.find_one_and_update(
+            "coke_reminders",
+            {
+                "status": "pending",
+                "reminder_time": {"$lte": now + timedelta(seconds=lead_seconds)},
+                "message": {"$in": ["", None]},
+                "$or": [
+                    {"pregen_lease_expires_at": None},
+                    {"pregen_lease_expires_at": {"$lt": now}}
+                ],
+                **shard_query(shard_index, shard_count)
+            },
+            {
+                "$set": {
+                    "pregen_claimed_by": worker_id,
+                    "pregen_lease_expires_at": now + timedelta(seconds=lease_seconds)
+                }
+            },
+            sort=[("reminder_time", 1)]
+        )
+    
+    def save_pregenerated_message(self, reminder, message):
+        """
+        Store a message generated ahead of time on its reminder.
+        
+        The write only applies if the reminder is still pending and has not
+        been invalidated since it was claimed (message_version unchanged).
+        
+        Returns:
+            bool: Whether the message was stored
+        """
+        modified = self.mongo_db.update_one(
+            "coke_reminders",
+            {
+                "_id": reminder["_id"],
+                "status": "pending",
+                "message_version": reminder.get("message_version")
+            },
+            {
+                "$set": {"message": message, "message_generated_at": datetime.now()},
+                "$unset": {"pregen_lease_expires_at": ""}
+            }
+        )
+        if not modified:
+            logger.info(f"🗑️  Discarded pre-generated message for {reminder['_id']} (reminder changed meanwhile)")
+        return modified > 0
+    
+    def invalidate_pregenerated_messages(self, user_id):
+        """
+        Drop messages generated ahead of time for a user's pending reminders,
+        e.g. because the user has chatted since and the context changed.
+        
+        Returns:
+            int: Number of reminders invalidated
+        """
+        modified = self.mongo_db.update_many(
+            "coke_reminders",
+            {
+                "user_id": user_id,
+                "status": "pending",
+                "$or": [
+                    {"message": {"$nin": ["", None]}},
+                    {"pregen_lease_expires_at": {"$ne": None}}
+                ]
+            },
+            {
+                "$set": {"message": ""},
+                "$unset": {"message_generated_at": "", "pregen_lease_expires_at": ""},
+                "$inc": {"message_version": 1}
+            }
+        )
+        if modified:
+            logger.info(f"♻️  Invalidated {modified} pre-generated reminder message(s) for {user_id}")
+        return modified
+    
+    def get_next_reminder_time(self, shard_index=0, shard_count=1):
+        """Get the reminder_time of the earliest pending reminder, or None."""
+        reminders = self.mongo_db.find_many(
+            "coke_reminders",
+            {"status": "pending", **shard_query(shard_index, shard_count)},
+            limit=1,
+            sort=[("reminder_time", 1)]
+        )
+        return reminders[0].get("reminder_time") if reminders else None
+    
+    def mark_reminder_sent(self, reminder_id, worker_id=None):
         """Mark a reminder as sent."""
-        self.mongo_db.update_one(
+        return self.mark_reminders_sent([reminder_id], worker_id)
+    
+    def mark_reminders_sent(self, reminder_ids, worker_id=None):
+        """
+        Mark a batch of reminders as sent in a single update.
+        
+        When worker_id is given, only reminders still claimed by that worker
+        are marked, so a worker whose lease was taken over does not overwrite
+        the new owner's state.
+        """
+        if not reminder_ids:
+            return 0
+        
+        query = {"_id": {"$in": list(reminder_ids)}}
+        if worker_id:
+            query.update({"status": "claimed", "claimed_by": worker_id})
+        else:
+            query["status"] = {"$in": ["pending", "claimed"]}
+        
+        modified = self.mongo_db.update_many(
             "coke_reminders",
-            {"_id": reminder_id},
-            {"$set": {"status": "sent", "sent_at": datetime.now().isoformat()}}
+            query,
+            {
+                "$set": {"status": "sent", "sent_at": datetime.now()},
+                "$unset": {"lease_expires_at": ""}
+            }
         )
-        logger.info(f"✅ Marked reminder {reminder_id} as sent")
+        if modified < len(reminder_ids):
+            logger.warning(f"⚠️  {len(reminder_ids) - modified} reminder(s) were no longer claimed by this worker")
+        logger.info(f"✅ Marked {modified} reminder(s) as sent")
+        return modified
     
     def get_pending_reminders(self, user_id):
         """Get all pending reminders for a user."""
@@ -87,8 +365,8 @@ class ReminderScheduler:
             "coke_reminders",
             {
                 "user_id": user_id,
-                "status": "pending"
-            }
+                "status": {"$in": ["pending", "claimed"]}
+            },
+            sort=[("reminder_time", 1)]
         )
         return reminders
-
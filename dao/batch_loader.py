@@ -0,0 +1,122 @@
+"""
+Batch Loader
+按请求作用域合并按ID读取：同一请求（或同一轮处理）中先登记要读取的ID，
+第一次取结果时用一次$in查询读回所有登记的ID，结果缓存到请求结束，避免N+1查询。
+一个请求创建一个loader，不跨请求、不跨线程共享
+"""
+import logging
+from logging import getLogger
+logging.basicConfig(level=logging.INFO)
+logger = getLogger(__name__)
+
+import sys
+sys.path.append(".")
+
+from typing import Callable, Dict, Hashable, Iterable, List, Optional
+from pymongo.collection import Collection
+from bson import ObjectId
+
+
+def find_by_ids(collection: Collection, ids: List[str], projection: Dict = None) -> List[Optional[Dict]]:
+    """
+    一次$in查询读取一组文档，结果与ids顺序一致，不存在或ID无效的为None
+    """
+    object_ids = {}
+    for doc_id in ids:
+        if not doc_id:
+            continue
+        try:
+            object_ids[doc_id] = ObjectId(doc_id)
+        except Exception:
+            continue
+    if not object_ids:
+        return [None] * len(ids)
+    
+    # 投影中必须带回_id才能把结果对应到ID
+    if projection:
+        projection = dict(projection, _id=1)
+    found = collection.find({"_id": {"$in": list(set(object_ids.values()))}}, projection)
+    by_id = {doc["_id"]: doc for doc in found}
+    return [by_id.get(object_ids.get(doc_id)) for doc_id in ids]
+
+
+class PendingLoad:
+    """已登记、尚未读取的一个ID；result()时与其他已登记的ID一起批量读取"""
+
+    def __init__(self, loader: "BatchLoader", key: Hashable):
+        self.loader = loader
+        self.key = key
+
+    def result(self) -> Optional[Dict]:
+        return self.loader.load(self.key)
+
+
+class BatchLoader:
+    """
+    DataLoader式批量加载器
+    batch_fn接收ID列表，返回与之一一对应的结果列表（不存在的为None），
+    如 UserDAO.get_users_by_ids、ConversationDAO.get_conversations_by_ids
+    """
+
+    def __init__(self, batch_fn: Callable[[List[Hashable]], List[Optional[Dict]]],
+                 max_batch_size: int = 1000):
+        """
+        Args:
+            batch_fn: 批量读取函数
+            max_batch_size: 一次查询最多的ID数，超过时分多次查询
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self._cache: Dict[Hashable, Optional[Dict]] = {}
+        self._queue: Dict[Hashable, None] = {}  # 有序去重的待读取ID
+        self.stats = {"loads": 0, "cache_hits": 0, "queries": 0, "fetched": 0}
+
+    def defer(self, key: Hashable) -> PendingLoad:
+        """登记一个ID，推迟到第一次取结果时与其他已登记的ID一起读取"""
+        if key not in self._cache:
+            self._queue[key] = None
+        return PendingLoad(self, key)
+
+    def defer_many(self, keys: Iterable[Hashable]) -> List[PendingLoad]:
+        """登记多个ID"""
+        return [self.defer(key) for key in keys]
+
+    def load(self, key: Hashable) -> Optional[Dict]:
+        """读取一个ID，连同所有已登记的ID一次查询"""
+        return self.load_many([key])[0]
+
+    def load_many(self, keys: Iterable[Hashable]) -> List[Optional[Dict]]:
+        """读取多个ID，结果与keys顺序一致；已缓存的不再查询"""
+        keys = list(keys)
+        self.stats["loads"] += len(keys)
+        self.stats["cache_hits"] += sum(1 for key in keys if key in self._cache)
+        for key in keys:
+            if key not in self._cache:
+                self._queue[key] = None
+        self.dispatch()
+        return [self._cache.get(key) for key in keys]
+
+    def dispatch(self) -> None:
+        """读取所有已登记的ID"""
+        while self._queue:
+            batch = list(self._queue)[:self.max_batch_size]
+            for key in batch:
+                del self._queue[key]
+            results = self.batch_fn(batch)
+            if len(results) != len(batch):
+                raise ValueError(f"batch_fn returned {len(results)} results for {len(batch)} keys")
+            self._cache.update(zip(batch, results))
+            self.stats["queries"] += 1
+            self.stats["fetched"] += len(batch)
+
+    def prime(self, key: Hashable, value: Optional[Dict]) -> None:
+        """放入已经拿到的文档（如刚创建或通过其他查询读到的），后续读取不再查询"""
+        self._queue.pop(key, None)
+        self._cache[key] = value
+
+    def clear(self, key: Hashable = None) -> None:
+        """清除一个ID的缓存（写操作之后调用），不传key时清空全部"""
+        if key is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(key, None)
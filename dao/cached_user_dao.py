@@ -0,0 +1,315 @@
+"""
+Cached User DAO
+带读穿透缓存的UserDAO：按ID和按平台ID读取用户时先查进程内LRU缓存，
+未命中才查询MongoDB并写入缓存。条目有TTL，查不到的用户也缓存（较短的TTL），
+本DAO的所有写操作（包括create_indexes中的重复账号处理）会使相关条目失效。其他进程的写入最多在TTL之后可见
+"""
+import copy
+import time
+import threading
+import logging
+from logging import getLogger
+logging.basicConfig(level=logging.INFO)
+logger = getLogger(__name__)
+
+import sys
+sys.path.append(".")
+
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from dao.user_dao import UserDAO
+
+_MISS = object()
+
+
+def platform_keys(data: Dict) -> List[Tuple[str, str, str]]:
+    """
+    从用户文档、更新内容或查询条件中取出平台ID对应的缓存键，
+    支持 {"platforms": {"wechat": {"id": ...}}}、{"platforms.wechat": {"id": ...}}、{"platforms.wechat.id": ...}
+    """
+    keys = []
+    if not data:
+        return keys
+    for field, value in data.items():
+        parts = field.split(".")
+        if parts[0] != "platforms":
+            continue
+        if len(parts) == 1 and isinstance(value, dict):
+            for platform, platform_data in value.items():
+                if isinstance(platform_data, dict) and platform_data.get("id"):
+                    keys.append(("platform", platform, platform_data["id"]))
+        elif len(parts) == 2 and isinstance(value, dict) and value.get("id"):
+            keys.append(("platform", parts[1], value["id"]))
+        elif len(parts) == 3 and parts[2] == "id" and isinstance(value, str):
+            keys.append(("platform", parts[1], value))
+    return keys
+
+
+class CachedUserDAO(UserDAO):
+    """
+    UserDAO加读穿透缓存：get_user_by_id、get_user_by_platform、get_users_by_ids走缓存，
+    稳定状态下收到平台消息时解析用户身份不访问数据库。
+    带projection的读取不走缓存（缓存只存整个文档）；返回的文档是副本，可以随意修改
+    """
+
+    def __init__(self, *args, max_entries: int = 10000, ttl: float = 300.0,
+                 negative_ttl: float = 30.0, **kwargs):
+        """
+        初始化CachedUserDAO
+
+        Args:
+            *args, **kwargs: 传给UserDAO
+            max_entries: 缓存条目上限，超过时淘汰最久未使用的
+            ttl: 用户文档的缓存时间（秒）
+            negative_ttl: "用户不存在"结果的缓存时间（秒）
+        """
+        super().__init__(*args, **kwargs)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # 键 -> (过期时间, 文档或None, 文档所属用户ID)
+        self._entries: "OrderedDict[Tuple, Tuple[float, Optional[Dict], Optional[str]]]" = OrderedDict()
+        # 用户ID -> 指向该用户的缓存键，失效时一起删除
+        self._keys_by_user: Dict[str, set] = {}
+        self._lock = threading.Lock()
+        # 每次失效加一；查询期间发生过失效则不写入查询结果，避免把旧数据放回缓存
+        self._generation = 0
+        self.stats = {"hits": 0, "negative_hits": 0, "misses": 0, "expired": 0,
+                      "evictions": 0, "invalidations": 0}
+
+    def get_user_by_id(self, user_id: str, projection: Dict = None) -> Optional[Dict]:
+        """通过ID获取用户，先查缓存"""
+        if projection is not None or not user_id:
+            return super().get_user_by_id(user_id, projection)
+
+        key = ("id", str(user_id))
+        cached = self._lookup(key)
+        if cached is not _MISS:
+            return cached
+
+        generation = self._generation
+        user = super().get_user_by_id(user_id)
+        self._store(generation, key, user)
+        return copy.deepcopy(user)
+
+    def get_user_by_platform(self, platform: str, platform_id: str, projection: Dict = None) -> Optional[Dict]:
+        """通过平台和平台ID获取用户，先查缓存"""
+        if projection is not None or not platform or not platform_id:
+            return super().get_user_by_platform(platform, platform_id, projection)
+
+        key = ("platform", platform, platform_id)
+        cached = self._lookup(key)
+        if cached is not _MISS:
+            return cached
+
+        generation = self._generation
+        user = super().get_user_by_platform(platform, platform_id)
+        self._store(generation, key, user)
+        return copy.deepcopy(user)
+
+    def get_users_by_ids(self, user_ids: List[str], projection: Dict = None) -> List[Optional[Dict]]:
+        """通过ID批量获取用户，只查询缓存中没有的ID"""
+        if projection is not None:
+            return super().get_users_by_ids(user_ids, projection)
+
+        found = {}
+        for user_id in dict.fromkeys(user_ids):
+            if user_id:
+                cached = self._lookup(("id", str(user_id)))
+                if cached is not _MISS:
+                    found[user_id] = cached
+
+        missing = [user_id for user_id in dict.fromkeys(user_ids) if user_id and user_id not in found]
+        if missing:
+            generation = self._generation
+            for user_id, user in zip(missing, super().get_users_by_ids(missing)):
+                self._store(generation, ("id", str(user_id)), user)
+                found[user_id] = user
+
+        return [copy.deepcopy(found.get(user_id)) for user_id in user_ids]
+
+    # 写操作：先写数据库，再使相关缓存失效（写失败也失效）
+
+    def create_user(self, user_data: Dict) -> str:
+        """创建用户，删除其平台ID的"不存在"缓存"""
+        try:
+            return super().create_user(user_data)
+        finally:
+            self.invalidate(user_data.get("_id"), platform_keys(user_data))
+
+    def update_user(self, user_id: str, update_data: Dict) -> bool:
+        """更新用户信息并使缓存失效"""
+        try:
+            return super().update_user(user_id, update_data)
+        finally:
+            self.invalidate(user_id, platform_keys(update_data))
+
+    def update_platform_info(self, user_id: str, platform: str,
+                            platform_data: Dict) -> bool:
+        """更新用户平台信息并使缓存失效"""
+        try:
+            return super().update_platform_info(user_id, platform, platform_data)
+        finally:
+            self.invalidate(user_id, platform_keys({f"platforms.{platform}": platform_data}))
+
+    def delete_user(self, user_id: str) -> bool:
+        """删除用户并使缓存失效"""
+        try:
+            return super().delete_user(user_id)
+        finally:
+            self.invalidate(user_id)
+
+    def change_status(self, user_id: str, status: str) -> bool:
+        """更改用户状态并使缓存失效"""
+        try:
+            return super().change_status(user_id, status)
+        finally:
+            self.invalidate(user_id)
+
+    def bulk_update_users(self, query: Dict, update: Dict) -> int:
+        """批量更新用户；无法知道更新了哪些用户，清空缓存"""
+        try:
+            return super().bulk_update_users(query, update)
+        finally:
+            self.clear_cache()
+
+    def upsert_user(self, query: Dict, user_data: Dict) -> str:
+        """插入或更新用户并使缓存失效"""
+        user_id = None
+        try:
+            user_id = super().upsert_user(query, user_data)
+            return user_id
+        finally:
+            self.invalidate(user_id, platform_keys(query) + platform_keys(user_data))
+
+    def add_platform_to_user(self, user_id: str, platform: str,
+                            platform_data: Dict) -> bool:
+        """为用户添加平台信息并使缓存失效"""
+        try:
+            return super().add_platform_to_user(user_id, platform, platform_data)
+        finally:
+            self.invalidate(user_id, platform_keys({f"platforms.{platform}": platform_data}))
+
+    def remove_platform_from_user(self, user_id: str, platform: str) -> bool:
+        """从用户删除平台信息并使缓存失效"""
+        try:
+            return super().remove_platform_from_user(user_id, platform)
+        finally:
+            self.invalidate(user_id)
+
+    def dedupe_platform_users(self, platform: str) -> int:
+        """处理重复的平台账号（create_indexes也会调用）；被去掉平台信息的用户不确定，清空缓存"""
+        try:
+            return super().dedupe_platform_users(platform)
+        finally:
+            self.clear_cache()
+
+    # 缓存管理
+
+    def invalidate(self, user_id: str = None, keys: Iterable[Tuple] = ()) -> None:
+        """
+        使一个用户的所有缓存条目（按ID和按各平台ID）以及指定的键失效
+
+        Args:
+            user_id: 用户ID
+            keys: 其他要删除的缓存键，如新增平台ID之前缓存的"不存在"结果
+        """
+        with self._lock:
+            self._generation += 1
+            self.stats["invalidations"] += 1
+            if user_id:
+                user_id = str(user_id)
+                self._remove(("id", user_id))
+                for key in list(self._keys_by_user.get(user_id, ())):
+                    self._remove(key)
+            for key in keys:
+                self._remove(key)
+
+    def clear_cache(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._generation += 1
+            self.stats["invalidations"] += 1
+            self._entries.clear()
+            self._keys_by_user.clear()
+
+    def hit_ratio(self) -> float:
+        """命中率（包括"不存在"结果的命中）"""
+        hits = self.stats["hits"] + self.stats["negative_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def cache_stats(self) -> Dict:
+        """缓存统计：命中、未命中、过期、淘汰、失效次数，当前条目数和命中率"""
+        with self._lock:
+            stats = dict(self.stats, size=len(self._entries))
+        stats["hit_ratio"] = self.hit_ratio()
+        return stats
+
+    def _lookup(self, key: Tuple):
+        """查缓存，命中时返回文档副本（不存在的用户为None），未命中返回_MISS"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return _MISS
+            expires_at, user, _ = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return _MISS
+            self._entries.move_to_end(key)
+            if user is None:
+                self.stats["negative_hits"] += 1
+                return None
+            self.stats["hits"] += 1
+        return copy.deepcopy(user)
+
+    def _store(self, generation: int, key: Tuple, user: Optional[Dict]) -> None:
+        """写入查询结果；找到用户时同时写入按ID和按各平台ID的键"""
+        with self._lock:
+            if generation != self._generation:
+                return
+            if user is None:
+                self._put(key, None, None, self.negative_ttl)
+                return
+            user_id = str(user["_id"])
+            keys = [key, ("id", user_id)] + platform_keys({"platforms": user.get("platforms")})
+            for cache_key in dict.fromkeys(keys):
+                self._put(cache_key, user, user_id, self.ttl)
+
+    def _put(self, key: Tuple, user: Optional[Dict], user_id: Optional[str], ttl: float) -> None:
+        """写入一个条目并淘汰超出上限的条目（调用方持有锁）"""
+        self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, user, user_id)
+        if user_id is not None:
+            self._keys_by_user.setdefault(user_id, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.stats["evictions"] += 1
+
+    def _remove(self, key: Tuple) -> None:
+        """删除一个条目（调用方持有锁）"""
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[2] is None:
+            return
+        keys = self._keys_by_user.get(entry[2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[entry[2]]
+
+
+# 使用示例
+if __name__ == "__main__":
+    user_model = CachedUserDAO(ttl=600, negative_ttl=60)
+
+    # 同一平台用户的消息：第一次查询数据库，之后从缓存返回
+    for _ in range(100):
+        user_model.get_user_by_platform("wechat", "wx123456")
+    print(user_model.cache_stats())
+
+    user_model.close()
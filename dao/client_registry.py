@@ -0,0 +1,165 @@
+"""
+MongoClient Registry
+进程内共享的MongoClient：同一URI和连接参数只创建一个客户端（一个连接池、一组监控线程），
+所有DAO共用。客户端以connect=False创建，第一次操作时才真正连接；
+fork之后子进程丢弃继承来的客户端，重新创建。
+"""
+import os
+import threading
+import logging
+from logging import getLogger
+logging.basicConfig(level=logging.INFO)
+logger = getLogger(__name__)
+
+import sys
+sys.path.append(".")
+
+from typing import Any, Dict, Iterator, List, Tuple
+from pymongo import MongoClient
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+from conf.config import CONF
+
+# 连接池默认参数，可在config.json的 mongodb.client_options 中覆盖
+DEFAULT_CLIENT_OPTIONS = {
+    "maxPoolSize": 100,
+    "minPoolSize": 0,
+    "maxIdleTimeMS": 300000,
+    "connectTimeoutMS": 5000,
+    "serverSelectionTimeoutMS": 5000,
+}
+
+# 懒解码读取：文档保持为原始BSON字节，首次访问字段时才解码（嵌套文档仍保持原始字节）
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+_clients: Dict[Tuple[str, Tuple], MongoClient] = {}
+_clients_lock = threading.Lock()
+
+
+def client_options(**overrides) -> Dict[str, Any]:
+    """合并默认参数、配置文件参数和调用方参数"""
+    options = dict(DEFAULT_CLIENT_OPTIONS)
+    options.update(CONF["mongodb"].get("client_options", {}))
+    options.update(overrides)
+    return options
+
+
+def get_client(uri: str, **overrides) -> MongoClient:
+    """
+    获取URI对应的共享客户端，不存在时创建（不立即连接）
+    overrides: MongoClient参数，如 maxPoolSize、minPoolSize、socketTimeoutMS；参数不同的调用方各用一个客户端
+    """
+    options = client_options(**overrides)
+    key = (uri, tuple(sorted(options.items())))
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = MongoClient(uri, connect=False, **options)
+            _clients[key] = client
+            logger.info(f"Created shared MongoClient for {uri} (maxPoolSize={options.get('maxPoolSize')})")
+    return client
+
+
+class SharedClientMixin:
+    """
+    DAO基类：client/db属性从注册表取共享客户端。
+    构造DAO不创建连接；fork之后首次访问时换成子进程自己的客户端
+    """
+
+    def _init_client(self, uri: str, db_name: str, options: Dict[str, Any] = None) -> None:
+        self.mongo_uri = uri
+        self.db_name = db_name
+        self.client_options = options or {}
+        self._client = None
+        self._client_pid = None
+
+    @property
+    def client(self) -> MongoClient:
+        pid = os.getpid()
+        if self._client is None or self._client_pid != pid:
+            self._client = get_client(self.mongo_uri, **self.client_options)
+            self._client_pid = pid
+        return self._client
+
+    @property
+    def db(self):
+        return self.client[self.db_name]
+
+    @staticmethod
+    def _iter_cursor(cursor, batch_size: int = 1000) -> Iterator[Dict]:
+        """
+        逐条产出游标中的文档，每次从服务器取batch_size条，内存占用与结果总数无关
+        调用方提前停止迭代时关闭服务器端游标
+        """
+        cursor.batch_size(batch_size)
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _ensure_index(collection, keys: List[Tuple[str, int]], **options) -> str:
+        """
+        创建索引；同名索引已存在但选项不同时（如旧版本在同一字段上建的非唯一索引）先删除再创建，
+        否则create_index会报IndexOptionsConflict
+        """
+        name = options.get("name") or "_".join(f"{field}_{direction}" for field, direction in keys)
+        existing = collection.index_information().get(name)
+        if existing is not None and any(existing.get(option) != value
+                                        for option, value in options.items() if option != "name"):
+            logger.warning(f"Rebuilding index {collection.name}.{name}: options changed to {options}")
+            collection.drop_index(name)
+        return collection.create_index(keys, **options)
+
+    @staticmethod
+    def _duplicate_groups(collection, group_key: Dict[str, str], match: Dict) -> Iterator[List[Any]]:
+        """
+        按group_key分组，产出有重复的组中各文档的_id（从早到晚），用于建唯一索引之前清理重复数据
+        """
+        pipeline = [
+            {"$match": match},
+            {"$sort": {"_id": 1}},
+            {"$group": {"_id": group_key, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ]
+        for group in collection.aggregate(pipeline, allowDiskUse=True):
+            yield group["ids"]
+
+    def _read_collection(self, collection_name: str, raw: bool = False):
+        """读取用的集合；raw为True时文档为只读的RawBSONDocument"""
+        if raw:
+            return self.db.get_collection(collection_name, codec_options=RAW_CODEC_OPTIONS)
+        return self.db[collection_name]
+
+
+def client_count() -> int:
+    """当前进程中的共享客户端数"""
+    return len(_clients)
+
+
+def close_all_clients() -> None:
+    """关闭所有共享客户端，在进程退出时调用"""
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+
+def _reset_after_fork() -> None:
+    """
+    子进程中丢弃从父进程继承的客户端（其连接和监控线程不能跨fork使用），
+    下次get_client时重新创建。不调用close，避免影响父进程的连接
+    """
+    global _clients_lock
+    _clients_lock = threading.Lock()
+    _clients.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -10,33 +10,80 @@ logger = getLogger(__name__)
 import sys
 sys.path.append(".")
 
-from pymongo import MongoClient
+from pymongo import UpdateOne, ReturnDocument
 from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from pymongo.cursor import Cursor
-from typing import Dict, List, Optional, Union, Any, Tuple
+from typing import Dict, List, Optional, Union, Any, Tuple, Iterator
+from datetime import datetime
 from bson import ObjectId
 
 from conf.config import CONF
+from dao.client_registry import SharedClientMixin
+from dao.batch_loader import BatchLoader, find_by_ids
 
 
-class ConversationDAO():
+# 决定会话是否为单聊及其参与者对键的字段，改动它们时需要重新计算private_key
+PRIVATE_KEY_FIELDS = ("platform", "chatroom_name", "talkers")
+
+# 已完成的迁移记录在migrations集合中，private_key补写完成后单聊查询不再查找没有键的旧会话
+MIGRATION_COLLECTION = "migrations"
+PRIVATE_KEY_MIGRATION = "conversations.private_key"
+# 迁移尚未完成时，每隔这么多秒重新检查一次迁移记录
+LEGACY_LOOKUP_RECHECK_SECONDS = 60
+
+
+def private_pair_key(platform: str, user_id1: str, user_id2: str) -> str:
+    """
+    单聊的参与者对键：platform|较小ID|较大ID，与两个用户的先后顺序无关
+    各部分中的 % 和 | 先转义，避免ID中含分隔符时不同的对得到相同的键
+    """
+    def escape(part: str) -> str:
+        return str(part).replace("%", "%25").replace("|", "%7C")
+    low, high = sorted([str(user_id1), str(user_id2)])
+    return "|".join([escape(platform), escape(low), escape(high)])
+
+
+def conversation_private_key(conversation: Dict) -> Optional[str]:
+    """会话是单聊（非群聊且恰好两个参与者）时返回参与者对键，否则返回None"""
+    talkers = conversation.get("talkers") or []
+    if conversation.get("chatroom_name") is not None or len(talkers) != 2:
+        return None
+    if not conversation.get("platform") or not all(talker.get("id") for talker in talkers):
+        return None
+    return private_pair_key(conversation["platform"], talkers[0]["id"], talkers[1]["id"])
+
+
+class ConversationDAO(SharedClientMixin):
     """会话模型类，提供conversations集合的增删改查操作"""
     
     def __init__(self, mongo_uri: str = "mongodb://" + CONF["mongodb"]["mongodb_ip"] + ":" + CONF["mongodb"]["mongodb_port"] + "/", 
-                 db_name: str = CONF["mongodb"]["mongodb_name"]):
+                 db_name: str = CONF["mongodb"]["mongodb_name"], client_options: Dict[str, Any] = None,
+                 legacy_private_lookup: Optional[bool] = None):
         """
         初始化Conversation类
         
         Args:
             mongo_uri: MongoDB连接URI
             db_name: 数据库名称
+            client_options: MongoClient参数（如 maxPoolSize），同URI同参数的DAO共用一个客户端
+            legacy_private_lookup: 单聊查询未命中private_key时是否再查找没有键的旧单聊；
+                None表示在migrate()完成之前查找，之后不再查找
         """
-        self.client = MongoClient(mongo_uri)
-        self.db = self.client[db_name]
-        self.collection: Collection = self.db.conversations
+        self._init_client(mongo_uri, db_name, client_options)
+        self.legacy_private_lookup = legacy_private_lookup
+        self._legacy_checked_at = None
+    
+    @property
+    def collection(self) -> Collection:
+        """conversations集合"""
+        return self.db.conversations
     
     def create_indexes(self):
-        """创建必要的索引"""
+        """
+        创建必要的索引
+        唯一索引建立之前并发创建的重复会话会使建索引失败，先用 migrate(dedupe=True) 处理
+        """
         # 为平台创建索引
         self.collection.create_index([("platform", 1)])
         
@@ -46,12 +93,158 @@ class ConversationDAO():
         # 为talkers.id创建索引，支持按参与者查询
         self.collection.create_index([("talkers.id", 1)])
         
-        # 创建组合索引，优化单聊查询
+        # 创建组合索引，优化按参与者查询
         self.collection.create_index([
             ("platform", 1),
             ("chatroom_name", 1),
             ("talkers.id", 1)
         ])
+        
+        # 单聊参与者对键的唯一索引：单聊查询是一次索引点查，同一对用户只能有一个单聊
+        # 部分索引只包含有private_key的文档（群聊和标记为duplicate_of的重复会话没有该字段）
+        self._ensure_index(
+            self.collection,
+            [("private_key", 1)],
+            unique=True,
+            partialFilterExpression={"private_key": {"$type": "string"}}
+        )
+        
+        # 同一平台下群聊名称唯一，get_or_create_group_conversation的upsert依赖它避免并发时重复创建
+        self._ensure_index(
+            self.collection,
+            [("platform", 1), ("chatroom_name", 1)],
+            unique=True,
+            partialFilterExpression={"chatroom_name": {"$type": "string"}}
+        )
+    
+    def dedupe_conversations(self) -> int:
+        """
+        处理重复会话（唯一索引建立之前的并发创建，只通过 migrate(dedupe=True) 显式运行）：
+        同一private_key的单聊、同一(platform, chatroom_name)的群聊各保留最早创建的一个，
+        其他会话的参与者和conversation_info中保留会话没有的项合并进来；
+        其他会话去掉唯一键字段并记录duplicate_of，文档本身保留（与UserDAO.dedupe_platform_users相同）
+        
+        Returns:
+            int: 标记为重复的会话数量
+        """
+        detached = 0
+        duplicate_keys = [
+            ("private_key", {"private_key": "$private_key"}, {"private_key": {"$type": "string"}}),
+            ("chatroom_name", {"platform": "$platform", "chatroom_name": "$chatroom_name"},
+             {"chatroom_name": {"$type": "string"}}),
+        ]
+        for key_field, group_key, match in duplicate_keys:
+            for ids in self._duplicate_groups(self.collection, group_key, match):
+                detached += self._merge_duplicates(ids, key_field)
+        return detached
+    
+    def _merge_duplicates(self, ids: List[ObjectId], key_field: str) -> int:
+        """把ids[1:]的参与者和会话信息合并进ids[0]，ids[1:]去掉key_field并记录duplicate_of，返回标记数量"""
+        conversations = {conversation["_id"]: conversation for conversation in self.collection.find({"_id": {"$in": ids}})}
+        keep = conversations.get(ids[0])
+        duplicates = [conversations[object_id] for object_id in ids[1:] if object_id in conversations]
+        if keep is None or not duplicates:
+            return 0
+        
+        talkers = {talker.get("id"): talker for talker in keep.get("talkers") or []}
+        info = dict(keep.get("conversation_info") or {})
+        for duplicate in duplicates:
+            for talker in duplicate.get("talkers") or []:
+                talkers.setdefault(talker.get("id"), talker)
+            for field, value in (duplicate.get("conversation_info") or {}).items():
+                info.setdefault(field, value)
+        
+        self.collection.update_one(
+            {"_id": keep["_id"]},
+            {"$set": {"talkers": list(talkers.values()), "conversation_info": info}}
+        )
+        duplicate_ids = [duplicate["_id"] for duplicate in duplicates]
+        result = self.collection.update_many(
+            {"_id": {"$in": duplicate_ids}},
+            {"$unset": {key_field: ""}, "$set": {"duplicate_of": keep["_id"]}}
+        )
+        logger.warning(f"Duplicate conversations {duplicate_ids} merged into {keep['_id']} and detached")
+        return result.modified_count
+    
+    def migrate(self, dedupe: bool = False, batch_size: int = 1000) -> int:
+        """
+        一次性迁移（部署新版本时运行，见dao/migrate.py）：建索引，为旧单聊补写private_key，
+        然后记录迁移完成，此后单聊查询只走private_key上的点查
+        
+        Args:
+            dedupe: 建索引之前先处理重复会话（见dedupe_conversations），有重复时不开启则建索引失败
+            batch_size: 补写时每批的会话数
+        
+        Returns:
+            int: 补写的会话数量
+        """
+        if dedupe:
+            self.dedupe_conversations()
+        self.create_indexes()
+        backfilled = self.backfill_private_keys(batch_size)
+        self.db[MIGRATION_COLLECTION].update_one(
+            {"_id": PRIVATE_KEY_MIGRATION},
+            {"$set": {"completed_at": datetime.now(), "backfilled": backfilled}},
+            upsert=True
+        )
+        self.legacy_private_lookup = False
+        return backfilled
+    
+    def _legacy_lookup_enabled(self) -> bool:
+        """是否还需要查找没有private_key的旧单聊：迁移记录存在后不再查找（未完成时定期重新检查）"""
+        if self.legacy_private_lookup is not None:
+            return self.legacy_private_lookup
+        now = time.monotonic()
+        if self._legacy_checked_at is not None and now - self._legacy_checked_at < LEGACY_LOOKUP_RECHECK_SECONDS:
+            return True
+        self._legacy_checked_at = now
+        if self.db[MIGRATION_COLLECTION].find_one({"_id": PRIVATE_KEY_MIGRATION}, {"_id": 1}) is not None:
+            self.legacy_private_lookup = False
+            return False
+        return True
+    
+    def backfill_private_keys(self, batch_size: int = 1000) -> int:
+        """
+        为创建于private_key之前的单聊补写参与者对键（在create_indexes之后调用，通常经由migrate）
+        同一对用户已有多个单聊时，只有先写入的一个得到键，其余记录警告后跳过
+        
+        Returns:
+            int: 补写的会话数量
+        """
+        query = {"chatroom_name": None, "talkers": {"$size": 2}, "private_key": {"$exists": False},
+                 "duplicate_of": {"$exists": False}}
+        projection = {"platform": 1, "chatroom_name": 1, "talkers.id": 1}
+        
+        backfilled = 0
+        ops = []
+        for conversation in self._iter_cursor(self.collection.find(query, projection).sort("_id", 1), batch_size):
+            key = conversation_private_key(conversation)
+            if key is None:
+                continue
+            ops.append(UpdateOne({"_id": conversation["_id"]}, {"$set": {"private_key": key}}))
+            if len(ops) >= batch_size:
+                backfilled += self._write_private_keys(ops)
+                ops = []
+        if ops:
+            backfilled += self._write_private_keys(ops)
+        
+        if backfilled:
+            logger.info(f"Backfilled private_key on {backfilled} conversation(s)")
+        return backfilled
+    
+    def _write_private_keys(self, ops: List[UpdateOne]) -> int:
+        """执行一批private_key写入，重复的参与者对跳过"""
+        written = 0
+        while ops:
+            try:
+                return written + self.collection.bulk_write(ops, ordered=True).modified_count
+            except BulkWriteError as e:
+                # 按顺序执行在第一个重复键处停止，跳过它后继续写剩下的
+                written += e.details.get("nModified", 0)
+                failed = e.details["writeErrors"][0]
+                logger.warning(f"Duplicate private conversation skipped: {failed.get('op')}")
+                ops = ops[failed["index"] + 1:]
+        return written
     
     def create_conversation(self, conversation_data: Dict) -> str:
         """
@@ -65,16 +258,22 @@ class ConversationDAO():
         """
         if "_id" in conversation_data and isinstance(conversation_data["_id"], str):
             conversation_data["_id"] = ObjectId(conversation_data["_id"])
+        
+        # 单聊写入参与者对键，供get_private_conversation索引查询
+        private_key = conversation_private_key(conversation_data)
+        if private_key is not None:
+            conversation_data.setdefault("private_key", private_key)
             
         result = self.collection.insert_one(conversation_data)
         return str(result.inserted_id)
     
-    def get_conversation_by_id(self, conversation_id: str) -> Optional[Dict]:
+    def get_conversation_by_id(self, conversation_id: str, projection: Dict = None) -> Optional[Dict]:
         """
         通过ID获取会话
         
         Args:
             conversation_id: 会话ID
+            projection: 返回字段，None表示整个文档
             
         Returns:
             Optional[Dict]: 会话数据或None
@@ -87,7 +286,31 @@ class ConversationDAO():
         except:
             return None
             
-        return self.collection.find_one({"_id": object_id})
+        return self.collection.find_one({"_id": object_id}, projection)
+    
+    def get_conversations_by_ids(self, conversation_ids: List[str], projection: Dict = None) -> List[Optional[Dict]]:
+        """
+        通过ID批量获取会话，一次$in查询
+        
+        Args:
+            conversation_ids: 会话ID列表
+            projection: 返回字段，None表示整个文档
+            
+        Returns:
+            List[Optional[Dict]]: 与conversation_ids顺序一致的会话数据，不存在或ID无效的为None
+        """
+        return find_by_ids(self.collection, conversation_ids, projection)
+    
+    def conversation_loader(self, projection: Dict = None, max_batch_size: int = 1000) -> BatchLoader:
+        """
+        创建请求作用域的会话批量加载器
+        
+        Args:
+            projection: 返回字段，None表示整个文档
+            max_batch_size: 一次查询最多的ID数
+        """
+        return BatchLoader(lambda conversation_ids: self.get_conversations_by_ids(conversation_ids, projection),
+                           max_batch_size)
     
     def get_private_conversation(self, platform: str, user_id1: str, user_id2: str) -> Optional[Dict]:
         """
@@ -104,16 +327,39 @@ class ConversationDAO():
         if not platform or not user_id1 or not user_id2:
             return None
         
-        # 构建查询条件：平台匹配，不是群聊，且两个用户都在talkers中
-        query = {
+        # 参与者对键上有唯一索引，一次索引点查；迁移完成之前，没有键的旧单聊按参与者查找并补写键
+        conversation = self.collection.find_one({"private_key": private_pair_key(platform, user_id1, user_id2)})
+        if conversation is None and self._legacy_lookup_enabled():
+            conversation = self._claim_legacy_private_conversation(platform, user_id1, user_id2)
+        return conversation
+    
+    def _claim_legacy_private_conversation(self, platform: str, user_id1: str, user_id2: str) -> Optional[Dict]:
+        """
+        查找创建于private_key之前、尚未补写键的单聊（走(platform, chatroom_name, talkers.id)组合索引），
+        找到时写入private_key，之后同一对用户的查询都是键上的点查
+        """
+        key = private_pair_key(platform, user_id1, user_id2)
+        conversation = self.collection.find_one({
             "platform": platform,
             "chatroom_name": None,
             "talkers.id": {"$all": [user_id1, user_id2]},
-            # 确保只有这两个用户（即talkers数组长度为2）
-            "$where": "this.talkers.length === 2"
-        }
+            "talkers": {"$size": 2},
+            "private_key": {"$exists": False},
+            "duplicate_of": {"$exists": False}
+        }, sort=[("_id", 1)])
+        if conversation is None or conversation_private_key(conversation) != key:
+            return None
         
-        return self.collection.find_one(query)
+        try:
+            self.collection.update_one(
+                {"_id": conversation["_id"], "private_key": {"$exists": False}},
+                {"$set": {"private_key": key}}
+            )
+        except DuplicateKeyError:
+            # 并发时另一个会话先拿到了这个键，以它为准
+            return self.collection.find_one({"private_key": key})
+        conversation["private_key"] = key
+        return conversation
     
     def get_group_conversation(self, platform: str, chatroom_name: str) -> Optional[Dict]:
         """
@@ -160,6 +406,10 @@ class ConversationDAO():
             update_fields
         )
         
+        # 改动了参与者、群名或平台时重新计算单聊键
+        if result.modified_count > 0 and any(field.split(".")[0] in PRIVATE_KEY_FIELDS for field in update_data):
+            self._sync_private_key(object_id)
+        
         return result.modified_count > 0
     
     def delete_conversation(self, conversation_id: str) -> bool:
@@ -181,7 +431,8 @@ class ConversationDAO():
         return result.deleted_count > 0
     
     def find_conversations(self, query: Dict = None, limit: int = 0, 
-                          skip: int = 0, sort=None) -> Cursor:
+                          skip: int = 0, sort=None, projection: Dict = None,
+                          raw: bool = False) -> List[Dict]:
         """
         查找符合条件的会话
         
@@ -190,14 +441,30 @@ class ConversationDAO():
             limit: 最大返回数量
             skip: 跳过的文档数
             sort: 排序字段
+            projection: 返回字段，如 {"platform": 1, "talkers": 1}；列表页无需取回聊天记录
+            raw: 返回只读的RawBSONDocument，首次访问字段时才解码；适合原样转发的文档，跳过大字段请用projection
+            
+        Returns:
+            List[Dict]: 会话列表
+        """
+        return list(self.iter_conversations(query, limit, skip, sort, projection, raw=raw))
+    
+    def iter_conversations(self, query: Dict = None, limit: int = 0, skip: int = 0, sort=None,
+                           projection: Dict = None, batch_size: int = 1000, raw: bool = False) -> Iterator[Dict]:
+        """
+        逐条迭代符合条件的会话，内存占用与结果总数无关
+        
+        Args:
+            batch_size: 每次从服务器取回的文档数
+            其余参数同 find_conversations
             
         Returns:
-            Cursor: MongoDB游标
+            Iterator[Dict]: 会话迭代器
         """
         if query is None:
             query = {}
             
-        cursor = self.collection.find(query)
+        cursor = self._read_collection("conversations", raw).find(query, projection)
         
         if skip > 0:
             cursor = cursor.skip(skip)
@@ -208,10 +475,10 @@ class ConversationDAO():
         if sort:
             cursor = cursor.sort(sort)
             
-        return list(cursor)
+        return self._iter_cursor(cursor, batch_size)
     
     def find_conversations_by_user(self, user_id: str, platform: Optional[str] = None,
-                                  include_groups: bool = True) -> List[Dict]:
+                                  include_groups: bool = True, projection: Dict = None) -> List[Dict]:
         """
         查找用户参与的所有会话
         
@@ -219,10 +486,25 @@ class ConversationDAO():
             user_id: 用户ID
             platform: 可选平台过滤
             include_groups: 是否包含群聊
+            projection: 返回字段
             
         Returns:
             List[Dict]: 会话列表
         """
+        return list(self.iter_conversations_by_user(user_id, platform, include_groups, projection))
+    
+    def iter_conversations_by_user(self, user_id: str, platform: Optional[str] = None,
+                                   include_groups: bool = True, projection: Dict = None,
+                                   batch_size: int = 1000) -> Iterator[Dict]:
+        """
+        逐条迭代用户参与的会话，参数同 find_conversations_by_user
+        
+        Args:
+            batch_size: 每次从服务器取回的文档数
+            
+        Returns:
+            Iterator[Dict]: 会话迭代器
+        """
         query = {"talkers.id": user_id}
         
         if platform:
@@ -231,8 +513,8 @@ class ConversationDAO():
         if not include_groups:
             query["chatroom_name"] = None
             
-        cursor = self.collection.find(query)
-        return list(cursor)
+        cursor = self.collection.find(query, projection)
+        return self._iter_cursor(cursor, batch_size)
     
     def add_user_to_conversation(self, conversation_id: str, 
                                 user_id: str, nickname: str) -> bool:
@@ -268,6 +550,8 @@ class ConversationDAO():
             {"$push": {"talkers": {"id": user_id, "nickname": nickname}}}
         )
         
+        if result.modified_count > 0:
+            self._sync_private_key(object_id)
         return result.modified_count > 0
     
     def remove_user_from_conversation(self, conversation_id: str, user_id: str) -> bool:
@@ -291,8 +575,26 @@ class ConversationDAO():
             {"$pull": {"talkers": {"id": user_id}}}
         )
         
+        if result.modified_count > 0:
+            self._sync_private_key(object_id)
         return result.modified_count > 0
     
+    def _sync_private_key(self, object_id: ObjectId) -> None:
+        """参与者变化后重新计算private_key：不再是单聊时删除，变成单聊时写入"""
+        conversation = self.collection.find_one({"_id": object_id}, {"platform": 1, "chatroom_name": 1, "talkers.id": 1, "private_key": 1})
+        if conversation is None:
+            return
+        key = conversation_private_key(conversation)
+        if key == conversation.get("private_key"):
+            return
+        if key is None:
+            self.collection.update_one({"_id": object_id}, {"$unset": {"private_key": ""}})
+            return
+        try:
+            self.collection.update_one({"_id": object_id}, {"$set": {"private_key": key}})
+        except DuplicateKeyError:
+            logger.warning(f"Conversation {object_id} duplicates an existing private conversation, private_key not set")
+    
     def update_user_nickname(self, conversation_id: str, 
                             user_id: str, new_nickname: str) -> bool:
         """
@@ -351,6 +653,9 @@ class ConversationDAO():
             {"$set": {"chatroom_name": new_name}}
         )
         
+        if result.modified_count > 0:
+            self._sync_private_key(object_id)
+        
         return result.modified_count > 0
     
     def get_or_create_private_conversation(self, platform: str, 
@@ -369,25 +674,25 @@ class ConversationDAO():
         Returns:
             Tuple[str, bool]: 会话ID和是否新创建的标志
         """
-        # 先尝试查找现有会话
-        existing = self.get_private_conversation(platform, user_id1, user_id2)
-        
-        if existing:
-            return str(existing["_id"]), False
-            
-        # 创建新会话
-        new_conversation = {
-            "chatroom_name": None,
-            "talkers": [
-                {"id": user_id1, "nickname": nickname1},
-                {"id": user_id2, "nickname": nickname2}
-            ],
-            "platform": platform,
-            "conversation_info": {}
-        }
+        # 迁移完成之前，还没有键的旧单聊先补写键后返回；迁移之后只有下面一次往返
+        if self._legacy_lookup_enabled():
+            conversation = self._claim_legacy_private_conversation(platform, user_id1, user_id2)
+            if conversation is not None:
+                return str(conversation["_id"]), False
         
-        conversation_id = self.create_conversation(new_conversation)
-        return conversation_id, True
+        # 一次upsert完成查找或创建：private_key上的唯一索引保证并发的首次消息只创建一个会话
+        return self._get_or_create(
+            {"private_key": private_pair_key(platform, user_id1, user_id2)},
+            {
+                "chatroom_name": None,
+                "talkers": [
+                    {"id": user_id1, "nickname": nickname1},
+                    {"id": user_id2, "nickname": nickname2}
+                ],
+                "platform": platform,
+                "conversation_info": {}
+            }
+        )
     
     def get_or_create_group_conversation(self, platform: str, 
                                         chatroom_name: str,
@@ -403,22 +708,43 @@ class ConversationDAO():
         Returns:
             Tuple[str, bool]: 会话ID和是否新创建的标志
         """
-        # 先尝试查找现有群聊
-        existing = self.get_group_conversation(platform, chatroom_name)
+        # 一次upsert完成查找或创建：(platform, chatroom_name)上的唯一索引保证只创建一个群聊
+        return self._get_or_create(
+            {"platform": platform, "chatroom_name": chatroom_name},
+            {
+                "talkers": initial_talkers or [],
+                "conversation_info": {}
+            }
+        )
+    
+    def _get_or_create(self, query: Dict, new_fields: Dict, max_attempts: int = 3) -> Tuple[str, bool]:
+        """
+        原子地查找或创建会话：一次 find_one_and_update(upsert=True)
+        新文档的_id预先生成，返回的_id与之相同即为本次创建
+        两个并发upsert都未命中时，后写入的一方会因唯一索引报DuplicateKeyError，重试即可读到已创建的会话
         
-        if existing:
-            return str(existing["_id"]), False
+        Args:
+            query: 唯一确定会话的等值条件（插入时会写入新文档）
+            new_fields: 只在创建时写入的字段
             
-        # 创建新群聊
-        new_conversation = {
-            "chatroom_name": chatroom_name,
-            "talkers": initial_talkers or [],
-            "platform": platform,
-            "conversation_info": {}
-        }
-        
-        conversation_id = self.create_conversation(new_conversation)
-        return conversation_id, True
+        Returns:
+            Tuple[str, bool]: 会话ID和是否新创建的标志
+        """
+        for attempt in range(max_attempts):
+            new_id = ObjectId()
+            try:
+                conversation = self.collection.find_one_and_update(
+                    query,
+                    {"$setOnInsert": {"_id": new_id, **new_fields}},
+                    projection={"_id": 1},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+            except DuplicateKeyError:
+                if attempt == max_attempts - 1:
+                    raise
+                continue
+            return str(conversation["_id"]), conversation["_id"] == new_id
     
     def update_conversation_info(self, conversation_id: str, info_data: Dict) -> bool:
         """
@@ -459,8 +785,8 @@ class ConversationDAO():
         return self.collection.count_documents(query)
     
     def close(self):
-        """关闭MongoDB连接"""
-        self.client.close()
+        """共享的MongoClient由client_registry.close_all_clients关闭，这里无需释放"""
+        pass
 
 
 # 使用示例
@@ -474,7 +800,7 @@ if __name__ == "__main__":
             "$exists": True   # 字段必须存在
         },
         "talkers.nickname": "不辣的皮皮"
-    })
+    }, projection={"talkers": 1, "conversation_info.future": 1})
 
     for conversation in conversations:
-        print(conversation)
\ No newline at end of file
+        print(conversation)
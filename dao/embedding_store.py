@@ -0,0 +1,531 @@
+"""
+Memory-mapped Embedding Store
+磁盘上的向量缓存：基础矩阵是内存映射的.npy文件，之后的写入追加到预写日志（WAL），
+启动时只需mmap基础矩阵并重放WAL，fork出的多个工作进程共享同一份页缓存
+"""
+import os
+import json
+import time
+import zlib
+import struct
+import pickle
+import threading
+import logging
+from logging import getLogger
+logging.basicConfig(level=logging.INFO)
+logger = getLogger(__name__)
+
+import sys
+sys.path.append(".")
+
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows：不加跨进程文件锁，只适合单进程写入
+    fcntl = None
+
+from dao.vector_index import VectorIndex, normalize_vectors, top_k_indices
+
+# WAL记录头：payload长度和CRC32
+WAL_HEADER = struct.Struct("<II")
+# WAL超过该大小时在后台压缩进基础矩阵
+WAL_COMPACT_BYTES = 64 << 20
+
+
+class EmbeddingStore:
+    """
+    基于mmap的向量索引，接口与VectorIndex一致
+
+    文件布局（path为不含扩展名的前缀）：
+      {path}.npy        归一化float32矩阵，只读mmap
+      {path}.ids        与矩阵行对应的文档ID（pickle）
+      {path}.meta.json  行数、维度、synced_at
+      {path}.wal        基础矩阵之后的写入，每条记录是长度+CRC32+pickle的(op, ids, vectors)
+      {path}.lock / {path}.compact.lock  跨进程文件锁
+
+    基础矩阵从不原地修改：覆盖或删除只在内存里标记该行失效，
+    新向量放在内存中的VectorIndex里。compact()把两部分合并成新的基础矩阵，
+    WAL超过wal_compact_bytes时在后台自动压缩。
+
+    多个进程可以共用同一组文件：追加WAL持共享锁，重放截断和替换文件持独占锁，
+    压缩前先追上其他进程追加的记录，压缩期间新追加的记录转入新的WAL。
+    """
+
+    WAL_ADD = "add"
+    WAL_REMOVE = "remove"
+    WAL_SYNCED = "synced"
+
+    def __init__(self, path: str, dimension: int = None, wal_compact_bytes: Optional[int] = WAL_COMPACT_BYTES):
+        """
+        wal_compact_bytes: WAL超过该字节数时在后台压缩，None表示只在显式调用compact()/save()时压缩
+        """
+        self.path = path
+        self.dimension = dimension
+        self.wal_compact_bytes = wal_compact_bytes
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._compact_thread: Optional[threading.Thread] = None
+        self._lock_fds: Dict[str, int] = {}
+        # 已重放到的WAL位置和WAL文件的inode（其他进程压缩后WAL被替换，inode改变）
+        self._wal_offset = 0
+        self._wal_inode: Optional[int] = None
+        self._wal_size = 0
+        self._clear()
+
+    def _clear(self) -> None:
+        """清空内存状态"""
+        self.synced_at: Optional[datetime] = None
+        self._base = np.empty((0, self.dimension or 0), dtype=np.float32)
+        self._base_ids: List[Any] = []
+        self._base_rows: Dict[Any, int] = {}
+        self._base_deleted = np.zeros(0, dtype=bool)
+        self._base_deleted_count = 0
+        self._overlay = VectorIndex(self.dimension)
+        self._wal_offset = 0
+
+    @classmethod
+    def open(cls, path: str, wal_compact_bytes: Optional[int] = WAL_COMPACT_BYTES) -> "EmbeddingStore":
+        """
+        打开（或新建）向量缓存：mmap基础矩阵并重放WAL
+        文件不完整或互相不一致（如压缩在几次替换之间崩溃）时丢弃全部文件，返回空的缓存，
+        调用方按synced_at为None从MongoDB重建
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        store = cls(path, wal_compact_bytes=wal_compact_bytes)
+        with store._lock, store._file_lock(".lock"):
+            try:
+                store._load_base()
+            except Exception as e:
+                logger.warning(f"Could not load embedding store {path}, discarding it for a rebuild: {e}")
+                store._remove_files()
+                store._clear()
+            replayed = store._replay_wal()
+        logger.info(f"Opened embedding store {path}: {len(store._base_ids)} mapped rows, {replayed} WAL records")
+        return store
+
+    @contextmanager
+    def _file_lock(self, suffix: str, exclusive: bool = True, blocking: bool = True):
+        """
+        跨进程文件锁{path}{suffix}，yield是否拿到锁；没有fcntl时不加锁
+        同一进程内的线程由self._lock（WAL锁）或self._compact_lock（压缩锁）互斥
+        """
+        if fcntl is None:
+            yield True
+            return
+        fd = self._lock_fds.get(suffix)
+        if fd is None:
+            fd = self._lock_fds[suffix] = os.open(f"{self.path}{suffix}", os.O_RDWR | os.O_CREAT, 0o644)
+        flags = (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if blocking else fcntl.LOCK_NB)
+        try:
+            fcntl.flock(fd, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _load_base(self) -> None:
+        """读取基础矩阵、ID和元数据，并检查三者一致"""
+        path = self.path
+        meta_path = f"{path}.meta.json"
+        if not os.path.exists(meta_path):
+            return
+
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(f"{path}.ids", "rb") as f:
+            self._base_ids = pickle.load(f)
+
+        self.dimension = meta["dimension"]
+        if meta["count"]:
+            self._base = np.load(f"{path}.npy", mmap_mode="r")
+        else:
+            self._base = np.empty((0, self.dimension or 0), dtype=np.float32)
+        if not meta["count"] == self._base.shape[0] == len(self._base_ids):
+            raise ValueError(f"行数不一致：meta {meta['count']}，矩阵 {self._base.shape[0]}，ID {len(self._base_ids)}")
+        if self._base.shape[0] and self._base.shape[1] != self.dimension:
+            raise ValueError(f"维度不一致：meta {self.dimension}，矩阵 {self._base.shape[1]}")
+
+        self._base_rows = {doc_id: row for row, doc_id in enumerate(self._base_ids)}
+        self._base_deleted = np.zeros(len(self._base_ids), dtype=bool)
+        self._base_deleted_count = 0
+        self._overlay = VectorIndex(self.dimension)
+        if meta.get("synced_at"):
+            self.synced_at = datetime.fromisoformat(meta["synced_at"])
+
+    def _remove_files(self) -> None:
+        """删除缓存的全部文件（WAL基于旧的基础矩阵，一并删除）"""
+        for suffix in [".npy", ".ids", ".meta.json", ".wal"]:
+            try:
+                os.remove(f"{self.path}{suffix}")
+            except FileNotFoundError:
+                pass
+
+    def __len__(self) -> int:
+        return len(self._base_ids) - self._base_deleted_count + len(self._overlay)
+
+    def __contains__(self, doc_id) -> bool:
+        row = self._base_rows.get(doc_id)
+        return (row is not None and not self._base_deleted[row]) or doc_id in self._overlay
+
+    @property
+    def ids(self) -> List[Any]:
+        """所有有效的文档ID"""
+        with self._lock:
+            base_ids = [doc_id for doc_id, deleted in zip(self._base_ids, self._base_deleted) if not deleted]
+            return base_ids + list(self._overlay.ids)
+
+    def add(self, doc_id, vector) -> None:
+        """插入或覆盖单个向量"""
+        self.add_many([doc_id], [vector])
+
+    def add_many(self, doc_ids: List[Any], vectors) -> None:
+        """批量插入或覆盖向量，并写入WAL"""
+        if len(doc_ids) == 0:
+            return
+        normalized = normalize_vectors(vectors)
+        with self._lock:
+            self._apply_add(doc_ids, normalized)
+            self._append_wal(self.WAL_ADD, list(doc_ids), normalized)
+
+    def remove(self, doc_id) -> bool:
+        """删除向量，并写入WAL"""
+        with self._lock:
+            removed = self._apply_remove([doc_id])
+            if removed:
+                self._append_wal(self.WAL_REMOVE, [doc_id], None)
+            return removed > 0
+
+    def mark_synced(self, synced_at: datetime) -> None:
+        """记录已与MongoDB同步到的时间点"""
+        with self._lock:
+            self.synced_at = synced_at
+            self._append_wal(self.WAL_SYNCED, [], synced_at)
+
+    def search(self, query_vector, top_k: int = 10,
+               candidate_ids: Iterable[Any] = None,
+               similarity_threshold: float = None) -> List[Tuple[Any, float]]:
+        """
+        余弦相似度检索（精确）
+        基础矩阵与内存中的新增部分分别取top_k，再合并
+        """
+        query = normalize_vectors(query_vector)[0]
+
+        with self._lock:
+            if len(self) == 0:
+                return []
+            if query.shape[0] != self.dimension:
+                raise ValueError(f"查询向量维度应为{self.dimension}，实际为{query.shape[0]}")
+
+            if candidate_ids is not None:
+                candidate_ids = list(candidate_ids)
+                rows = np.array([
+                    row for row in (self._base_rows.get(doc_id) for doc_id in candidate_ids)
+                    if row is not None and not self._base_deleted[row]
+                ], dtype=np.int64)
+                scores = self._base[rows] @ query if rows.size else np.empty(0, dtype=np.float32)
+            else:
+                rows = None
+                scores = self._base @ query if self._base_ids else np.empty(0, dtype=np.float32)
+                if self._base_deleted_count:
+                    scores[self._base_deleted] = -np.inf
+
+            hits = []
+            for i in top_k_indices(scores, top_k):
+                score = float(scores[i])
+                if score == -np.inf or (similarity_threshold is not None and score < similarity_threshold):
+                    break
+                row = i if rows is None else rows[i]
+                hits.append((self._base_ids[row], score))
+
+            hits.extend(self._overlay.search(query, top_k, candidate_ids, similarity_threshold))
+            hits.sort(key=lambda hit: hit[1], reverse=True)
+            return hits[:top_k]
+
+    def search_many(self, query_vectors, top_k: int = 10,
+                    candidate_ids_list: List[Optional[Iterable[Any]]] = None,
+                    similarity_threshold: float = None) -> List[List[Tuple[Any, float]]]:
+        """批量检索：基础矩阵与整个查询矩阵做一次矩阵乘，再与新增部分的批量结果合并"""
+        queries = normalize_vectors(query_vectors)
+        if candidate_ids_list is None:
+            candidate_ids_list = [None] * len(queries)
+        elif len(candidate_ids_list) != len(queries):
+            raise ValueError("candidate_ids_list和query_vectors长度不一致")
+        candidate_ids_list = [None if ids is None else list(ids) for ids in candidate_ids_list]
+
+        with self._lock:
+            if len(self) == 0:
+                return [[] for _ in range(len(queries))]
+            if queries.shape[1] != self.dimension:
+                raise ValueError(f"查询向量维度应为{self.dimension}，实际为{queries.shape[1]}")
+
+            if self._base_ids:
+                scores = queries @ self._base.T
+            else:
+                scores = np.empty((len(queries), 0), dtype=np.float32)
+            if self._base_deleted_count:
+                scores[:, self._base_deleted] = -np.inf
+            overlay_hits = self._overlay.search_many(queries, top_k, candidate_ids_list, similarity_threshold)
+
+            results = []
+            for row_scores, candidate_ids, extra in zip(scores, candidate_ids_list, overlay_hits):
+                rows = None
+                if candidate_ids is not None:
+                    rows = np.array([
+                        row for row in (self._base_rows.get(doc_id) for doc_id in candidate_ids)
+                        if row is not None
+                    ], dtype=np.int64)
+                    row_scores = row_scores[rows]
+
+                hits = []
+                for i in top_k_indices(row_scores, top_k):
+                    score = float(row_scores[i])
+                    if score == -np.inf or (similarity_threshold is not None and score < similarity_threshold):
+                        break
+                    hits.append((self._base_ids[i if rows is None else rows[i]], score))
+
+                hits.extend(extra)
+                hits.sort(key=lambda hit: hit[1], reverse=True)
+                results.append(hits[:top_k])
+            return results
+
+    def save(self, path: str = None) -> None:
+        """
+        把有效的基础行和新增向量写成基础矩阵
+        path: 另存为其他前缀；默认（或等于自身前缀时）即compact()
+        """
+        if path is None or path == self.path:
+            self.compact()
+            return
+        with self._lock:
+            snapshot = self._snapshot()
+        for tmp_path, final_path in self._write_snapshot(path, *snapshot):
+            os.replace(tmp_path, final_path)
+
+    def compact(self, wait: bool = True) -> bool:
+        """
+        压缩：把有效的基础行和新增向量写成新的基础矩阵，WAL只保留压缩期间新追加的记录
+        新矩阵在锁外写入，检索和写入只在取快照和替换文件时短暂等待
+        wait: 为False时若本进程或其他进程正在压缩则直接返回False
+        返回是否完成了压缩
+        """
+        if not self._compact_lock.acquire(blocking=wait):
+            return False
+        try:
+            with self._file_lock(".compact.lock", blocking=wait) as acquired:
+                if not acquired:
+                    return False
+
+                # 先追上其他进程追加的记录，快照才包含WAL中到offset为止的全部写入
+                with self._lock, self._file_lock(".lock"):
+                    self._catch_up()
+                    offset = self._wal_offset
+                    snapshot = self._snapshot()
+                replacements = self._write_snapshot(self.path, *snapshot)
+
+                with self._lock, self._file_lock(".lock"):
+                    wal_path = f"{self.path}.wal"
+                    with open(wal_path, "rb") as f:
+                        f.seek(offset)
+                        tail = f.read()
+                    with open(f"{wal_path}.tmp", "wb") as f:
+                        f.write(tail)
+                    for tmp_path, final_path in replacements + [(f"{wal_path}.tmp", wal_path)]:
+                        os.replace(tmp_path, final_path)
+
+                    # 重新映射新矩阵，重放快照之后追加的记录
+                    self._clear()
+                    self._load_base()
+                    replayed = self._replay_wal()
+                logger.info(f"Compacted embedding store {self.path}: {len(self._base_ids)} rows, "
+                            f"{replayed} WAL records kept")
+                return True
+        finally:
+            self._compact_lock.release()
+
+    def _maybe_compact(self) -> None:
+        """WAL超过wal_compact_bytes时启动后台压缩（调用方持有锁）"""
+        if not self.wal_compact_bytes or self._wal_size <= self.wal_compact_bytes:
+            return
+        if self._compact_thread is not None and self._compact_thread.is_alive():
+            return
+        self._compact_thread = threading.Thread(target=self._compact_in_background,
+                                                name="embedding-store-compact", daemon=True)
+        self._compact_thread.start()
+
+    def _compact_in_background(self) -> None:
+        """后台压缩；压缩期间追加的记录使WAL仍超过阈值时接着压缩"""
+        while self.compact(wait=False) and self._wal_size > self.wal_compact_bytes:
+            pass
+
+    def wait_for_compaction(self, timeout: float = None) -> None:
+        """等待进行中的后台压缩完成"""
+        thread = self._compact_thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _snapshot(self) -> Tuple[List[Any], np.ndarray, np.ndarray, np.ndarray, Optional[datetime]]:
+        """取压缩用的快照(ids, 基础矩阵, 保留行掩码, 新增矩阵, synced_at)，调用方持有锁"""
+        keep = ~self._base_deleted
+        ids = [doc_id for doc_id, kept in zip(self._base_ids, keep) if kept] + list(self._overlay.ids)
+        # 基础矩阵只读且替换文件后旧映射仍然有效，不需要复制；新增部分会继续变化，复制一份
+        return ids, self._base, keep, self._overlay.matrix.copy(), self.synced_at
+
+    def _write_snapshot(self, path: str, ids: List[Any], base: np.ndarray, keep: np.ndarray,
+                        overlay: np.ndarray, synced_at: Optional[datetime]) -> List[Tuple[str, str]]:
+        """把快照写成{path}的临时文件，返回按顺序替换的(临时文件, 目标文件)列表"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        dimension = self.dimension or 0
+
+        matrix_tmp = f"{path}.npy.tmp"
+        matrix = np.lib.format.open_memmap(matrix_tmp, mode="w+", dtype=np.float32, shape=(len(ids), dimension))
+        base_count = int(keep.sum())
+        if base_count:
+            matrix[:base_count] = base[keep]
+        if len(overlay):
+            matrix[base_count:] = overlay
+        matrix.flush()
+        del matrix
+
+        with open(f"{path}.ids.tmp", "wb") as f:
+            pickle.dump(ids, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(f"{path}.meta.json.tmp", "w", encoding="utf-8") as f:
+            json.dump({
+                "count": len(ids),
+                "dimension": self.dimension,
+                "synced_at": synced_at.isoformat() if synced_at else None,
+            }, f)
+
+        return [(matrix_tmp, f"{path}.npy"), (f"{path}.ids.tmp", f"{path}.ids"),
+                (f"{path}.meta.json.tmp", f"{path}.meta.json")]
+
+    def _apply_add(self, doc_ids: List[Any], normalized: np.ndarray) -> None:
+        """把写入应用到内存状态。调用方持有锁"""
+        if self.dimension is None:
+            self.dimension = normalized.shape[1]
+        self._mark_base_deleted(doc_ids)
+        self._overlay.add_many(doc_ids, normalized)
+
+    def _apply_remove(self, doc_ids: List[Any]) -> int:
+        """把删除应用到内存状态，返回删除数。调用方持有锁"""
+        removed = self._mark_base_deleted(doc_ids)
+        for doc_id in doc_ids:
+            removed += int(self._overlay.remove(doc_id))
+        return removed
+
+    def _mark_base_deleted(self, doc_ids: List[Any]) -> int:
+        """让基础矩阵中的行失效。调用方持有锁"""
+        marked = 0
+        for doc_id in doc_ids:
+            row = self._base_rows.get(doc_id)
+            if row is not None and not self._base_deleted[row]:
+                self._base_deleted[row] = True
+                marked += 1
+        self._base_deleted_count += marked
+        return marked
+
+    def _append_wal(self, op: str, doc_ids: List[Any], payload) -> None:
+        """
+        追加一条WAL记录（调用方持有锁），一次write写完，多个进程追加同一文件也不会交错
+        超过wal_compact_bytes时触发后台压缩
+        """
+        data = pickle.dumps((op, doc_ids, payload), protocol=pickle.HIGHEST_PROTOCOL)
+        record = WAL_HEADER.pack(len(data), zlib.crc32(data)) + data
+        with self._file_lock(".lock", exclusive=False):
+            fd = os.open(f"{self.path}.wal", os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, record)
+                self._wal_size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+        self._maybe_compact()
+
+    def _catch_up(self) -> int:
+        """
+        追上其他进程追加的WAL记录；WAL已被其他进程压缩替换时重新加载基础矩阵
+        调用方持有锁和独占文件锁
+        """
+        try:
+            inode = os.stat(f"{self.path}.wal").st_ino
+        except FileNotFoundError:
+            inode = None
+        if inode != self._wal_inode:
+            self._clear()
+            self._load_base()
+        return self._replay_wal()
+
+    def _replay_wal(self) -> int:
+        """
+        从上次读到的位置重放WAL到末尾，调用方持有锁和独占文件锁
+        记录不完整或校验失败（写入中途崩溃、磁盘损坏）时把文件截断到最后一条完好的记录，
+        之后的追加从这里继续；旧格式（无长度和校验和）的WAL因此整体丢弃，由调用方按synced_at从MongoDB补齐
+        """
+        wal_path = f"{self.path}.wal"
+        replayed = 0
+        with os.fdopen(os.open(wal_path, os.O_RDWR | os.O_CREAT, 0o644), "r+b") as f:
+            self._wal_inode = os.fstat(f.fileno()).st_ino
+            f.seek(self._wal_offset)
+            while True:
+                header = f.read(WAL_HEADER.size)
+                if not header:
+                    break
+                record = None
+                if len(header) == WAL_HEADER.size:
+                    length, checksum = WAL_HEADER.unpack(header)
+                    data = f.read(length)
+                    if len(data) == length and zlib.crc32(data) == checksum:
+                        try:
+                            record = pickle.loads(data)
+                        except Exception:
+                            record = None
+                if record is None:
+                    logger.warning(f"{wal_path}: corrupt WAL record at byte {self._wal_offset}, truncating")
+                    f.truncate(self._wal_offset)
+                    break
+
+                op, doc_ids, payload = record
+                if op == self.WAL_ADD:
+                    self._apply_add(doc_ids, payload)
+                elif op == self.WAL_REMOVE:
+                    self._apply_remove(doc_ids)
+                elif op == self.WAL_SYNCED:
+                    self.synced_at = payload
+                self._wal_offset = f.tell()
+                replayed += 1
+        self._wal_size = self._wal_offset
+        return replayed
+
+
+# 使用示例：对比从零构建与mmap打开的耗时
+if __name__ == "__main__":
+    import tempfile
+
+    rng = np.random.default_rng(42)
+    vectors = rng.normal(size=(200000, 256)).astype(np.float32)
+    ids = list(range(len(vectors)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "demo")
+        store = EmbeddingStore.open(path)
+        store.add_many(ids, vectors)
+        store.save()
+
+        start = time.perf_counter()
+        reopened = EmbeddingStore.open(path)
+        print(f"open {len(reopened)} vectors: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        reopened.add(-1, vectors[0])
+        reopened.remove(0)
+        print("top hit after WAL writes:", reopened.search(vectors[0], top_k=1))
+        print("after WAL replay:", EmbeddingStore.open(path).search(vectors[0], top_k=1))
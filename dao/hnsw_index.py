@@ -0,0 +1,585 @@
+"""
+HNSW Approximate Nearest Neighbour Index
+进程内、纯CPU的HNSW近似最近邻索引，接口与VectorIndex一致，可替换使用
+
+参数说明：
+- M: 每层每个节点的最大邻居数（第0层为2M），越大召回越高、内存越大
+- ef_construction: 建图时的候选集大小，越大建图越慢、图质量越高
+- ef_search: 查询时的候选集大小，越大召回越高、延迟越高（可随时调整）
+- min_graph_size: 存活向量数达到该值才建图，之前直接精确检索（小规模时一次矩阵乘比图检索快，
+  也省去建图开销）；默认按维度取 MIN_GRAPH_ELEMENTS // dimension，见 benchmark_recall
+"""
+import os
+import time
+import pickle
+import threading
+import logging
+from logging import getLogger
+logging.basicConfig(level=logging.INFO)
+logger = getLogger(__name__)
+
+import sys
+sys.path.append(".")
+
+from typing import Dict, List, Any, Optional, Iterable, Tuple
+import numpy as np
+
+from dao.vector_index import VectorIndex, normalize_vectors, top_k_indices, SCORE_BLOCK_ELEMENTS
+
+# 默认建图阈值（向量数 × 维度）：精确检索的耗时与之成正比，约在该规模超过图检索
+# （实测128维约2万条、1536维约2千条时图检索约1ms，与精确检索持平）
+MIN_GRAPH_ELEMENTS = 3_000_000
+# 图检索每轮同时扩展的候选数
+EXPAND_WIDTH = 16
+
+
+def _grow(array: np.ndarray, capacity: int, fill=0) -> np.ndarray:
+    """把数组的行数扩到capacity，新增部分填fill"""
+    grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class HNSWIndex:
+    """
+    分层可导航小世界图（HNSW）索引
+
+    支持增量插入和删除：删除（以及覆盖写入）采用墓碑标记，检索时跳过。
+    墓碑比例超过rebuild_threshold、或规模达到min_graph_size时在后台线程重建：
+    新图在锁外构建，期间的写入记入日志，构建完成后持锁回放并替换，检索不被阻塞。
+    """
+
+    SNAPSHOT_VERSION = 2
+
+    def __init__(self, dimension: int = None, M: int = 16, ef_construction: int = 100,
+                 ef_search: int = 64, rebuild_threshold: float = 0.3,
+                 min_graph_size: int = None,
+                 seed: int = 42, initial_capacity: int = 1024):
+        self.dimension = dimension
+        self.M = M
+        self.M0 = 2 * M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.rebuild_threshold = rebuild_threshold
+        self.min_graph_size = min_graph_size
+        # 快照已与MongoDB同步到的时间点，由加载方维护
+        self.synced_at = None
+        self._level_mult = 1 / np.log(M)
+        self._rng = np.random.default_rng(seed)
+        self._capacity = initial_capacity
+
+        self._matrix: Optional[np.ndarray] = None
+        self._ids: List[Any] = []               # 节点 -> 文档ID
+        self._nodes: Dict[Any, int] = {}        # 文档ID -> 节点（仅未删除）
+        self._levels: List[int] = []
+        self._neighbors: List[List[List[int]]] = []  # 节点 -> 每层邻居列表
+        self._links0 = np.full((0, self.M0), -1, dtype=np.int32)  # 第0层邻居的定长副本，-1为空位
+        self._deleted = np.zeros(0, dtype=bool)
+        self._deleted_count = 0
+        self._graph_ready = False
+        self._entry: Optional[int] = None
+        self._max_level = -1
+        # 图检索的访问标记：每次搜索换一个编号，免去逐次清零
+        self._visit_marks = np.zeros(0, dtype=np.int32)
+        self._visit_tag = 0
+        self._lock = threading.RLock()
+        # 后台重建期间的写入日志 [(op, doc_id, vector)]，不在重建时为None
+        self._pending: Optional[List[Tuple[str, Any, Optional[np.ndarray]]]] = None
+        self._rebuild_thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self._nodes
+
+    @property
+    def ids(self) -> List[Any]:
+        """索引中（未删除）的文档ID"""
+        return list(self._nodes)
+
+    @property
+    def graph_ready(self) -> bool:
+        """是否已建图（否则检索为精确检索）"""
+        return self._graph_ready
+
+    def _graph_threshold(self) -> int:
+        """建图所需的存活向量数"""
+        if self.min_graph_size is not None:
+            return self.min_graph_size
+        return MIN_GRAPH_ELEMENTS // max(self.dimension or 1, 1)
+
+    def _ensure_capacity(self, size: int):
+        """按需扩容（容量翻倍）"""
+        if self._matrix is None:
+            capacity = max(self._capacity, size)
+            self._matrix = np.zeros((capacity, self.dimension), dtype=np.float32)
+        elif size > self._matrix.shape[0]:
+            capacity = max(size, self._matrix.shape[0] * 2)
+            grown = np.zeros((capacity, self.dimension), dtype=np.float32)
+            grown[:len(self._ids)] = self._matrix[:len(self._ids)]
+            self._matrix = grown
+        else:
+            return
+        self._deleted = _grow(self._deleted, capacity)
+        self._visit_marks = _grow(self._visit_marks, capacity)
+        self._links0 = _grow(self._links0, capacity, -1)
+
+    def _random_level(self) -> int:
+        return int(-np.log(1.0 - self._rng.random()) * self._level_mult)
+
+    def _search_layer(self, query: np.ndarray, entry_points: List[int],
+                      ef: int, level: int) -> List[Tuple[float, int]]:
+        """
+        在单层上做best-first搜索，返回最多ef个(相似度, 节点)
+        每轮同时扩展最多EXPAND_WIDTH个最优候选：它们的邻居一次取出、去重、打分，
+        结果集用argpartition合并，避免逐个邻居的堆操作
+        """
+        self._visit_tag += 1
+        if self._visit_tag == np.iinfo(np.int32).max:
+            self._visit_marks[:] = 0
+            self._visit_tag = 1
+        marks, tag = self._visit_marks, self._visit_tag
+
+        result_nodes = np.unique(np.asarray(entry_points, dtype=np.int64))
+        marks[result_nodes] = tag
+        result_sims = self._matrix[result_nodes] @ query
+        if result_nodes.size > ef:
+            keep = np.argpartition(-result_sims, ef - 1)[:ef]
+            result_nodes, result_sims = result_nodes[keep], result_sims[keep]
+        candidate_nodes, candidate_sims = result_nodes, result_sims
+
+        while candidate_nodes.size:
+            worst = result_sims.min() if result_nodes.size >= ef else -np.inf
+            promising = candidate_sims >= worst
+            if not promising.any():
+                break
+            candidate_nodes, candidate_sims = candidate_nodes[promising], candidate_sims[promising]
+            if candidate_nodes.size > EXPAND_WIDTH:
+                order = np.argpartition(-candidate_sims, EXPAND_WIDTH - 1)
+                expand, rest = order[:EXPAND_WIDTH], order[EXPAND_WIDTH:]
+                expanding = candidate_nodes[expand]
+                candidate_nodes, candidate_sims = candidate_nodes[rest], candidate_sims[rest]
+            else:
+                expanding = candidate_nodes
+                candidate_nodes, candidate_sims = candidate_nodes[:0], candidate_sims[:0]
+
+            if level == 0:
+                neighbors = self._links0[expanding].ravel()
+                neighbors = neighbors[neighbors >= 0]
+            else:
+                links = self._neighbors
+                neighbors = np.fromiter(
+                    (n for node in expanding.tolist() for n in links[node][level]), dtype=np.int64
+                )
+            neighbors = neighbors[marks[neighbors] != tag]
+            if not neighbors.size:
+                continue
+            # 去重：每个位置写入各自的负编号，读回与自己一致的位置每个节点只有一个
+            positions = -np.arange(1, neighbors.size + 1, dtype=np.int32)
+            marks[neighbors] = positions
+            neighbors = neighbors[marks[neighbors] == positions]
+            marks[neighbors] = tag
+
+            sims = self._matrix[neighbors] @ query
+            if result_nodes.size >= ef:
+                closer = sims > worst
+                neighbors, sims = neighbors[closer], sims[closer]
+                if not neighbors.size:
+                    continue
+
+            result_nodes = np.concatenate([result_nodes, neighbors])
+            result_sims = np.concatenate([result_sims, sims])
+            if result_nodes.size > ef:
+                keep = np.argpartition(-result_sims, ef - 1)[:ef]
+                result_nodes, result_sims = result_nodes[keep], result_sims[keep]
+            candidate_nodes = np.concatenate([candidate_nodes, neighbors])
+            candidate_sims = np.concatenate([candidate_sims, sims])
+
+        return list(zip(result_sims.tolist(), result_nodes.tolist()))
+
+    def _select_neighbors(self, candidates: List[Tuple[float, int]], m: int) -> List[int]:
+        """
+        启发式邻居选择：优先保留"离基点比离已选邻居更近"的候选，
+        使邻居分布在不同方向上；不足m个时用剩余最近的补齐
+        """
+        candidates = sorted(candidates, reverse=True)
+        if len(candidates) <= m:
+            return [node for _, node in candidates]
+
+        nodes = [node for _, node in candidates]
+        vectors = self._matrix[nodes]
+        pairwise = vectors @ vectors.T
+        selected: List[int] = []
+        for i, (sim, _) in enumerate(candidates):
+            if len(selected) >= m:
+                break
+            if selected and pairwise[i, selected].max() > sim:
+                continue
+            selected.append(i)
+
+        if len(selected) < m:
+            chosen = set(selected)
+            selected.extend([i for i in range(len(nodes)) if i not in chosen][:m - len(selected)])
+        return [nodes[i] for i in selected]
+
+    def _insert(self, doc_id, vector: np.ndarray):
+        """插入单个已归一化的向量，覆盖时旧节点记为墓碑（调用方持有锁）"""
+        if doc_id in self._nodes:
+            self._remove_node(doc_id)
+        if self._pending is not None:
+            self._pending.append(("add", doc_id, vector))
+
+        node = len(self._ids)
+        self._ensure_capacity(node + 1)
+        self._matrix[node] = vector
+        self._deleted[node] = False
+        self._ids.append(doc_id)
+        self._nodes[doc_id] = node
+
+        if not self._graph_ready:
+            # 未建图：只存向量，检索时精确打分
+            self._levels.append(0)
+            self._neighbors.append([[]])
+            return
+
+        level = self._random_level()
+        self._levels.append(level)
+        self._neighbors.append([[] for _ in range(level + 1)])
+
+        if self._entry is None:
+            self._entry = node
+            self._max_level = level
+            return
+
+        entry_points = [self._entry]
+        for layer in range(self._max_level, level, -1):
+            entry_points = [max(self._search_layer(vector, entry_points, 1, layer))[1]]
+
+        for layer in range(min(level, self._max_level), -1, -1):
+            found = self._search_layer(vector, entry_points, self.ef_construction, layer)
+            max_neighbors = self.M0 if layer == 0 else self.M
+            neighbors = self._select_neighbors(found, self.M)
+            self._set_links(node, layer, neighbors)
+
+            for neighbor in neighbors:
+                links = self._neighbors[neighbor][layer] + [node]
+                if len(links) > max_neighbors:
+                    sims = (self._matrix[links] @ self._matrix[neighbor]).tolist()
+                    links = self._select_neighbors(list(zip(sims, links)), max_neighbors)
+                self._set_links(neighbor, layer, links)
+            entry_points = [n for _, n in found]
+
+        if level > self._max_level:
+            self._entry = node
+            self._max_level = level
+
+    def _set_links(self, node: int, layer: int, links: List[int]):
+        """更新节点某层的邻居，第0层同时写入定长数组供检索成批读取（调用方持有锁）"""
+        self._neighbors[node][layer] = links
+        if layer == 0:
+            self._links0[node, :len(links)] = links
+            self._links0[node, len(links):] = -1
+
+    def add(self, doc_id, vector) -> None:
+        """插入或覆盖单个向量"""
+        self.add_many([doc_id], [vector])
+
+    def add_many(self, doc_ids: List[Any], vectors) -> None:
+        """批量插入或覆盖向量"""
+        if len(doc_ids) == 0:
+            return
+        normalized = normalize_vectors(vectors)
+        if normalized.shape[0] != len(doc_ids):
+            raise ValueError("doc_ids和vectors长度不一致")
+
+        with self._lock:
+            if self.dimension is None:
+                self.dimension = normalized.shape[1]
+            elif normalized.shape[1] != self.dimension:
+                raise ValueError(f"向量维度应为{self.dimension}，实际为{normalized.shape[1]}")
+            for doc_id, vector in zip(doc_ids, normalized):
+                self._insert(doc_id, vector)
+            self._schedule_rebuild()
+
+    def bulk_load(self, batches: Iterable[Tuple[List[Any], Any]]) -> None:
+        """
+        从(文档ID列表, 向量列表)批次初始加载：先只写入向量，全部写完后同步建一次图，
+        避免逐批触发后台重建
+        """
+        with self._lock:
+            for doc_ids, vectors in batches:
+                normalized = normalize_vectors(vectors)
+                if self.dimension is None:
+                    self.dimension = normalized.shape[1]
+                for doc_id, vector in zip(doc_ids, normalized):
+                    self._insert(doc_id, vector)
+        if not self._graph_ready and len(self) >= self._graph_threshold():
+            self.rebuild()
+
+    def _remove_node(self, doc_id) -> bool:
+        """打墓碑标记（调用方持有锁）"""
+        node = self._nodes.pop(doc_id, None)
+        if node is None:
+            return False
+        if self._pending is not None:
+            self._pending.append(("remove", doc_id, None))
+        self._deleted[node] = True
+        self._deleted_count += 1
+        return True
+
+    def remove(self, doc_id) -> bool:
+        """删除向量，返回是否存在"""
+        with self._lock:
+            removed = self._remove_node(doc_id)
+            if removed:
+                self._schedule_rebuild()
+            return removed
+
+    def _schedule_rebuild(self):
+        """墓碑比例超过rebuild_threshold、或规模达到min_graph_size但尚未建图时，启动后台重建（调用方持有锁）"""
+        if self._rebuild_thread is not None and self._rebuild_thread.is_alive():
+            return
+        too_many_deleted = self._deleted_count > self.rebuild_threshold * len(self._ids)
+        needs_graph = not self._graph_ready and len(self._nodes) >= self._graph_threshold()
+        if too_many_deleted or needs_graph:
+            self._rebuild_thread = threading.Thread(target=self.rebuild, name="hnsw-rebuild", daemon=True)
+            self._rebuild_thread.start()
+
+    def wait_for_rebuild(self, timeout: float = None) -> None:
+        """等待进行中的后台重建完成"""
+        thread = self._rebuild_thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def rebuild(self) -> None:
+        """
+        丢弃墓碑节点，用存活向量重建（存活数达到min_graph_size时建图，否则只压缩）
+        新结构在锁外构建，构建期间的写入记入日志，最后持锁回放并替换
+        """
+        with self._lock:
+            if self._pending is not None:
+                return
+            live = list(self._nodes.items())
+            doc_ids = [doc_id for doc_id, _ in live]
+            vectors = self._matrix[[node for _, node in live]] if live else []
+            deleted_count = self._deleted_count
+            fresh = HNSWIndex(self.dimension, self.M, self.ef_construction, self.ef_search,
+                              self.rebuild_threshold, self.min_graph_size,
+                              seed=int(self._rng.integers(2 ** 31)), initial_capacity=len(live) or self._capacity)
+            self._pending = []
+
+        logger.info(f"Rebuilding HNSW index: {len(live)} live, {deleted_count} deleted")
+        try:
+            fresh._graph_ready = len(live) >= self._graph_threshold()
+            for doc_id, vector in zip(doc_ids, vectors):
+                fresh._insert(doc_id, vector)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            pending, self._pending = self._pending, None
+            for op, doc_id, vector in pending:
+                if op == "add":
+                    fresh._insert(doc_id, vector)
+                else:
+                    fresh._remove_node(doc_id)
+            self._adopt(fresh)
+            logger.info(f"Rebuilt HNSW index: {len(fresh)} vectors, {len(pending)} writes replayed")
+
+    def _adopt(self, other: "HNSWIndex"):
+        """换用另一个索引的数据结构（调用方持有锁）"""
+        self._matrix = other._matrix
+        self._ids, self._nodes, self._levels, self._neighbors = other._ids, other._nodes, other._levels, other._neighbors
+        self._deleted, self._deleted_count = other._deleted, other._deleted_count
+        self._graph_ready, self._entry, self._max_level = other._graph_ready, other._entry, other._max_level
+        self._links0, self._visit_marks, self._visit_tag = other._links0, other._visit_marks, other._visit_tag
+
+    def search(self, query_vector, top_k: int = 10,
+               candidate_ids: Iterable[Any] = None,
+               similarity_threshold: float = None,
+               ef_search: int = None) -> List[Tuple[Any, float]]:
+        """
+        近似余弦相似度检索（未建图时为精确检索）
+        candidate_ids: 只在这些文档中检索；给定时对候选集做精确打分
+        ef_search: 覆盖本次查询的候选集大小
+        返回 [(doc_id, similarity), ...]，按相似度降序
+        """
+        query = normalize_vectors(query_vector)[0]
+
+        with self._lock:
+            if not self._nodes:
+                return []
+            if query.shape[0] != self.dimension:
+                raise ValueError(f"查询向量维度应为{self.dimension}，实际为{query.shape[0]}")
+
+            if candidate_ids is not None:
+                nodes = np.array([self._nodes[i] for i in candidate_ids if i in self._nodes], dtype=np.int64)
+                scores = self._matrix[nodes] @ query
+                found = [(float(scores[i]), int(nodes[i])) for i in top_k_indices(scores, top_k)]
+            elif not self._graph_ready:
+                found = self._exact_top_k(self._matrix[:len(self._ids)] @ query, top_k)
+            else:
+                entry_points = [self._entry]
+                for layer in range(self._max_level, 0, -1):
+                    entry_points = [max(self._search_layer(query, entry_points, 1, layer))[1]]
+                ef = max(ef_search or self.ef_search, top_k)
+                found = sorted(self._search_layer(query, entry_points, ef, 0), reverse=True)
+
+            return self._collect(found, top_k, similarity_threshold)
+
+    def _exact_top_k(self, scores: np.ndarray, top_k: int) -> List[Tuple[float, int]]:
+        """对全部节点的分数取top_k，墓碑节点排除在外（调用方持有锁）"""
+        scores[self._deleted[:len(self._ids)]] = -np.inf
+        return [(float(scores[i]), int(i)) for i in top_k_indices(scores, top_k)]
+
+    def _collect(self, found: List[Tuple[float, int]], top_k: int,
+                 similarity_threshold: float = None) -> List[Tuple[Any, float]]:
+        """把按相似度降序的(相似度, 节点)转成结果，跳过墓碑并应用阈值（调用方持有锁）"""
+        results = []
+        for sim, node in found:
+            if self._deleted[node]:
+                continue
+            if similarity_threshold is not None and sim < similarity_threshold:
+                break
+            results.append((self._ids[node], float(sim)))
+            if len(results) >= top_k:
+                break
+        return results
+
+    def search_many(self, query_vectors, top_k: int = 10,
+                    candidate_ids_list: List[Optional[Iterable[Any]]] = None,
+                    similarity_threshold: float = None) -> List[List[Tuple[Any, float]]]:
+        """
+        批量检索，返回与查询顺序一致的结果列表
+        未建图时不带候选集的查询与向量矩阵分块做矩阵乘；图检索和带候选集的查询逐个进行
+        """
+        if candidate_ids_list is None:
+            candidate_ids_list = [None] * len(query_vectors)
+        if len(candidate_ids_list) != len(query_vectors):
+            raise ValueError("candidate_ids_list和query_vectors长度不一致")
+
+        with self._lock:
+            if self._graph_ready or not self._nodes:
+                return [
+                    self.search(query, top_k, candidate_ids, similarity_threshold)
+                    for query, candidate_ids in zip(query_vectors, candidate_ids_list)
+                ]
+
+            queries = normalize_vectors(query_vectors)
+            if queries.shape[1] != self.dimension:
+                raise ValueError(f"查询向量维度应为{self.dimension}，实际为{queries.shape[1]}")
+            results = [None] * len(queries)
+            for i, candidate_ids in enumerate(candidate_ids_list):
+                if candidate_ids is not None:
+                    results[i] = self.search(queries[i], top_k, candidate_ids, similarity_threshold)
+
+            unfiltered = [i for i, candidate_ids in enumerate(candidate_ids_list) if candidate_ids is None]
+            block_size = max(1, SCORE_BLOCK_ELEMENTS // len(self._ids))
+            for start in range(0, len(unfiltered), block_size):
+                block = unfiltered[start:start + block_size]
+                scores = queries[block] @ self._matrix[:len(self._ids)].T
+                for i, row_scores in zip(block, scores):
+                    results[i] = self._collect(self._exact_top_k(row_scores, top_k), top_k, similarity_threshold)
+            return results
+
+    def save(self, path: str) -> None:
+        """把索引快照写入磁盘（先写临时文件再原子替换）"""
+        with self._lock:
+            state = {
+                "version": self.SNAPSHOT_VERSION,
+                "params": {
+                    "dimension": self.dimension,
+                    "M": self.M,
+                    "ef_construction": self.ef_construction,
+                    "ef_search": self.ef_search,
+                    "rebuild_threshold": self.rebuild_threshold,
+                    "min_graph_size": self.min_graph_size,
+                },
+                "matrix": None if self._matrix is None else self._matrix[:len(self._ids)].copy(),
+                "ids": self._ids,
+                "levels": self._levels,
+                "neighbors": self._neighbors,
+                "deleted": self._deleted[:len(self._ids)].tolist(),
+                "graph_ready": self._graph_ready,
+                "entry": self._entry,
+                "max_level": self._max_level,
+                "rng": self._rng.bit_generator.state,
+                "synced_at": self.synced_at,
+            }
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "HNSWIndex":
+        """从磁盘快照加载索引（版本1的快照都已建图）"""
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state.get("version") not in (1, cls.SNAPSHOT_VERSION):
+            raise ValueError(f"Unsupported HNSW snapshot version: {state.get('version')}")
+
+        index = cls(**state["params"])
+        index._matrix = state["matrix"]
+        index._ids = state["ids"]
+        index._levels = state["levels"]
+        index._neighbors = state["neighbors"]
+        index._deleted = np.array(state["deleted"], dtype=bool)
+        index._deleted_count = int(index._deleted.sum())
+        index._visit_marks = np.zeros(len(index._ids), dtype=np.int32)
+        index._links0 = np.full((len(index._ids), index.M0), -1, dtype=np.int32)
+        for node, layers in enumerate(index._neighbors):
+            index._links0[node, :len(layers[0])] = layers[0]
+        index._nodes = {doc_id: node for node, doc_id in enumerate(index._ids) if not index._deleted[node]}
+        index._graph_ready = state.get("graph_ready", True)
+        index._entry = state["entry"]
+        index._max_level = state["max_level"]
+        index._rng.bit_generator.state = state["rng"]
+        index.synced_at = state.get("synced_at")
+        return index
+
+
+def benchmark_recall(num_vectors: int = 20000, dimension: int = 128, num_queries: int = 200,
+                     top_k: int = 10, num_clusters: int = 100,
+                     ef_search_values: Tuple[int, ...] = (16, 32, 64, 128, 256),
+                     M: int = 16, ef_construction: int = 100, seed: int = 0) -> List[Dict[str, float]]:
+    """
+    召回率基准：在聚类合成数据上对比HNSW与精确检索（VectorIndex）
+    返回每个ef_search下的recall@k和平均查询延迟；图检索的延迟低于精确检索的规模才值得建图，
+    据此设置min_graph_size
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(num_clusters, dimension))
+    data = centers[rng.integers(num_clusters, size=num_vectors)] + 0.5 * rng.normal(size=(num_vectors, dimension))
+    queries = centers[rng.integers(num_clusters, size=num_queries)] + 0.5 * rng.normal(size=(num_queries, dimension))
+    doc_ids = list(range(num_vectors))
+
+    exact = VectorIndex()
+    exact.add_many(doc_ids, data)
+    start = time.perf_counter()
+    truth = [{doc_id for doc_id, _ in exact.search(q, top_k)} for q in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / num_queries
+
+    start = time.perf_counter()
+    hnsw = HNSWIndex(M=M, ef_construction=ef_construction, min_graph_size=0)
+    hnsw.bulk_load([(doc_ids, data)])
+    build_s = time.perf_counter() - start
+    print(f"exact: {exact_ms:.2f} ms/query; HNSW build: {build_s:.1f}s for {num_vectors} x {dimension}")
+
+    report = []
+    for ef in ef_search_values:
+        start = time.perf_counter()
+        found = [{doc_id for doc_id, _ in hnsw.search(q, top_k, ef_search=ef)} for q in queries]
+        latency_ms = (time.perf_counter() - start) * 1000 / num_queries
+        recall = float(np.mean([len(f & t) / top_k for f, t in zip(found, truth)]))
+        report.append({"ef_search": ef, "recall": recall, "latency_ms": latency_ms})
+        print(f"ef_search={ef:4d}  recall@{top_k}={recall:.4f}  {latency_ms:.2f} ms/query")
+    return report
+
+
+# 示例用法：python dao/hnsw_index.py
+if __name__ == "__main__":
+    benchmark_recall()
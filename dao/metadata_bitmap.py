@@ -0,0 +1,187 @@
+"""
+Metadata Bitmaps
+元数据位图：为每个(元数据字段, 值)预先维护一个位号集合，等值过滤只需求交，
+不必每次查询都回到MongoDB扫描
+"""
+import threading
+import logging
+from logging import getLogger
+logging.basicConfig(level=logging.INFO)
+logger = getLogger(__name__)
+
+import sys
+sys.path.append(".")
+
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple, Union
+import numpy as np
+
+# 文档数在该值的1/512以下的(字段, 值)用位号集合存储，超过后改用位图；
+# 一个位号在集合中约占60字节，位图每个文档占1/8字节，两者在1/512处持平
+SPARSE_RATIO_SHIFT = 9
+# 文档数不超过该值时总是用集合
+SPARSE_MIN = 64
+
+
+def _bitmap_keys(field: str, value) -> List[Tuple[str, Hashable]]:
+    """值对应的位图键；数组按元素展开（与MongoDB对数组字段的等值匹配一致）"""
+    values = value if isinstance(value, list) else [value]
+    keys = []
+    for item in values:
+        if isinstance(item, (dict, list)):
+            continue
+        try:
+            hash(item)
+        except TypeError:
+            continue
+        # True == 1 在Python中哈希相同，但MongoDB区分布尔值与数字
+        keys.append((field, ("bool", item) if isinstance(item, bool) else item))
+    return keys
+
+
+class MetadataBitmaps:
+    """
+    文档元数据的位图索引
+
+    每个文档分配一个位号（删除后复用）。文档多的(字段, 值)用Python整数位图，
+    文档少的（如时间戳这类几乎每个文档都不同的值）用位号集合，
+    否则每个值的位图都要占到最大位号那么长，总内存随文档数平方增长。
+    只支持顶层字段对标量的等值过滤（含数组包含）；带操作符（如$gt）、嵌套文档或None的过滤
+    返回None，由调用方回退到MongoDB查询。
+    """
+
+    def __init__(self):
+        self._bits: Dict[Any, int] = {}
+        self._doc_ids: List[Any] = []
+        self._free_bits: List[int] = []
+        self._doc_keys: Dict[Any, List[Tuple[str, Hashable]]] = {}
+        self._bitmaps: Dict[Tuple[str, Hashable], Union[int, Set[int]]] = {}
+        self._counts: Dict[Tuple[str, Hashable], int] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._bits)
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self._bits
+
+    @property
+    def ids(self) -> List[Any]:
+        """已登记的文档ID"""
+        return list(self._bits)
+
+    def add(self, doc_id, metadata: Dict[str, Any]) -> None:
+        """登记或覆盖文档的元数据"""
+        with self._lock:
+            self._remove(doc_id)
+            if self._free_bits:
+                bit = self._free_bits.pop()
+                self._doc_ids[bit] = doc_id
+            else:
+                bit = len(self._doc_ids)
+                self._doc_ids.append(doc_id)
+            self._bits[doc_id] = bit
+
+            keys = [key for field, value in (metadata or {}).items() for key in _bitmap_keys(field, value)]
+            self._doc_keys[doc_id] = keys
+            dense_limit = self._dense_limit()
+            for key in keys:
+                entry = self._bitmaps.get(key)
+                count = self._counts.get(key, 0) + 1
+                self._counts[key] = count
+                if entry is None:
+                    self._bitmaps[key] = {bit}
+                elif isinstance(entry, set):
+                    entry.add(bit)
+                    if count > dense_limit:
+                        self._bitmaps[key] = sum(1 << member for member in entry)
+                else:
+                    self._bitmaps[key] = entry | (1 << bit)
+
+    def remove(self, doc_id) -> bool:
+        """删除文档，返回是否存在"""
+        with self._lock:
+            return self._remove(doc_id)
+
+    def _remove(self, doc_id) -> bool:
+        """调用方持有锁"""
+        bit = self._bits.pop(doc_id, None)
+        if bit is None:
+            return False
+        dense_limit = self._dense_limit()
+        for key in self._doc_keys.pop(doc_id, []):
+            count = self._counts[key] - 1
+            if not count:
+                del self._bitmaps[key]
+                del self._counts[key]
+                continue
+            self._counts[key] = count
+            entry = self._bitmaps[key]
+            if isinstance(entry, set):
+                entry.discard(bit)
+            else:
+                entry &= ~(1 << bit)
+                # 留出余量，避免在阈值附近反复转换
+                if count <= dense_limit // 2:
+                    entry = set(self._set_bits(entry).tolist())
+                self._bitmaps[key] = entry
+        self._doc_ids[bit] = None
+        self._free_bits.append(bit)
+        return True
+
+    def supports(self, filters: Dict[str, Any]) -> bool:
+        """过滤条件是否都是位图可以回答的等值条件"""
+        return all(
+            value is not None and not isinstance(value, (dict, list))
+            and not field.startswith("$") and "." not in field
+            for field, value in filters.items()
+        )
+
+    def match(self, filters: Dict[str, Any]) -> Optional[List[Any]]:
+        """
+        满足所有等值条件的文档ID
+        返回None表示过滤条件不受支持，需要回退到MongoDB
+        """
+        if not self.supports(filters):
+            return None
+
+        with self._lock:
+            entries = []
+            for field, value in filters.items():
+                keys = _bitmap_keys(field, value)
+                entry = self._bitmaps.get(keys[0]) if keys else None
+                if not entry:
+                    return []
+                entries.append(entry)
+            if not entries:
+                return list(self._bits)
+
+            sparse = sorted((entry for entry in entries if isinstance(entry, set)), key=len)
+            dense = [entry for entry in entries if not isinstance(entry, set)]
+            if sparse:
+                # 从最小的集合出发，逐个检查其余条件
+                bits = set(sparse[0]).intersection(*sparse[1:])
+                for bitmap in dense:
+                    bits = {bit for bit in bits if bitmap & (1 << bit)}
+                return [self._doc_ids[bit] for bit in sorted(bits)]
+
+            result = dense[0]
+            for bitmap in dense[1:]:
+                result &= bitmap
+                if not result:
+                    return []
+            return [self._doc_ids[bit] for bit in self._set_bits(result)]
+
+    def memory_bytes(self) -> int:
+        """位图和位号集合占用的字节数（估算）"""
+        with self._lock:
+            return sum(sys.getsizeof(entry) for entry in self._bitmaps.values())
+
+    def _dense_limit(self) -> int:
+        """(字段, 值)的文档数超过该值时改用位图。调用方持有锁"""
+        return max(SPARSE_MIN, len(self._doc_ids) >> SPARSE_RATIO_SHIFT)
+
+    @staticmethod
+    def _set_bits(bitmap: int) -> np.ndarray:
+        """位图中为1的位号"""
+        raw = np.frombuffer(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little"), dtype=np.uint8)
+        return np.flatnonzero(np.unpackbits(raw, bitorder="little"))
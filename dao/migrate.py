@@ -0,0 +1,31 @@
+"""
+数据迁移入口：部署新版本时运行一次，建索引并补写旧数据
+    python dao/migrate.py
+    python dao/migrate.py --dedupe   # 唯一索引建立之前有重复会话时，先合并并标记duplicate_of
+"""
+import argparse
+import logging
+from logging import getLogger
+logging.basicConfig(level=logging.INFO)
+logger = getLogger(__name__)
+
+import sys
+sys.path.append(".")
+
+from conf.config import CONF
+from dao.conversation_dao import ConversationDAO
+from dao.user_dao import UserDAO
+
+
+def migrate(db_name: str = CONF["mongodb"]["mongodb_name"], dedupe: bool = False) -> None:
+    """建users和conversations的索引，为旧单聊补写private_key；dedupe见ConversationDAO.dedupe_conversations"""
+    UserDAO(db_name=db_name).create_indexes()
+    backfilled = ConversationDAO(db_name=db_name).migrate(dedupe=dedupe)
+    logger.info(f"Migration finished, private_key backfilled on {backfilled} conversation(s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="建索引并补写旧数据")
+    parser.add_argument("--dedupe", action="store_true", help="建唯一索引之前合并重复会话（保留文档，标记duplicate_of）")
+    args = parser.parse_args()
+    migrate(dedupe=args.dedupe)
@@ -4,6 +4,10 @@ MongoDB Vector Database Library
 """
 import os
 import time
+import threading
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import traceback
 import logging
@@ -15,20 +19,103 @@ import sys
 sys.path.append(".")
 
 import pymongo
-from pymongo import MongoClient
-from typing import Dict, List, Any, Optional, Union, Tuple
+from pymongo import ReturnDocument, UpdateOne
+from typing import Dict, List, Any, Optional, Union, Tuple, Iterator
 import numpy as np
 from bson import ObjectId
 
 from conf.config import CONF
+from dao.vector_index import VectorIndex
+from dao.hnsw_index import HNSWIndex
+from dao.embedding_store import EmbeddingStore
+from dao.quantized_index import QuantizedVectorIndex
+from dao.text_index import TextIndex, TEXT_SEARCH_MODES
+from dao.hybrid_fusion import hybrid_rank, FUSION_METHODS
+from dao.metadata_bitmap import MetadataBitmaps
+from dao.client_registry import SharedClientMixin
+from dao.vector_codec import (
+    EMBEDDING_ENCODINGS, EMBEDDING_TYPES, encode_vector, decode_vector, decode_embedding_fields, vector_encoding
+)
 
-class MongoDBBase:
+EMBEDDING_FIELDS = ["key_embedding", "value_embedding"]
+TEXT_FIELDS = ["key", "value"]
+# 不取回向量字段的投影：只需要文本和元数据时避免传输和解码两个1536维数组
+EXCLUDE_EMBEDDINGS = {field: 0 for field in EMBEDDING_FIELDS}
+
+# 按检索结果取回文档时每次$in查询最多的ID数
+FETCH_CHUNK_MAX = 1000
+
+# 进程内索引（向量、文本、元数据位图）依赖的字段；写入这些字段时更新updated_at并增加集合的版本号
+INDEXED_FIELDS = TEXT_FIELDS + EMBEDDING_FIELDS + ["metadata"]
+INDEXED_PROJECTION = {field: 1 for field in INDEXED_FIELDS}
+# 每个集合的写入版本号：{_id: 集合名, version: 写入次数, deletes: 删除次数}，
+# 检索前比较版本号即可发现其他进程或其他方法的写入
+INDEX_VERSIONS_COLLECTION = "index_versions"
+# 增量同步按updated_at回看的余量，容忍各进程之间的时钟偏差
+SYNC_CLOCK_SKEW = timedelta(seconds=5)
+# VectorDB批量检索时标记结果属于哪个查询的临时字段
+BATCH_QUERY_FIELD = "_batch_query"
+
+class MongoDBBase(SharedClientMixin):
     """MongoDB基础类"""
     
     def __init__(self, connection_string: str = "mongodb://" + CONF["mongodb"]["mongodb_ip"] + ":" + CONF["mongodb"]["mongodb_port"] + "/", 
-                 db_name: str = CONF["mongodb"]["mongodb_name"]):
-        self.client = MongoClient(connection_string)
-        self.db = self.client[db_name]
+                 db_name: str = CONF["mongodb"]["mongodb_name"],
+                 vector_index_type: str = "flat", vector_index_dir: str = None,
+                 hnsw_params: Dict[str, Any] = None, embedding_encoding: str = "array",
+                 vector_partition_field: str = None, max_loaded_partitions: int = 256,
+                 client_options: Dict[str, Any] = None, index_refresh_interval: Optional[float] = 1.0):
+        """
+        连接使用client_registry中按URI共享的MongoClient，首次操作时才连接
+        client_options: MongoClient参数（如 maxPoolSize、minPoolSize、超时），覆盖默认值和配置文件
+        vector_index_type: 进程内向量索引类型，"flat"（精确）、"hnsw"（近似最近邻）、
+            "mmap"（精确，向量缓存在vector_index_dir下的内存映射文件中，多进程共享）
+            或 "int8"/"float16"（量化常驻，检索时按需从MongoDB取回全精度向量精排）
+        vector_index_dir: 索引快照/向量缓存目录（文本索引快照也存放于此），启动时从中加载，
+            为None时不持久化（"mmap"必须提供）
+        hnsw_params: HNSWIndex参数，例如 {"M": 16, "ef_construction": 100, "ef_search": 64, "min_graph_size": 2000}，
+            存活向量数低于min_graph_size（默认按维度推算）时不建图、精确检索
+        embedding_encoding: 新写入向量的存储格式，"array"（double数组）、"float32" 或 "float16"（二进制）；
+            读取时两种格式都能识别
+        vector_partition_field: 分区字段（metadata下的键，如 "user_id"）。过滤条件包含该字段时，
+            只在该分区自己的向量索引中检索，代价与分区大小成正比
+        max_loaded_partitions: 内存中保留的分区索引数，超出时按LRU淘汰
+        index_refresh_interval: 检索前检查集合写入版本号的最小间隔（秒）。版本号变化时已加载的索引
+            增量同步其他进程和通用写方法（insert_one、update_one等）的写入；0表示每次检索都检查，
+            None表示不检查，只同步本对象向量方法的写入
+        """
+        if vector_index_type not in ["flat", "hnsw", "mmap", "int8", "float16"]:
+            raise ValueError("vector_index_type must be 'flat', 'hnsw', 'mmap', 'int8' or 'float16'")
+        if vector_index_type == "mmap" and not vector_index_dir:
+            raise ValueError("vector_index_type 'mmap' requires vector_index_dir")
+        if embedding_encoding not in EMBEDDING_ENCODINGS:
+            raise ValueError(f"embedding_encoding must be one of {EMBEDDING_ENCODINGS}")
+        
+        self._init_client(connection_string, db_name, client_options)
+        # 进程内向量索引，按(集合, 向量字段)懒加载
+        self.vector_index_type = vector_index_type
+        self.vector_index_dir = vector_index_dir
+        self.hnsw_params = hnsw_params or {}
+        self.embedding_encoding = embedding_encoding
+        self._vector_indexes: Dict[Tuple[str, str], Union[VectorIndex, HNSWIndex, EmbeddingStore]] = {}
+        self._vector_indexes_lock = threading.Lock()
+        # 进程内文本倒排索引，按(集合, 文本字段)懒加载
+        self._text_indexes: Dict[Tuple[str, str], TextIndex] = {}
+        self._text_indexes_lock = threading.Lock()
+        # 分区向量索引，按(集合, 向量字段, 分区值)懒加载，LRU淘汰
+        self.vector_partition_field = vector_partition_field
+        self.max_loaded_partitions = max_loaded_partitions
+        self._partition_indexes: "OrderedDict[Tuple[str, str, Any], VectorIndex]" = OrderedDict()
+        self._partition_indexes_lock = threading.Lock()
+        # 元数据位图，按集合懒加载
+        self._metadata_bitmaps: Dict[str, MetadataBitmaps] = {}
+        self._metadata_bitmaps_lock = threading.Lock()
+        # 混合检索各路并发执行用的线程池，首次使用时创建
+        self._search_executor: Optional[ThreadPoolExecutor] = None
+        # 各集合已加载索引的同步状态（已同步的版本号、时间等），首次加载索引时创建
+        self.index_refresh_interval = index_refresh_interval
+        self._index_sync: Dict[str, Dict[str, Any]] = {}
+        self._index_sync_lock = threading.Lock()
         
     def get_collection(self, collection_name: str):
         """获取指定集合"""
@@ -36,48 +123,98 @@ class MongoDBBase:
     
     def insert_one(self, collection_name: str, document: Dict) -> str:
         """插入单个文档"""
+        indexed = self._stamp_document(document)
         result = self.db[collection_name].insert_one(document)
+        if indexed:
+            self._record_write(collection_name)
         return str(result.inserted_id)
     
     def insert_many(self, collection_name: str, documents: List[Dict]) -> List[str]:
         """插入多个文档"""
+        indexed = [self._stamp_document(document) for document in documents]
         result = self.db[collection_name].insert_many(documents)
+        if any(indexed):
+            self._record_write(collection_name)
         return [str(id) for id in result.inserted_ids]
     
-    def find_one(self, collection_name: str, query: Dict) -> Dict:
-        """查找单个文档"""
-        return self.db[collection_name].find_one(query)
+    def find_one(self, collection_name: str, query: Dict, projection: Dict = None, raw: bool = False) -> Dict:
+        """
+        查找单个文档
+        projection: 返回字段，如 {"key": 1} 或 EXCLUDE_EMBEDDINGS
+        raw: 返回只读的RawBSONDocument，首次访问字段时才解码；适合原样转发的文档，跳过大字段请用projection
+        """
+        return self._read_collection(collection_name, raw).find_one(query, projection)
+    
+    def find_many(self, collection_name: str, query: Dict, limit: int = 0, sort=None,
+                  projection: Dict = None, raw: bool = False) -> List[Dict]:
+        """查找多个文档，projection/raw 同 find_one"""
+        return list(self.iter_many(collection_name, query, limit, sort, projection, raw=raw))
     
-    def find_many(self, collection_name: str, query: Dict, limit: int = 0) -> List[Dict]:
-        """查找多个文档"""
-        cursor = self.db[collection_name].find(query)
+    def iter_many(self, collection_name: str, query: Dict, limit: int = 0, sort=None,
+                  projection: Dict = None, batch_size: int = 1000, raw: bool = False) -> Iterator[Dict]:
+        """
+        逐条迭代查询结果，每批从服务器取batch_size条，适合大范围扫描（导出、重建索引等）
+        其余参数同 find_many
+        """
+        cursor = self._read_collection(collection_name, raw).find(query, projection)
+        if sort:
+            cursor = cursor.sort(sort)
         if limit > 0:
             cursor = cursor.limit(limit)
-        return list(cursor)
+        return self._iter_cursor(cursor, batch_size)
+    
+    def find_one_and_update(self, collection_name: str, query: Dict, update: Dict,
+                            sort=None, upsert: bool = False, projection: Dict = None) -> Optional[Dict]:
+        """原子地查找并更新单个文档，返回更新后的文档"""
+        indexed = self._update_touches_indexed_fields(update)
+        document = self.db[collection_name].find_one_and_update(
+            query, self._stamp_update(update) if indexed else update,
+            projection=projection,
+            sort=sort,
+            upsert=upsert,
+            return_document=ReturnDocument.AFTER
+        )
+        if indexed and document is not None:
+            self._record_write(collection_name)
+        return document
     
     def update_one(self, collection_name: str, query: Dict, update: Dict) -> int:
         """更新单个文档"""
-        result = self.db[collection_name].update_one(query, update)
+        indexed = self._update_touches_indexed_fields(update)
+        result = self.db[collection_name].update_one(query, self._stamp_update(update) if indexed else update)
+        if indexed and result.matched_count:
+            self._record_write(collection_name)
         return result.modified_count
     
     def update_many(self, collection_name: str, query: Dict, update: Dict) -> int:
         """更新多个文档"""
-        result = self.db[collection_name].update_many(query, update)
+        indexed = self._update_touches_indexed_fields(update)
+        result = self.db[collection_name].update_many(query, self._stamp_update(update) if indexed else update)
+        if indexed and result.matched_count:
+            self._record_write(collection_name)
         return result.modified_count
     
     def replace_one(self, collection_name: str, query: Dict, update: Dict) -> int:
         """替换单个文档"""
+        indexed = self._stamp_document(update)
         result = self.db[collection_name].replace_one(query, update)
+        if result.matched_count:
+            # 被替换的文档可能带有索引字段，只在集合已有版本号（有进程加载过索引）时记录
+            self._record_write(collection_name, create=indexed)
         return result.modified_count
     
     def delete_one(self, collection_name: str, query: Dict) -> int:
         """删除单个文档"""
         result = self.db[collection_name].delete_one(query)
+        if result.deleted_count:
+            self._record_write(collection_name, deleted=True, create=False)
         return result.deleted_count
     
     def delete_many(self, collection_name: str, query: Dict) -> int:
-        """删除多个文档"""
+        """删除多个文档，已加载的索引在下次检索前删除这些文档"""
         result = self.db[collection_name].delete_many(query)
+        if result.deleted_count:
+            self._record_write(collection_name, deleted=True, create=False)
         return result.deleted_count
     
     def count_documents(self, collection_name: str, query: Dict = None) -> int:
@@ -93,6 +230,10 @@ class MongoDBBase:
     def drop_collection(self, collection_name: str):
         """删除集合"""
         self.db.drop_collection(collection_name)
+        self._record_write(collection_name, deleted=True, create=False)
+        self.refresh_vector_index(collection_name)
+        self.refresh_text_index(collection_name)
+        self.refresh_metadata_bitmaps(collection_name)
     
     def list_collections(self) -> List[str]:
         """列出所有集合"""
@@ -100,11 +241,17 @@ class MongoDBBase:
     
     def aggregate(self, collection_name: str, pipeline: List[Dict]) -> List[Dict]:
         """聚合查询"""
-        return list(self.db[collection_name].aggregate(pipeline))
+        return list(self.iter_aggregate(collection_name, pipeline))
+    
+    def iter_aggregate(self, collection_name: str, pipeline: List[Dict], batch_size: int = 1000) -> Iterator[Dict]:
+        """逐条迭代聚合结果，每批从服务器取batch_size条"""
+        cursor = self.db[collection_name].aggregate(pipeline, batchSize=batch_size)
+        return self._iter_cursor(cursor, batch_size)
     
     def close(self):
-        """关闭连接"""
-        self.client.close()
+        """释放本对象的资源；共享的MongoClient由client_registry.close_all_clients关闭"""
+        if self._search_executor is not None:
+            self._search_executor.shutdown(wait=False)
     
     # 向量库
     def create_vector_collection(self, collection_name: str, create_indexes: bool = True) -> None:
@@ -121,6 +268,11 @@ class MongoDBBase:
             # 为文本字段创建索引
             collection.create_index("key")
             collection.create_index("value")
+            # 增量同步按updated_at读取变更的文档
+            collection.create_index("updated_at")
+            # 分区字段索引：分区加载只读取该分区的文档
+            if self.vector_partition_field:
+                collection.create_index(f"metadata.{self.vector_partition_field}")
             # 为向量字段创建索引 (MongoDB 5.0+支持向量索引)
             # 如果使用MongoDB 5.0+并支持向量索引，可以添加向量索引
             # collection.create_index([("key_embedding", "vector")])
@@ -140,33 +292,45 @@ class MongoDBBase:
         document = {
             "key": key,
             "value": value,
-            "key_embedding": key_embedding,
-            "value_embedding": value_embedding,
-            "metadata": metadata
+            "key_embedding": encode_vector(key_embedding, self.embedding_encoding),
+            "value_embedding": encode_vector(value_embedding, self.embedding_encoding),
+            "metadata": metadata,
+            "updated_at": datetime.now()
         }
         
         # 插入文档并返回ID
         result = self.db[collection_name].insert_one(document)
+        self._sync_vector_indexes(collection_name, result.inserted_id, document)
+        self._sync_text_indexes(collection_name, result.inserted_id, document)
+        self._sync_metadata(collection_name, result.inserted_id, document)
+        self._record_write(collection_name, synced=True)
         return str(result.inserted_id)
     
-    def get_vector_by_id(self, collection_name: str, doc_id: str) -> Dict:
+    def get_vector_by_id(self, collection_name: str, doc_id: str, include_embeddings: bool = True) -> Dict:
         """
         通过ID获取向量文档
+        二进制编码的向量以numpy float32数组返回
+        include_embeddings: 为False时不取回向量字段
         """
-        result = self.db[collection_name].find_one({"_id": ObjectId(doc_id)})
-        return result
+        result = self.db[collection_name].find_one({"_id": ObjectId(doc_id)}, self._embedding_projection(include_embeddings))
+        return decode_embedding_fields(result, EMBEDDING_FIELDS)
     
-    def get_vectors_by_text(self, collection_name: str, field: str, text: str) -> List[Dict]:
+    def get_vectors_by_text(self, collection_name: str, field: str, text: str,
+                            include_embeddings: bool = True) -> List[Dict]:
         """
         通过文本内容获取向量文档
         field: "key" 或 "value"
+        include_embeddings: 为False时不取回向量字段
         """
-        if field not in ["key", "value"]:
+        if field not in TEXT_FIELDS:
             raise ValueError("field must be 'key' or 'value'")
         
-        # 使用正则表达式进行部分匹配
-        query = {field: {"$regex": text, "$options": "i"}}
-        results = list(self.db[collection_name].find(query))
+        # 部分匹配（不区分大小写）由文本倒排索引完成
+        hits = self.get_text_index(collection_name, field).search(text)
+        results = [
+            decode_embedding_fields(doc, EMBEDDING_FIELDS)
+            for doc in self._fetch_documents(collection_name, hits, projection=self._embedding_projection(include_embeddings))
+        ]
         return results
     
     def update_vector(self, collection_name: str, doc_id: str, 
@@ -186,19 +350,26 @@ class MongoDBBase:
         if value is not None:
             update_fields["value"] = value
         if key_embedding is not None:
-            update_fields["key_embedding"] = key_embedding
+            update_fields["key_embedding"] = encode_vector(key_embedding, self.embedding_encoding)
         if value_embedding is not None:
-            update_fields["value_embedding"] = value_embedding
+            update_fields["value_embedding"] = encode_vector(value_embedding, self.embedding_encoding)
         if metadata is not None:
             update_fields["metadata"] = metadata
         
         if not update_fields:
             return False
+        update_fields["updated_at"] = datetime.now()
         
         result = self.db[collection_name].update_one(
             {"_id": ObjectId(doc_id)},
             {"$set": update_fields}
         )
+        # 文档不存在时不能写入索引，否则检索会命中不存在的文档
+        if result.matched_count:
+            self._sync_vector_indexes(collection_name, ObjectId(doc_id), update_fields)
+            self._sync_text_indexes(collection_name, ObjectId(doc_id), update_fields)
+            self._sync_metadata(collection_name, ObjectId(doc_id), update_fields)
+            self._record_write(collection_name, synced=True)
         
         return result.modified_count > 0
     
@@ -212,12 +383,22 @@ class MongoDBBase:
         update_dict = {}
         for key, value in metadata_updates.items():
             update_dict[f"metadata.{key}"] = value
+        update_dict["updated_at"] = datetime.now()
         
         result = self.db[collection_name].update_one(
             {"_id": ObjectId(doc_id)},
             {"$set": update_dict}
         )
         
+        if result.modified_count and (collection_name in self._metadata_bitmaps
+                                      or self.vector_partition_field in metadata_updates):
+            # 位图需要完整的metadata
+            doc = self.db[collection_name].find_one({"_id": ObjectId(doc_id)}, {"metadata": 1})
+            if doc is not None:
+                self._sync_metadata(collection_name, ObjectId(doc_id), doc)
+        if result.modified_count:
+            self._record_write(collection_name, synced=True)
+        
         return result.modified_count > 0
     
     def delete_vector(self, collection_name: str, doc_id: str) -> bool:
@@ -226,8 +407,58 @@ class MongoDBBase:
         返回是否成功删除
         """
         result = self.db[collection_name].delete_one({"_id": ObjectId(doc_id)})
+        for index in (self._loaded_vector_indexes(collection_name) + self._loaded_text_indexes(collection_name)
+                      + self._loaded_partition_indexes(collection_name)):
+            index.remove(ObjectId(doc_id))
+        bitmaps = self._metadata_bitmaps.get(collection_name)
+        if bitmaps is not None:
+            bitmaps.remove(ObjectId(doc_id))
+        if result.deleted_count:
+            self._record_write(collection_name, deleted=True, synced=True)
         return result.deleted_count > 0
     
+    def migrate_embedding_encoding(self, collection_name: str, encoding: str = None,
+                                   fields: List[str] = None, batch_size: int = 1000) -> int:
+        """
+        把集合中的向量字段改写为指定存储格式（默认为embedding_encoding）
+        可重复执行，已是目标格式的字段不会被改写
+        返回被修改的文档数
+        """
+        encoding = encoding or self.embedding_encoding
+        fields = fields or EMBEDDING_FIELDS
+        
+        collection = self.db[collection_name]
+        cursor = collection.find(
+            {"$or": [{field: EMBEDDING_TYPES} for field in fields]},
+            {field: 1 for field in fields}
+        ).batch_size(batch_size)
+        
+        modified = 0
+        operations = []
+        for doc in cursor:
+            update_fields = {}
+            for field in fields:
+                value = doc.get(field)
+                if value is None:
+                    continue
+                if vector_encoding(value) != encoding:
+                    update_fields[field] = encode_vector(value, encoding)
+            if update_fields:
+                update_fields["updated_at"] = datetime.now()
+                operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": update_fields}))
+        
+            if len(operations) >= batch_size:
+                modified += collection.bulk_write(operations, ordered=False).modified_count
+                operations = []
+        
+        if operations:
+            modified += collection.bulk_write(operations, ordered=False).modified_count
+        
+        if modified:
+            self._record_write(collection_name)
+        logger.info(f"Migrated {modified} documents in {collection_name} to {encoding} embeddings")
+        return modified
+    
     def _cosine_similarity(self, vec1: List[float], vec2: List[float]) -> float:
         """
         计算两个向量的余弦相似度
@@ -249,98 +480,832 @@ class MongoDBBase:
                      embedding_field: str = "key_embedding",
                      metadata_filters: Dict[str, Any] = None,
                      top_k: int = 10,
-                     similarity_threshold: float = 0.0) -> List[Dict]:
+                     similarity_threshold: float = 0.0,
+                     include_embeddings: bool = True) -> List[Dict]:
         """
         向量相似度搜索
         embedding_field: "key_embedding" 或 "value_embedding"
         metadata_filters: 元数据过滤条件，格式为 {"字段名": 值}
         top_k: 返回的最大结果数量
         similarity_threshold: 相似度阈值，只返回相似度大于此值的结果
+        include_embeddings: 为False时结果文档不含向量字段
         """
-        if embedding_field not in ["key_embedding", "value_embedding"]:
+        if embedding_field not in EMBEDDING_FIELDS:
             raise ValueError("embedding_field must be 'key_embedding' or 'value_embedding'")
         
-        # 构建查询条件
-        query = {}
-        if metadata_filters:
-            for key, value in metadata_filters.items():
-                query[f"metadata.{key}"] = value
+        # 元数据过滤得到分区索引和/或候选集，交给向量索引
+        index, candidate_ids = self._resolve_vector_scope(collection_name, embedding_field, metadata_filters)
+        hits = index.search(query_embedding, top_k, candidate_ids, similarity_threshold)
+        return self._fetch_scored_documents(collection_name, hits, self._embedding_projection(include_embeddings))
+    
+    def batch_vector_search(self, collection_name: str,
+                            query_embeddings: List[List[float]],
+                            embedding_field: str = "key_embedding",
+                            metadata_filters: Union[Dict[str, Any], List[Dict[str, Any]]] = None,
+                            top_k: int = 10,
+                            similarity_threshold: float = 0.0,
+                            include_embeddings: bool = True) -> List[List[Dict]]:
+        """
+        批量向量相似度搜索：落在同一个索引上的查询与向量矩阵一次矩阵乘完成打分，结果按输入顺序返回
+        metadata_filters: 所有查询共用一个过滤条件，或与查询一一对应的过滤条件列表；
+            与vector_search一样按过滤条件选择分区索引和候选集，相同的过滤条件只解析一次
+        所有结果文档只取回一次
+        include_embeddings: 为False时结果文档不含向量字段
+        """
+        if embedding_field not in EMBEDDING_FIELDS:
+            raise ValueError("embedding_field must be 'key_embedding' or 'value_embedding'")
+        if not query_embeddings:
+            return []
         
-        # 获取所有符合条件的文档
-        cursor = self.db[collection_name].find(query)
+        if isinstance(metadata_filters, list):
+            if len(metadata_filters) != len(query_embeddings):
+                raise ValueError("metadata_filters和query_embeddings长度不一致")
+            filters_list = metadata_filters
+        else:
+            filters_list = [metadata_filters] * len(query_embeddings)
         
-        # 计算相似度并排序
-        results = []
-        for doc in cursor:
-            if embedding_field in doc and isinstance(doc[embedding_field], list):
-                similarity = self._cosine_similarity(query_embedding, doc[embedding_field])
-                
-                if similarity >= similarity_threshold:
-                    # 添加相似度到结果中
-                    doc_with_score = dict(doc)
-                    doc_with_score["similarity"] = similarity
-                    results.append(doc_with_score)
+        # 按(索引, 查询下标)分组，每个索引上的查询一起检索
+        scopes_by_filter = {}
+        groups = {}
+        for i, filters in enumerate(filters_list):
+            filter_key = repr(sorted(filters.items())) if filters else None
+            if filter_key not in scopes_by_filter:
+                scopes_by_filter[filter_key] = self._resolve_vector_scope(collection_name, embedding_field, filters)
+            index, candidate_ids = scopes_by_filter[filter_key]
+            groups.setdefault(id(index), (index, []))[1].append((i, candidate_ids))
         
-        # 按相似度降序排序
-        results.sort(key=lambda x: x["similarity"], reverse=True)
+        hits_list = [None] * len(query_embeddings)
+        for index, members in groups.values():
+            group_hits = index.search_many([query_embeddings[i] for i, _ in members], top_k,
+                                           [candidate_ids for _, candidate_ids in members], similarity_threshold)
+            for (i, _), hits in zip(members, group_hits):
+                hits_list[i] = hits
         
-        # 返回前top_k个结果
-        return results[:top_k]
+        # 所有查询的结果文档一次取回，每个查询得到各自的副本
+        docs = {doc["_id"]: doc for doc in self._fetch_scored_documents(
+            collection_name, [(doc_id, 0.0) for doc_id in {doc_id for hits in hits_list for doc_id, _ in hits}],
+            self._embedding_projection(include_embeddings)
+        )}
+        return [
+            [{**docs[doc_id], "similarity": similarity} for doc_id, similarity in hits if doc_id in docs]
+            for hits in hits_list
+        ]
     
     def combined_search(self, collection_name: str,
                        text_query: str = None, text_field: str = "key",
                        query_embedding: List[float] = None, embedding_field: str = "key_embedding",
                        metadata_filters: Dict[str, Any] = None,
                        top_k: int = 10,
-                       similarity_threshold: float = 0.0) -> List[Dict]:
+                       similarity_threshold: float = 0.0,
+                       include_embeddings: bool = True) -> List[Dict]:
         """
         组合搜索：支持文本查询和向量查询的结合
+        文本查询为不区分大小写的子串匹配，由文本倒排索引完成
+        include_embeddings: 为False时结果文档不含向量字段
         """
+        projection = self._embedding_projection(include_embeddings)
+        
         # 构建基础查询条件
         query = {}
         
-        # 添加文本查询条件
-        if text_query and text_field in ["key", "value"]:
-            query[text_field] = {"$regex": text_query, "$options": "i"}
-        
         # 添加元数据过滤条件
         if metadata_filters:
             for key, value in metadata_filters.items():
                 query[f"metadata.{key}"] = value
         
-        # 执行查询
-        cursor = self.db[collection_name].find(query)
+        # 文本查询：从倒排索引得到按BM25排序的候选
+        text_hits = None
+        if text_query and text_field in TEXT_FIELDS:
+            text_hits = self.get_text_index(collection_name, text_field).search(text_query)
         
         # 如果有向量查询
-        if query_embedding and embedding_field in ["key_embedding", "value_embedding"]:
-            # 计算相似度并排序
-            results = []
-            for doc in cursor:
-                if embedding_field in doc and isinstance(doc[embedding_field], list):
-                    similarity = self._cosine_similarity(query_embedding, doc[embedding_field])
-                    
-                    if similarity >= similarity_threshold:
-                        # 添加相似度到结果中
-                        doc_with_score = dict(doc)
-                        doc_with_score["similarity"] = similarity
-                        results.append(doc_with_score)
+        if query_embedding and embedding_field in EMBEDDING_FIELDS:
+            # 候选集在内存中求交，不把整个命中列表放进MongoDB查询
+            candidate_ids = self._metadata_candidates(collection_name, metadata_filters) if metadata_filters else None
+            if text_hits is not None:
+                text_ids = [doc_id for doc_id, _ in text_hits]
+                if candidate_ids is None:
+                    candidate_ids = text_ids
+                else:
+                    allowed = set(candidate_ids)
+                    candidate_ids = [doc_id for doc_id in text_ids if doc_id in allowed]
             
-            # 按相似度降序排序
-            results.sort(key=lambda x: x["similarity"], reverse=True)
-            
-            # 返回前top_k个结果
-            return results[:top_k]
+            index = self.get_vector_index(collection_name, embedding_field)
+            hits = index.search(query_embedding, top_k, candidate_ids, similarity_threshold)
+            return self._fetch_scored_documents(collection_name, hits, projection)
+        elif text_hits is not None:
+            # 只有文本和元数据过滤，按BM25排序
+            return self._fetch_documents(collection_name, text_hits, query, top_k, projection=projection)
+        else:
+            # 只有元数据过滤
+            return list(self.db[collection_name].find(query, projection).limit(top_k))
+    
+    def fused_search(self, collection_name: str, text_query: str, query_embedding: List[float],
+                     text_field: str = "key", embedding_field: str = "key_embedding",
+                     metadata_filters: Dict[str, Any] = None, top_k: int = 10,
+                     fusion: str = "rrf", weights: Dict[str, float] = None, rrf_k: int = 60,
+                     candidate_k: int = None, text_mode: str = "keyword",
+                     include_embeddings: bool = True) -> List[Dict]:
+        """
+        本地混合检索：向量索引与文本索引两路并发检索后融合，不依赖Atlas
+        （VectorDB.hybrid_search是基于Atlas $search的另一套实现，参数不同）
+        metadata_filters: 先得到候选集，两路都只在候选集中打分
+        fusion: "rrf"（倒数排名融合）或 "weighted"（min-max归一化后加权）
+        weights: 各路权重，键为 "vector" / "text"
+        candidate_k: 每路参与融合的结果数，默认 max(top_k * 5, 50)
+        返回的文档附带hybrid_score和explanation（各路的排名、原始分数与贡献）
+        include_embeddings: 为False时结果文档不含向量字段
+        """
+        if embedding_field not in EMBEDDING_FIELDS:
+            raise ValueError("embedding_field must be 'key_embedding' or 'value_embedding'")
+        if text_field not in TEXT_FIELDS:
+            raise ValueError("text_field must be 'key' or 'value'")
+        if fusion not in FUSION_METHODS:
+            raise ValueError(f"fusion must be one of {FUSION_METHODS}")
+        
+        candidate_k = candidate_k or max(top_k * 5, 50)
+        candidate_ids = self._metadata_candidates(collection_name, metadata_filters) if metadata_filters else None
+        
+        # 索引在提交到线程池之前加载，避免两路各自触发加载
+        vector_index, vector_candidate_ids = self._resolve_vector_scope(collection_name, embedding_field, metadata_filters)
+        text_index = self.get_text_index(collection_name, text_field)
+        legs = {}
+        if query_embedding is not None:
+            legs["vector"] = lambda: vector_index.search(query_embedding, candidate_k, vector_candidate_ids)
+        if text_query:
+            legs["text"] = lambda: text_index.search(text_query, candidate_k, candidate_ids, mode=text_mode)
+        
+        fused = hybrid_rank(legs, top_k, fusion, weights, rrf_k, executor=self._get_search_executor())
+        docs = self._fetch_documents(collection_name, [(doc_id, score) for doc_id, score, _ in fused],
+                                     score_field="hybrid_score",
+                                     projection=self._embedding_projection(include_embeddings))
+        explanations = {doc_id: explanation for doc_id, _, explanation in fused}
+        for doc in docs:
+            decode_embedding_fields(doc, EMBEDDING_FIELDS)
+            doc["explanation"] = explanations[doc["_id"]]
+        return docs
+    
+    def _get_search_executor(self) -> ThreadPoolExecutor:
+        """混合检索的线程池（懒创建）"""
+        if self._search_executor is None:
+            with self._vector_indexes_lock:
+                if self._search_executor is None:
+                    self._search_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hybrid-search")
+        return self._search_executor
+    
+    def text_search(self, collection_name: str, text_query: str, text_field: str = "key",
+                    mode: str = "substring", metadata_filters: Dict[str, Any] = None,
+                    top_k: int = 10, include_embeddings: bool = True) -> List[Dict]:
+        """
+        文本检索，结果按BM25排序并附上text_score字段
+        mode: "substring"（包含整个查询串）或 "keyword"（命中任一关键词）
+        include_embeddings: 为False时结果文档不含向量字段
+        """
+        if text_field not in TEXT_FIELDS:
+            raise ValueError("text_field must be 'key' or 'value'")
+        if mode not in TEXT_SEARCH_MODES:
+            raise ValueError(f"mode must be one of {TEXT_SEARCH_MODES}")
+        
+        query = {f"metadata.{key}": value for key, value in (metadata_filters or {}).items()}
+        hits = self.get_text_index(collection_name, text_field).search(text_query, mode=mode)
+        return [
+            decode_embedding_fields(doc, EMBEDDING_FIELDS)
+            for doc in self._fetch_documents(collection_name, hits, query, top_k, score_field="text_score",
+                                             projection=self._embedding_projection(include_embeddings))
+        ]
+    
+    def get_vector_index(self, collection_name: str, embedding_field: str) -> Union[VectorIndex, HNSWIndex, EmbeddingStore]:
+        """
+        获取(集合, 向量字段)对应的进程内向量索引，首次访问时从MongoDB加载
+        通过insert_vector/update_vector/delete_vector写入的数据立即同步到已加载的索引；
+        其他进程或其他方法的写入在访问时按index_refresh_interval增量同步
+        """
+        key = (collection_name, embedding_field)
+        index = self._vector_indexes.get(key)
+        if index is not None:
+            self._refresh_indexes(collection_name)
+            return index
+        
+        self._ensure_sync_state(collection_name)
+        with self._vector_indexes_lock:
+            index = self._vector_indexes.get(key)
+            if index is None:
+                index = self._load_vector_index(collection_name, embedding_field)
+                self._vector_indexes[key] = index
+        return index
+    
+    def refresh_vector_index(self, collection_name: str, embedding_field: str = None) -> None:
+        """丢弃已加载的向量索引（含分区索引），下次检索时重新加载"""
+        with self._vector_indexes_lock:
+            for key in list(self._vector_indexes):
+                if key[0] == collection_name and embedding_field in (None, key[1]):
+                    del self._vector_indexes[key]
+        with self._partition_indexes_lock:
+            for key in list(self._partition_indexes):
+                if key[0] == collection_name and embedding_field in (None, key[1]):
+                    del self._partition_indexes[key]
+    
+    def get_partition_index(self, collection_name: str, embedding_field: str, partition_value) -> VectorIndex:
+        """
+        获取一个分区的向量索引，首次访问时只读取该分区的文档（O(分区大小)）
+        内存中最多保留max_loaded_partitions个分区，按最近使用淘汰
+        """
+        key = (collection_name, embedding_field, partition_value)
+        with self._partition_indexes_lock:
+            index = self._partition_indexes.get(key)
+            if index is not None:
+                self._partition_indexes.move_to_end(key)
+        if index is not None:
+            self._refresh_indexes(collection_name)
+            return index
+        
+        self._ensure_sync_state(collection_name)
+        index = self._create_vector_index(collection_name, embedding_field, partition=True)
+        query = {f"metadata.{self.vector_partition_field}": partition_value}
+        for doc_ids, vectors in self._iter_embedding_batches(collection_name, embedding_field, query):
+            index.add_many(doc_ids, vectors)
+        
+        with self._partition_indexes_lock:
+            # 并发加载时保留先放入的那一份
+            index = self._partition_indexes.setdefault(key, index)
+            self._partition_indexes.move_to_end(key)
+            while len(self._partition_indexes) > self.max_loaded_partitions:
+                self._partition_indexes.popitem(last=False)
+        return index
+    
+    def get_metadata_bitmaps(self, collection_name: str) -> MetadataBitmaps:
+        """获取集合的元数据位图，首次访问时从MongoDB读取所有文档的metadata构建"""
+        bitmaps = self._metadata_bitmaps.get(collection_name)
+        if bitmaps is not None:
+            self._refresh_indexes(collection_name)
+            return bitmaps
+        
+        self._ensure_sync_state(collection_name)
+        with self._metadata_bitmaps_lock:
+            bitmaps = self._metadata_bitmaps.get(collection_name)
+            if bitmaps is None:
+                bitmaps = MetadataBitmaps()
+                for doc in self.db[collection_name].find({}, {"metadata": 1}).batch_size(1000):
+                    bitmaps.add(doc["_id"], doc.get("metadata"))
+                self._metadata_bitmaps[collection_name] = bitmaps
+                logger.info(f"Loaded metadata bitmaps {collection_name}: {len(bitmaps)} documents")
+        return bitmaps
+    
+    def refresh_metadata_bitmaps(self, collection_name: str) -> None:
+        """丢弃已加载的元数据位图，下次过滤时重新构建"""
+        with self._metadata_bitmaps_lock:
+            self._metadata_bitmaps.pop(collection_name, None)
+    
+    def _metadata_candidates(self, collection_name: str, metadata_filters: Dict[str, Any]) -> List[Any]:
+        """满足元数据过滤的文档ID：等值条件由位图回答，其他条件回退到MongoDB查询"""
+        candidate_ids = self.get_metadata_bitmaps(collection_name).match(metadata_filters)
+        if candidate_ids is None:
+            query = {f"metadata.{key}": value for key, value in metadata_filters.items()}
+            candidate_ids = [doc["_id"] for doc in self.db[collection_name].find(query, {"_id": 1})]
+        return candidate_ids
+    
+    def _resolve_vector_scope(self, collection_name: str, embedding_field: str,
+                              metadata_filters: Dict[str, Any] = None) -> Tuple[Any, Optional[List[Any]]]:
+        """
+        根据元数据过滤选择要检索的索引和候选集
+        过滤包含分区字段的等值条件时使用该分区的索引，其余条件再在分区内过滤
+        """
+        if not metadata_filters:
+            return self.get_vector_index(collection_name, embedding_field), None
+        
+        partition_value = metadata_filters.get(self.vector_partition_field) if self.vector_partition_field else None
+        if partition_value is not None and not isinstance(partition_value, (dict, list)):
+            index = self.get_partition_index(collection_name, embedding_field, partition_value)
+            if len(metadata_filters) == 1:
+                return index, None
+            return index, self._metadata_candidates(collection_name, metadata_filters)
+        
+        return self.get_vector_index(collection_name, embedding_field), self._metadata_candidates(collection_name, metadata_filters)
+    
+    def save_vector_indexes(self) -> List[str]:
+        """
+        把已加载的索引写入vector_index_dir，返回写入的文件路径
+        HNSW写快照；mmap向量缓存把WAL合并进基础矩阵
+        """
+        if self.vector_index_type not in ["hnsw", "mmap"] or not self.vector_index_dir:
+            return []
+        
+        os.makedirs(self.vector_index_dir, exist_ok=True)
+        saved = []
+        for (collection_name, embedding_field), index in list(self._vector_indexes.items()):
+            path = self._vector_index_snapshot_path(collection_name, embedding_field)
+            index.save(path)
+            saved.append(path)
+            logger.info(f"Saved vector index snapshot {path} ({len(index)} vectors)")
+        return saved
+    
+    def _create_vector_index(self, collection_name: str, embedding_field: str,
+                             partition: bool = False) -> Union[VectorIndex, HNSWIndex]:
+        """
+        按配置创建空的内存向量索引
+        分区索引规模小，"hnsw"/"mmap"配置下也使用精确的VectorIndex
+        """
+        if self.vector_index_type == "hnsw" and not partition:
+            return HNSWIndex(**self.hnsw_params)
+        if self.vector_index_type in ["int8", "float16"]:
+            return QuantizedVectorIndex(
+                quantization=self.vector_index_type,
+                full_vector_loader=lambda doc_ids: self._load_full_vectors(collection_name, embedding_field, doc_ids)
+            )
+        return VectorIndex()
+    
+    def _load_full_vectors(self, collection_name: str, embedding_field: str, doc_ids: List[Any]) -> Dict[Any, np.ndarray]:
+        """按ID取回全精度向量，供量化索引精排"""
+        return {
+            doc["_id"]: decode_vector(doc[embedding_field])
+            for doc in self.db[collection_name].find({"_id": {"$in": list(doc_ids)}, embedding_field: EMBEDDING_TYPES},
+                                                     {embedding_field: 1})
+        }
+    
+    def _vector_index_snapshot_path(self, collection_name: str, embedding_field: str) -> Optional[str]:
+        """HNSW索引快照文件路径，或mmap向量缓存的文件前缀"""
+        if self.vector_index_type not in ["hnsw", "mmap"] or not self.vector_index_dir:
+            return None
+        path = os.path.join(self.vector_index_dir, f"{self.db.name}.{collection_name}.{embedding_field}")
+        return f"{path}.hnsw" if self.vector_index_type == "hnsw" else path
+    
+    def _iter_embedding_batches(self, collection_name: str, embedding_field: str,
+                                query: Dict = None, batch_size: int = 1000):
+        """分批读取(文档ID列表, 向量列表)"""
+        cursor = self.db[collection_name].find(
+            {**(query or {}), embedding_field: EMBEDDING_TYPES},
+            {embedding_field: 1}
+        ).batch_size(batch_size)
+        
+        doc_ids, vectors = [], []
+        for doc in cursor:
+            doc_ids.append(doc["_id"])
+            vectors.append(decode_vector(doc[embedding_field]))
+            if len(doc_ids) >= batch_size:
+                yield doc_ids, vectors
+                doc_ids, vectors = [], []
+        if doc_ids:
+            yield doc_ids, vectors
+    
+    def _load_vector_index(self, collection_name: str, embedding_field: str,
+                           batch_size: int = 1000) -> Union[VectorIndex, HNSWIndex, EmbeddingStore]:
+        """优先从快照加载索引，否则从MongoDB分批读取向量构建"""
+        snapshot_path = self._vector_index_snapshot_path(collection_name, embedding_field)
+        if self.vector_index_type == "mmap":
+            store = EmbeddingStore.open(snapshot_path)
+            is_new = store.synced_at is None
+            self._reconcile_vector_index(store, collection_name, embedding_field, batch_size)
+            if is_new:
+                # 首次构建后立即落盘，之后的进程直接mmap
+                store.save()
+            return store
+        
+        if snapshot_path and os.path.exists(snapshot_path):
+            try:
+                index = HNSWIndex.load(snapshot_path)
+                if self.hnsw_params.get("ef_search"):
+                    index.ef_search = self.hnsw_params["ef_search"]
+                self._reconcile_vector_index(index, collection_name, embedding_field, batch_size)
+                logger.info(f"Loaded vector index snapshot {snapshot_path}: {len(index)} vectors")
+                return index
+            except Exception as e:
+                logger.warning(f"Could not load vector index snapshot {snapshot_path}, rebuilding: {e}")
+        
+        index = self._create_vector_index(collection_name, embedding_field)
+        batches = self._iter_embedding_batches(collection_name, embedding_field, batch_size=batch_size)
+        if isinstance(index, HNSWIndex):
+            index.synced_at = datetime.now()
+            index.bulk_load(batches)
+        else:
+            for doc_ids, vectors in batches:
+                index.add_many(doc_ids, vectors)
+        
+        logger.info(f"Loaded vector index {collection_name}.{embedding_field}: {len(index)} vectors")
+        return index
+    
+    def _reconcile_vector_index(self, index: Union[HNSWIndex, EmbeddingStore], collection_name: str,
+                                embedding_field: str, batch_size: int = 1000) -> None:
+        """
+        让快照追上MongoDB：删除已不存在的文档，补充快照之后新增的文档，
+        并重新读取updated_at晚于上次同步时间的文档
+        """
+        sync_started = datetime.now()
+        removed_ids, missing_ids = self._diff_index_ids(
+            index, collection_name, {embedding_field: EMBEDDING_TYPES}, batch_size
+        )
+        
+        for doc_id in removed_ids:
+            index.remove(doc_id)
+        for start in range(0, len(missing_ids), batch_size):
+            chunk = {"_id": {"$in": missing_ids[start:start + batch_size]}}
+            for doc_ids, vectors in self._iter_embedding_batches(collection_name, embedding_field, chunk, batch_size):
+                index.add_many(doc_ids, vectors)
+        
+        if missing_ids or removed_ids:
+            logger.info(f"Reconciled {collection_name}.{embedding_field}: +{len(missing_ids)} -{len(removed_ids)}")
+        
+        if isinstance(index, EmbeddingStore):
+            index.mark_synced(sync_started)
         else:
-            # 只有文本和元数据过滤，没有向量查询
-            return list(cursor.limit(top_k))
+            index.synced_at = sync_started
+    
+    def _diff_index_ids(self, index, collection_name: str, field_query: Dict,
+                        batch_size: int = 1000) -> Tuple[set, List[Any]]:
+        """
+        对比快照与集合，返回(需要删除的ID, 需要重新读取的ID)
+        需要重新读取的包括快照中没有的文档，以及updated_at不早于index.synced_at的文档
+        （写入索引字段时由本类的写方法维护updated_at）
+        """
+        current_ids = {
+            doc["_id"] for doc in
+            self.db[collection_name].find(field_query, {"_id": 1}).batch_size(batch_size)
+        }
+        indexed_ids = set(index.ids)
+        
+        missing_ids = list(current_ids - indexed_ids)
+        if index.synced_at is not None:
+            missing_set = set(missing_ids)
+            missing_ids += [
+                doc["_id"] for doc in
+                self.db[collection_name].find({"updated_at": {"$gte": index.synced_at}}, {"_id": 1}).batch_size(batch_size)
+                if doc["_id"] in current_ids and doc["_id"] not in missing_set
+            ]
+        return indexed_ids - current_ids, missing_ids
+    
+    def _loaded_vector_indexes(self, collection_name: str) -> List[VectorIndex]:
+        """集合下已加载的向量索引"""
+        return [index for (name, _), index in list(self._vector_indexes.items()) if name == collection_name]
+    
+    def _loaded_partition_indexes(self, collection_name: str) -> List[VectorIndex]:
+        """集合下已加载的分区索引"""
+        with self._partition_indexes_lock:
+            return [index for key, index in self._partition_indexes.items() if key[0] == collection_name]
+    
+    def _sync_vector_indexes(self, collection_name: str, doc_id, fields: Dict) -> None:
+        """把写入的向量字段同步到已加载的索引"""
+        for embedding_field in EMBEDDING_FIELDS:
+            index = self._vector_indexes.get((collection_name, embedding_field))
+            if index is not None and fields.get(embedding_field) is not None:
+                index.add(doc_id, decode_vector(fields[embedding_field]))
+    
+    def get_text_index(self, collection_name: str, text_field: str) -> TextIndex:
+        """
+        获取(集合, 文本字段)对应的文本倒排索引，首次访问时从快照或MongoDB加载
+        通过insert_vector/update_vector/delete_vector写入的数据立即同步到已加载的索引，其他写入增量同步
+        """
+        key = (collection_name, text_field)
+        index = self._text_indexes.get(key)
+        if index is not None:
+            self._refresh_indexes(collection_name)
+            return index
+        
+        self._ensure_sync_state(collection_name)
+        with self._text_indexes_lock:
+            index = self._text_indexes.get(key)
+            if index is None:
+                index = self._load_text_index(collection_name, text_field)
+                self._text_indexes[key] = index
+        return index
+    
+    def refresh_text_index(self, collection_name: str, text_field: str = None) -> None:
+        """丢弃已加载的文本索引，下次检索时重新加载"""
+        with self._text_indexes_lock:
+            for key in list(self._text_indexes):
+                if key[0] == collection_name and text_field in (None, key[1]):
+                    del self._text_indexes[key]
+    
+    def save_text_indexes(self) -> List[str]:
+        """把已加载的文本索引快照写入vector_index_dir，返回写入的文件路径"""
+        if not self.vector_index_dir:
+            return []
+        
+        os.makedirs(self.vector_index_dir, exist_ok=True)
+        saved = []
+        for (collection_name, text_field), index in list(self._text_indexes.items()):
+            path = self._text_index_snapshot_path(collection_name, text_field)
+            index.save(path)
+            saved.append(path)
+            logger.info(f"Saved text index snapshot {path} ({len(index)} documents)")
+        return saved
+    
+    def _text_index_snapshot_path(self, collection_name: str, text_field: str) -> Optional[str]:
+        """文本索引快照文件路径"""
+        if not self.vector_index_dir:
+            return None
+        return os.path.join(self.vector_index_dir, f"{self.db.name}.{collection_name}.{text_field}.text")
+    
+    def _iter_text_batches(self, collection_name: str, text_field: str,
+                           query: Dict = None, batch_size: int = 1000):
+        """分批读取(文档ID列表, 文本列表)"""
+        cursor = self.db[collection_name].find(
+            {**(query or {}), text_field: {"$type": "string"}},
+            {text_field: 1}
+        ).batch_size(batch_size)
+        
+        doc_ids, texts = [], []
+        for doc in cursor:
+            doc_ids.append(doc["_id"])
+            texts.append(doc[text_field])
+            if len(doc_ids) >= batch_size:
+                yield doc_ids, texts
+                doc_ids, texts = [], []
+        if doc_ids:
+            yield doc_ids, texts
+    
+    def _load_text_index(self, collection_name: str, text_field: str, batch_size: int = 1000) -> TextIndex:
+        """优先从快照加载文本索引并补齐变更，否则从MongoDB分批读取构建"""
+        snapshot_path = self._text_index_snapshot_path(collection_name, text_field)
+        if snapshot_path and os.path.exists(snapshot_path):
+            try:
+                index = TextIndex.load(snapshot_path)
+                sync_started = datetime.now()
+                removed_ids, missing_ids = self._diff_index_ids(
+                    index, collection_name, {text_field: {"$type": "string"}}, batch_size
+                )
+                for doc_id in removed_ids:
+                    index.remove(doc_id)
+                for start in range(0, len(missing_ids), batch_size):
+                    chunk = {"_id": {"$in": missing_ids[start:start + batch_size]}}
+                    for doc_ids, texts in self._iter_text_batches(collection_name, text_field, chunk, batch_size):
+                        index.add_many(doc_ids, texts)
+                index.synced_at = sync_started
+                logger.info(f"Loaded text index snapshot {snapshot_path}: {len(index)} documents "
+                            f"(+{len(missing_ids)} -{len(removed_ids)})")
+                return index
+            except Exception as e:
+                logger.warning(f"Could not load text index snapshot {snapshot_path}, rebuilding: {e}")
+        
+        index = TextIndex()
+        index.synced_at = datetime.now()
+        for doc_ids, texts in self._iter_text_batches(collection_name, text_field, batch_size=batch_size):
+            index.add_many(doc_ids, texts)
+        
+        logger.info(f"Loaded text index {collection_name}.{text_field}: {len(index)} documents")
+        return index
+    
+    def _loaded_text_indexes(self, collection_name: str) -> List[TextIndex]:
+        """集合下已加载的文本索引"""
+        return [index for (name, _), index in list(self._text_indexes.items()) if name == collection_name]
+    
+    def _sync_metadata(self, collection_name: str, doc_id, fields: Dict) -> None:
+        """
+        把写入同步到已加载的元数据位图和分区索引
+        fields中有metadata时视为完整的metadata；文档移入分区但fields中没有向量时淘汰该分区，下次访问重新加载
+        """
+        metadata = fields.get("metadata")
+        if metadata is not None:
+            bitmaps = self._metadata_bitmaps.get(collection_name)
+            if bitmaps is not None:
+                bitmaps.add(doc_id, metadata)
+        
+        if not self.vector_partition_field:
+            return
+        partition_value = None if metadata is None else metadata.get(self.vector_partition_field)
+        with self._partition_indexes_lock:
+            for key, index in list(self._partition_indexes.items()):
+                if key[0] != collection_name:
+                    continue
+                in_partition = doc_id in index
+                belongs = in_partition if metadata is None else key[2] == partition_value
+                if not belongs:
+                    if in_partition:
+                        index.remove(doc_id)
+                    continue
+                vector = fields.get(key[1])
+                if vector is not None:
+                    index.add(doc_id, decode_vector(vector))
+                elif not in_partition:
+                    del self._partition_indexes[key]
+    
+    def _sync_text_indexes(self, collection_name: str, doc_id, fields: Dict) -> None:
+        """把写入的文本字段同步到已加载的索引"""
+        for text_field in TEXT_FIELDS:
+            index = self._text_indexes.get((collection_name, text_field))
+            if index is not None and isinstance(fields.get(text_field), str):
+                index.add(doc_id, fields[text_field])
+    
+    # 已加载索引与其他写入的增量同步
+    
+    @staticmethod
+    def _touches_indexed_fields(fields) -> bool:
+        """字段名（可为点路径）中是否有进程内索引依赖的字段"""
+        return any(str(field).split(".")[0] in INDEXED_FIELDS for field in fields)
+    
+    def _update_touches_indexed_fields(self, update) -> bool:
+        """更新操作是否可能改动索引字段；聚合管道形式的更新无法判断，按改动处理"""
+        if isinstance(update, list):
+            return True
+        return any(self._touches_indexed_fields(fields) for fields in update.values() if isinstance(fields, dict))
+    
+    @staticmethod
+    def _stamp_update(update):
+        """给更新操作加上updated_at，使其他进程的增量同步能读到这次改动"""
+        if isinstance(update, list):
+            return update + [{"$set": {"updated_at": datetime.now()}}]
+        if "updated_at" in update.get("$set", {}):
+            return update
+        return {**update, "$set": {**update.get("$set", {}), "updated_at": datetime.now()}}
+    
+    def _stamp_document(self, document: Dict) -> bool:
+        """含索引字段的文档写入前补上updated_at（原地修改，同insert_one补_id），返回是否含索引字段"""
+        if not self._touches_indexed_fields(document):
+            return False
+        document.setdefault("updated_at", datetime.now())
+        return True
+    
+    def _record_write(self, collection_name: str, deleted: bool = False, synced: bool = False,
+                      create: bool = True) -> None:
+        """
+        增加集合的写入版本号，各进程的已加载索引在下次检索前同步这次写入
+        
+        Args:
+            deleted: 写入删除了文档，同步时需要对比ID找出已删除的文档
+            synced: 本对象已把这次写入同步到自己的索引；版本号之间没有其他写入时不必再同步
+            create: 集合还没有版本号时是否创建；为False时只有加载过索引的集合才记录
+        """
+        inc = {"version": 1, "deletes": 1} if deleted else {"version": 1}
+        versions = self.db[INDEX_VERSIONS_COLLECTION].find_one_and_update(
+            {"_id": collection_name}, {"$inc": inc}, upsert=create, return_document=ReturnDocument.AFTER
+        )
+        state = self._index_sync.get(collection_name)
+        if state is None or versions is None:
+            return
+        with state["lock"]:
+            expected_deletes = state["deletes"] + (1 if deleted else 0)
+            if synced and versions["version"] == state["version"] + 1 and versions.get("deletes", 0) == expected_deletes:
+                state["version"], state["deletes"] = versions["version"], expected_deletes
+            else:
+                state["dirty"] = True
+    
+    def _ensure_sync_state(self, collection_name: str) -> None:
+        """集合第一次加载索引之前记下当前版本号，之后版本号变化即表示有需要同步的写入"""
+        if collection_name in self._index_sync:
+            return
+        with self._index_sync_lock:
+            if collection_name in self._index_sync:
+                return
+            versions = self.db[INDEX_VERSIONS_COLLECTION].find_one_and_update(
+                {"_id": collection_name}, {"$setOnInsert": {"version": 0, "deletes": 0}},
+                upsert=True, return_document=ReturnDocument.AFTER
+            )
+            self._index_sync[collection_name] = {
+                "version": versions.get("version", 0),
+                "deletes": versions.get("deletes", 0),
+                "synced_at": datetime.now(),
+                "checked": time.monotonic(),
+                "dirty": False,
+                "lock": threading.Lock(),
+            }
+    
+    def _refresh_indexes(self, collection_name: str) -> None:
+        """
+        让集合已加载的索引追上其他写入：本对象的通用写方法写过之后立即检查，否则间隔index_refresh_interval检查一次。
+        版本号变化时重新读取updated_at晚于上次同步的文档；有删除时再对比ID，删除已不存在的文档
+        """
+        state = self._index_sync.get(collection_name)
+        if state is None:
+            return
+        if not state["dirty"] and (self.index_refresh_interval is None
+                                   or time.monotonic() - state["checked"] < self.index_refresh_interval):
+            return
+        # 另一个线程正在同步时直接使用当前索引
+        if not state["lock"].acquire(blocking=False):
+            return
+        try:
+            state["checked"] = time.monotonic()
+            state["dirty"] = False
+            versions = self.db[INDEX_VERSIONS_COLLECTION].find_one({"_id": collection_name}) or {}
+            version, deletes = versions.get("version", 0), versions.get("deletes", 0)
+            if version == state["version"] and deletes == state["deletes"]:
+                return
+            
+            sync_started = datetime.now()
+            changed = 0
+            for doc in self.db[collection_name].find(
+                {"updated_at": {"$gte": state["synced_at"] - SYNC_CLOCK_SKEW}}, INDEXED_PROJECTION
+            ).batch_size(1000):
+                self._apply_document(collection_name, doc)
+                changed += 1
+            removed = self._remove_deleted_documents(collection_name) if deletes != state["deletes"] else 0
+            
+            state.update(version=version, deletes=deletes, synced_at=sync_started)
+            logger.debug(f"Refreshed indexes of {collection_name} to version {version}: "
+                        f"{changed} changed, {removed} removed")
+        finally:
+            state["lock"].release()
+    
+    def _apply_document(self, collection_name: str, doc: Dict) -> None:
+        """把文档在MongoDB中的当前内容写入已加载的索引：有的字段覆盖，没有的字段从对应索引中删除"""
+        doc_id = doc["_id"]
+        for embedding_field in EMBEDDING_FIELDS:
+            index = self._vector_indexes.get((collection_name, embedding_field))
+            if index is None:
+                continue
+            if doc.get(embedding_field) is not None:
+                index.add(doc_id, decode_vector(doc[embedding_field]))
+            else:
+                index.remove(doc_id)
+        for text_field in TEXT_FIELDS:
+            index = self._text_indexes.get((collection_name, text_field))
+            if index is None:
+                continue
+            if isinstance(doc.get(text_field), str):
+                index.add(doc_id, doc[text_field])
+            else:
+                index.remove(doc_id)
+        self._sync_metadata(collection_name, doc_id, {**doc, "metadata": doc.get("metadata") or {}})
+    
+    def _remove_deleted_documents(self, collection_name: str) -> int:
+        """对比集合中现有的ID，从已加载的索引中删除已不存在的文档，返回删除的条目数"""
+        structures = (self._loaded_vector_indexes(collection_name) + self._loaded_text_indexes(collection_name)
+                      + self._loaded_partition_indexes(collection_name))
+        bitmaps = self._metadata_bitmaps.get(collection_name)
+        if bitmaps is not None:
+            structures.append(bitmaps)
+        if not structures:
+            return 0
+        
+        current_ids = {doc["_id"] for doc in self.db[collection_name].find({}, {"_id": 1}).batch_size(10000)}
+        removed = 0
+        for structure in structures:
+            for doc_id in structure.ids:
+                if doc_id not in current_ids:
+                    structure.remove(doc_id)
+                    removed += 1
+        return removed
+    
+    @staticmethod
+    def _embedding_projection(include_embeddings: bool) -> Optional[Dict]:
+        """include_embeddings为False时返回排除向量字段的投影"""
+        return None if include_embeddings else EXCLUDE_EMBEDDINGS
+    
+    def _fetch_documents(self, collection_name: str, hits: List[Tuple[Any, float]], query: Dict = None,
+                         limit: int = 0, score_field: str = None, projection: Dict = None) -> List[Dict]:
+        """
+        按检索结果顺序取回满足query的文档，score_field不为空时附上分数
+        按排名分块读取，凑够limit个就停止：没有query时第一块就是前limit个命中，
+        有query时块大小逐次翻倍（最大FETCH_CHUNK_MAX），过滤掉的越多读得越远
+        """
+        if not hits:
+            return []
+        
+        query = query or {}
+        chunk_size = min(limit, FETCH_CHUNK_MAX) if limit else FETCH_CHUNK_MAX
+        results = []
+        position = 0
+        while position < len(hits) and not (limit and len(results) >= limit):
+            chunk = hits[position:position + chunk_size]
+            position += len(chunk)
+            docs = {
+                doc["_id"]: doc
+                for doc in self.db[collection_name].find({**query, "_id": {"$in": [doc_id for doc_id, _ in chunk]}},
+                                                         projection)
+            }
+            for doc_id, score in chunk:
+                doc = docs.get(doc_id)
+                if doc is None:
+                    continue
+                if score_field:
+                    doc[score_field] = score
+                results.append(doc)
+                if limit and len(results) >= limit:
+                    break
+            if query:
+                chunk_size = min(chunk_size * 2, FETCH_CHUNK_MAX)
+        return results
+    
+    def _fetch_scored_documents(self, collection_name: str, hits: List[Tuple[Any, float]],
+                                projection: Dict = None) -> List[Dict]:
+        """按检索结果顺序取回文档，并附上similarity字段"""
+        if not hits:
+            return []
+        
+        docs = {
+            doc["_id"]: doc
+            for doc in self.db[collection_name].find({"_id": {"$in": [doc_id for doc_id, _ in hits]}}, projection)
+        }
+        
+        results = []
+        for doc_id, similarity in hits:
+            doc = docs.get(doc_id)
+            if doc is not None:
+                decode_embedding_fields(doc, EMBEDDING_FIELDS)
+                doc["similarity"] = similarity
+                results.append(doc)
+        return results
 
 
 class VectorDB(MongoDBBase):
     """向量数据库类，继承自MongoDBBase"""
     
     def __init__(self, connection_string: str = "mongodb://localhost:27017/", 
-                 db_name: str = "vector_db", vector_dimension: int = 1536):
-        super().__init__(connection_string, db_name)
+                 db_name: str = "vector_db", vector_dimension: int = 1536,
+                 embedding_encoding: str = "array"):
+        """
+        embedding_encoding: 向量存储格式；Atlas的knnVector索引只识别数组，
+            二进制格式（"float32"/"float16"）只适合进程内检索
+        """
+        super().__init__(connection_string, db_name, embedding_encoding=embedding_encoding)
         self.vector_dimension = vector_dimension
     
     def create_vector_collection(self, collection_name: str, vector_field: str = "vector"):
@@ -378,7 +1343,7 @@ class VectorDB(MongoDBBase):
             metadata = {}
             
         document = {
-            vector_field: vector,
+            vector_field: encode_vector(vector, self.embedding_encoding),
             **metadata
         }
         
@@ -395,7 +1360,7 @@ class VectorDB(MongoDBBase):
             raise ValueError("向量列表和元数据列表长度不一致")
             
         documents = [
-            {vector_field: vector, **metadata}
+            {vector_field: encode_vector(vector, self.embedding_encoding), **metadata}
             for vector, metadata in zip(vectors, metadata_list)
         ]
         
@@ -405,6 +1370,11 @@ class VectorDB(MongoDBBase):
                      k: int = 10, vector_field: str = "vector", 
                      filter_query: Dict = None) -> List[Dict]:
         """向量相似度搜索"""
+        return self.aggregate(collection_name, self._vector_search_pipeline(query_vector, k, vector_field, filter_query))
+    
+    def _vector_search_pipeline(self, query_vector: List[float], k: int = 10, vector_field: str = "vector",
+                                filter_query: Dict = None) -> List[Dict]:
+        """单个查询向量的$search聚合管道"""
         if filter_query is None:
             filter_query = {}
             
@@ -433,7 +1403,7 @@ class VectorDB(MongoDBBase):
         if filter_query:
             pipeline.append({"$match": filter_query})
             
-        return self.aggregate(collection_name, pipeline)
+        return pipeline
     
     def hybrid_search(self, collection_name: str, query_vector: List[float], 
                      text_query: str, vector_weight: float = 0.7, 
@@ -515,12 +1485,29 @@ class VectorDB(MongoDBBase):
         })
     
     def batch_vector_search(self, collection_name: str, query_vectors: List[List[float]], 
-                           k: int = 10, vector_field: str = "vector") -> List[List[Dict]]:
-        """批量向量搜索"""
+                           k: int = 10, vector_field: str = "vector",
+                           filter_query: Dict = None, batch_size: int = 16) -> List[List[Dict]]:
+        """
+        批量向量搜索：$search每次只接受一个查询向量，每batch_size个查询用$unionWith拼成一个聚合，
+        一次往返取回（$unionWith中使用$search需要MongoDB 6.0+），结果按输入顺序返回
+        """
         results = []
-        for query_vector in query_vectors:
-            result = self.vector_search(collection_name, query_vector, k, vector_field)
-            results.append(result)
+        for start in range(0, len(query_vectors), batch_size):
+            chunk = query_vectors[start:start + batch_size]
+            pipelines = [
+                self._vector_search_pipeline(query_vector, k, vector_field, filter_query)
+                + [{"$addFields": {BATCH_QUERY_FIELD: i}}]
+                for i, query_vector in enumerate(chunk)
+            ]
+            pipeline = pipelines[0] + [
+                {"$unionWith": {"coll": collection_name, "pipeline": sub_pipeline}}
+                for sub_pipeline in pipelines[1:]
+            ]
+            
+            grouped = [[] for _ in chunk]
+            for doc in self.aggregate(collection_name, pipeline):
+                grouped[doc.pop(BATCH_QUERY_FIELD)].append(doc)
+            results.extend(grouped)
         return results
     
     def upsert_vector_document(self, collection_name: str, query: Dict, 
@@ -532,7 +1519,7 @@ class VectorDB(MongoDBBase):
             
         update_data = {
             "$set": {
-                vector_field: vector,
+                vector_field: encode_vector(vector, self.embedding_encoding),
                 **metadata
             }
         }
@@ -0,0 +1,310 @@
+"""
+N-gram Text Index
+进程内文本倒排索引：按字符n-gram（默认1~3元）切分，不依赖分词器，中文和英文都适用。
+子串查询由倒排表求交后校验原文得到，关键词查询按BM25打分
+"""
+import os
+import math
+import time
+import pickle
+import threading
+import unicodedata
+import logging
+from logging import getLogger
+logging.basicConfig(level=logging.INFO)
+logger = getLogger(__name__)
+
+import sys
+sys.path.append(".")
+
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+from dao.vector_index import top_k_indices
+
+TEXT_SEARCH_MODES = ["substring", "keyword"]
+
+
+def normalize_text(text: str) -> str:
+    """NFKC归一化（全角转半角等）并转小写，使查询不区分大小写"""
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+def char_ngrams(text: str, sizes: Iterable[int]) -> List[str]:
+    """文本的所有字符n-gram"""
+    grams = []
+    for n in sizes:
+        grams.extend(text[i:i + n] for i in range(len(text) - n + 1))
+    return grams
+
+
+def split_keywords(text: str) -> List[str]:
+    """按空白和标点拆分关键词"""
+    terms, current = [], []
+    for char in text:
+        if char.isalnum():
+            current.append(char)
+        elif current:
+            terms.append("".join(current))
+            current = []
+    if current:
+        terms.append("".join(current))
+    return terms
+
+
+class TextIndex:
+    """
+    字符n-gram倒排索引 + BM25
+
+    每个文档分配一个内部行号，每个n-gram对应一个倒排表 {行号: 词频}。
+    子串查询：取查询中最长可用长度的n-gram，倒排表求交得到候选，再用原文校验；
+    关键词查询：查询拆成关键词后展开为n-gram，命中任一n-gram的文档按BM25排序。
+    打分时倒排表转换为numpy数组（按n-gram缓存，写入时失效），一次向量化计算整条倒排表。
+    """
+
+    SNAPSHOT_VERSION = 2
+
+    def __init__(self, ngram_sizes: Tuple[int, ...] = (1, 2, 3), k1: float = 1.2, b: float = 0.75):
+        self.ngram_sizes = tuple(sorted(ngram_sizes))
+        self.k1 = k1
+        self.b = b
+        # 快照已与MongoDB同步到的时间点，由加载方维护
+        self.synced_at = None
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._posting_arrays: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._rows: Dict[Any, int] = {}           # 文档ID -> 行号
+        self._doc_ids: List[Any] = []             # 行号 -> 文档ID（已删除为None）
+        self._texts: List[Optional[str]] = []     # 行号 -> 归一化文本
+        self._lengths = np.zeros(0, dtype=np.float64)
+        self._free_rows: List[int] = []
+        self._total_length = 0
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self._rows
+
+    @property
+    def ids(self) -> List[Any]:
+        """已索引的文档ID"""
+        return list(self._rows)
+
+    def add(self, doc_id, text: str) -> None:
+        """插入或覆盖文档文本"""
+        with self._lock:
+            self._remove(doc_id)
+            normalized = normalize_text(text)
+            grams = Counter(char_ngrams(normalized, self.ngram_sizes))
+
+            if self._free_rows:
+                row = self._free_rows.pop()
+                self._doc_ids[row] = doc_id
+                self._texts[row] = normalized
+            else:
+                row = len(self._doc_ids)
+                self._doc_ids.append(doc_id)
+                self._texts.append(normalized)
+                if row >= len(self._lengths):
+                    self._lengths = np.concatenate([self._lengths, np.zeros(max(1024, row), dtype=np.float64)])
+            self._rows[doc_id] = row
+
+            for gram, tf in grams.items():
+                self._postings.setdefault(gram, {})[row] = tf
+                self._posting_arrays.pop(gram, None)
+            length = sum(grams.values())
+            self._lengths[row] = length
+            self._total_length += length
+
+    def add_many(self, doc_ids: List[Any], texts: List[str]) -> None:
+        """批量插入或覆盖"""
+        for doc_id, text in zip(doc_ids, texts):
+            self.add(doc_id, text)
+
+    def remove(self, doc_id) -> bool:
+        """删除文档，返回是否存在"""
+        with self._lock:
+            return self._remove(doc_id)
+
+    def _remove(self, doc_id) -> bool:
+        """调用方持有锁"""
+        row = self._rows.pop(doc_id, None)
+        if row is None:
+            return False
+        for gram in set(char_ngrams(self._texts[row], self.ngram_sizes)):
+            postings = self._postings.get(gram)
+            if postings is not None:
+                postings.pop(row, None)
+                self._posting_arrays.pop(gram, None)
+                if not postings:
+                    del self._postings[gram]
+        self._total_length -= int(self._lengths[row])
+        self._lengths[row] = 0
+        self._doc_ids[row] = None
+        self._texts[row] = None
+        self._free_rows.append(row)
+        return True
+
+    def search(self, query: str, top_k: int = None, candidate_ids: Iterable[Any] = None,
+               mode: str = "substring") -> List[Tuple[Any, float]]:
+        """
+        文本检索
+        mode: "substring"（文档包含整个查询串）或 "keyword"（命中任一关键词即可）
+        candidate_ids: 只在这些文档中检索，None表示全部
+        返回 [(doc_id, bm25_score), ...]，按分数降序
+        """
+        if mode not in TEXT_SEARCH_MODES:
+            raise ValueError(f"mode must be one of {TEXT_SEARCH_MODES}")
+        normalized = normalize_text(query)
+        if not normalized.strip():
+            return []
+
+        with self._lock:
+            if mode == "substring":
+                matched = self._substring_matches(normalized)
+                tokens = self._query_grams(normalized)
+            else:
+                matched = None
+                tokens = [gram for term in split_keywords(normalized) for gram in self._query_grams(term)]
+
+            if candidate_ids is not None:
+                candidates = {self._rows[doc_id] for doc_id in candidate_ids if doc_id in self._rows}
+                matched = candidates if matched is None else matched & candidates
+
+            rows, scores = self._bm25(tokens, matched)
+            selected = top_k_indices(scores, len(scores) if top_k is None else top_k)
+            return [(self._doc_ids[rows[i]], float(scores[i])) for i in selected]
+
+    def _query_grams(self, text: str) -> List[str]:
+        """查询串的n-gram：使用不超过查询长度的最长n，避免短n-gram稀释打分"""
+        usable = [n for n in self.ngram_sizes if n <= len(text)]
+        if not usable:
+            return []
+        return char_ngrams(text, [usable[-1]])
+
+    def _substring_matches(self, text: str) -> set:
+        """包含整个查询串的文档行号：倒排表由短到长求交，再校验原文。调用方持有锁"""
+        grams = set(self._query_grams(text))
+        if not grams:
+            return set()
+
+        postings = sorted((self._postings.get(gram, {}) for gram in grams), key=len)
+        if not postings[0]:
+            return set()
+        matched = set(postings[0])
+        for posting in postings[1:]:
+            matched.intersection_update(posting)
+            if not matched:
+                return matched
+
+        if len(text) > self.ngram_sizes[-1] or len(grams) > 1:
+            matched = {row for row in matched if text in self._texts[row]}
+        return matched
+
+    def _posting_array(self, gram: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """n-gram倒排表的(行号数组, 词频数组)，按需构建并缓存。调用方持有锁"""
+        arrays = self._posting_arrays.get(gram)
+        if arrays is None:
+            postings = self._postings.get(gram)
+            if not postings:
+                return None
+            arrays = (np.fromiter(postings.keys(), dtype=np.int64, count=len(postings)),
+                      np.fromiter(postings.values(), dtype=np.float64, count=len(postings)))
+            self._posting_arrays[gram] = arrays
+        return arrays
+
+    def _bm25(self, tokens: List[str], restrict_to: Optional[set]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        对tokens计算BM25，返回(行号数组, 分数数组)
+        restrict_to为None时返回所有命中文档，否则只返回这些行号中的命中文档。调用方持有锁
+        """
+        doc_count = len(self._rows)
+        if doc_count == 0 or (restrict_to is not None and not restrict_to):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        avg_length = self._total_length / doc_count
+
+        scores = np.zeros(len(self._doc_ids), dtype=np.float64)
+        hit = np.zeros(len(self._doc_ids), dtype=bool)
+        for gram, query_tf in Counter(tokens).items():
+            arrays = self._posting_array(gram)
+            if arrays is None:
+                continue
+            rows, tfs = arrays
+            idf = math.log(1 + (doc_count - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self._lengths[rows] / avg_length)
+            scores[rows] += query_tf * idf * tfs * (self.k1 + 1) / (tfs + norm)
+            hit[rows] = True
+
+        if restrict_to is not None:
+            # 候选行中没有命中任何查询词的不算结果
+            rows = np.fromiter(restrict_to, dtype=np.int64, count=len(restrict_to))
+            rows = rows[hit[rows]]
+        else:
+            rows = np.flatnonzero(hit)
+        return rows, scores[rows]
+
+    def save(self, path: str) -> None:
+        """把索引快照写入磁盘（先写临时文件再原子替换）"""
+        with self._lock:
+            state = {
+                "version": self.SNAPSHOT_VERSION,
+                "params": {"ngram_sizes": self.ngram_sizes, "k1": self.k1, "b": self.b},
+                "postings": self._postings,
+                "doc_ids": self._doc_ids,
+                "texts": self._texts,
+                "lengths": self._lengths[:len(self._doc_ids)],
+                "free_rows": self._free_rows,
+                "total_length": self._total_length,
+                "synced_at": self.synced_at,
+            }
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "TextIndex":
+        """从磁盘快照加载索引"""
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state.get("version") != cls.SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported text index snapshot version: {state.get('version')}")
+
+        index = cls(**state["params"])
+        index._postings = state["postings"]
+        index._doc_ids = state["doc_ids"]
+        index._texts = state["texts"]
+        index._lengths = np.array(state["lengths"], dtype=np.float64)
+        index._free_rows = state["free_rows"]
+        index._rows = {doc_id: row for row, doc_id in enumerate(index._doc_ids) if doc_id is not None}
+        index._total_length = state["total_length"]
+        index.synced_at = state.get("synced_at")
+        return index
+
+
+# 使用示例：中文子串与关键词检索
+if __name__ == "__main__":
+    index = TextIndex()
+    docs = {
+        1: "用户喜欢喝咖啡，尤其是拿铁",
+        2: "用户每天早上跑步",
+        3: "用户的猫叫咖啡豆",
+        4: "Likes Coffee and running",
+    }
+    for doc_id, text in docs.items():
+        index.add(doc_id, text)
+
+    print("substring 咖啡:", index.search("咖啡"))
+    print("substring 喝咖啡:", index.search("喝咖啡"))
+    print("keyword 咖啡 跑步:", index.search("咖啡 跑步", mode="keyword"))
+    print("substring COFFEE:", index.search("COFFEE"))
+
+    start = time.perf_counter()
+    for i in range(20000):
+        index.add(f"bulk{i}", f"第{i}条记忆：用户提到了{i % 97}号话题和一些其他内容")
+    print(f"indexed 20000 docs in {time.perf_counter() - start:.2f}s")
+    start = time.perf_counter()
+    hits = index.search("42号话题")
+    print(f"substring query over {len(index)} docs: {len(hits)} hits in {(time.perf_counter() - start) * 1000:.1f} ms")
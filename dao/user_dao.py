@@ -10,41 +10,54 @@ logger = getLogger(__name__)
 import sys
 sys.path.append(".")
 
-from pymongo import MongoClient
+from pymongo import ReturnDocument
 from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
 from pymongo.cursor import Cursor
-from typing import Dict, List, Optional, Union, Any
+from typing import Dict, List, Optional, Union, Any, Iterator, Tuple
 from bson import ObjectId
 
 from conf.config import CONF
+from dao.client_registry import SharedClientMixin
+from dao.batch_loader import BatchLoader, find_by_ids
 
-class UserDAO():
+class UserDAO(SharedClientMixin):
     """用户模型类，提供users集合的增删改查操作"""
     
     def __init__(self, mongo_uri: str = "mongodb://" + CONF["mongodb"]["mongodb_ip"] + ":" + CONF["mongodb"]["mongodb_port"] + "/", 
-                 db_name: str = CONF["mongodb"]["mongodb_name"]):
+                 db_name: str = CONF["mongodb"]["mongodb_name"], client_options: Dict[str, Any] = None):
         """
         初始化User类
         
         Args:
             mongo_uri: MongoDB连接URI
             db_name: 数据库名称
+            client_options: MongoClient参数（如 maxPoolSize），同URI同参数的DAO共用一个客户端
         """
-        self.client = MongoClient(mongo_uri)
-        self.db = self.client[db_name]
-        self.collection: Collection = self.db.get_collection("users")
+        self._init_client(mongo_uri, db_name, client_options)
     
-    def create_indexes(self):
-        """创建必要的索引"""
-        # 为平台ID创建索引
-        self.collection.create_index([
-            ("platforms.wechat.id", 1)
-        ])
+    @property
+    def collection(self) -> Collection:
+        """users集合"""
+        return self.db.get_collection("users")
+    
+    def create_indexes(self, platforms: Tuple[str, ...] = ("wechat",)):
+        """
+        创建必要的索引
         
-        # 可以为其他平台创建类似的索引
-        # self.collection.create_index([
-        #     ("platforms.other_platform.id", 1)
-        # ])
+        Args:
+            platforms: 要建平台ID唯一索引的平台
+        """
+        # 为平台ID创建唯一索引：一个平台账号只对应一个用户，并发的upsert_user不会重复创建
+        # 先处理旧数据中的重复账号；旧版本的同名非唯一索引由_ensure_index替换
+        for platform in platforms:
+            self.dedupe_platform_users(platform)
+            self._ensure_index(
+                self.collection,
+                [(f"platforms.{platform}.id", 1)],
+                unique=True,
+                partialFilterExpression={f"platforms.{platform}.id": {"$type": "string"}}
+            )
         
         # 为status字段创建索引
         self.collection.create_index([("status", 1)])
@@ -52,6 +65,29 @@ class UserDAO():
         # 为is_character字段创建索引
         self.collection.create_index([("is_character", 1)])
     
+    def dedupe_platform_users(self, platform: str) -> int:
+        """
+        同一平台账号对应多个用户时（唯一索引建立之前的并发创建），账号保留给最早创建的用户，
+        其余用户去掉该平台信息并记录duplicate_of，文档本身保留（其他集合可能引用其ID）
+        
+        Args:
+            platform: 平台名称
+            
+        Returns:
+            int: 去掉平台信息的用户数量
+        """
+        field = f"platforms.{platform}.id"
+        detached = 0
+        for ids in self._duplicate_groups(self.collection, {"id": f"${field}"}, {field: {"$type": "string"}}):
+            keep, duplicates = ids[0], ids[1:]
+            result = self.collection.update_many(
+                {"_id": {"$in": duplicates}},
+                {"$unset": {f"platforms.{platform}": ""}, "$set": {"duplicate_of": keep}}
+            )
+            detached += result.modified_count
+            logger.warning(f"Duplicate {platform} users {duplicates} detached in favour of {keep}")
+        return detached
+    
     def create_user(self, user_data: Dict) -> str:
         """
         创建新用户
@@ -68,12 +104,13 @@ class UserDAO():
         result = self.collection.insert_one(user_data)
         return str(result.inserted_id)
     
-    def get_user_by_id(self, user_id: str) -> Optional[Dict]:
+    def get_user_by_id(self, user_id: str, projection: Dict = None) -> Optional[Dict]:
         """
         通过ID获取用户
         
         Args:
             user_id: 用户ID
+            projection: 返回字段，None表示整个文档
             
         Returns:
             Optional[Dict]: 用户数据或None
@@ -86,15 +123,78 @@ class UserDAO():
         except:
             return None
             
-        return self.collection.find_one({"_id": object_id})
+        return self.collection.find_one({"_id": object_id}, projection)
+    
+    def get_users_by_ids(self, user_ids: List[str], projection: Dict = None) -> List[Optional[Dict]]:
+        """
+        通过ID批量获取用户，一次$in查询
+        
+        Args:
+            user_ids: 用户ID列表
+            projection: 返回字段，None表示整个文档
+            
+        Returns:
+            List[Optional[Dict]]: 与user_ids顺序一致的用户数据，不存在或ID无效的为None
+        """
+        return find_by_ids(self.collection, user_ids, projection)
+    
+    def user_loader(self, projection: Dict = None, max_batch_size: int = 1000) -> BatchLoader:
+        """
+        创建请求作用域的用户批量加载器，如处理群聊时先登记所有talkers的ID，再一次查询读回
+        
+        Args:
+            projection: 返回字段，None表示整个文档
+            max_batch_size: 一次查询最多的ID数
+        """
+        return BatchLoader(lambda user_ids: self.get_users_by_ids(user_ids, projection), max_batch_size)
+    
+    def get_users_by_platform_ids(self, platform: str, platform_ids: List[str],
+                                  projection: Dict = None) -> List[Optional[Dict]]:
+        """
+        通过平台ID批量获取用户，一次$in查询
+        
+        Args:
+            platform: 平台名称 (例如 "wechat")
+            platform_ids: 平台用户ID列表
+            projection: 返回字段，None表示整个文档
+            
+        Returns:
+            List[Optional[Dict]]: 与platform_ids顺序一致的用户数据，不存在的为None
+        """
+        field = f"platforms.{platform}.id"
+        wanted = [platform_id for platform_id in dict.fromkeys(platform_ids) if platform_id]
+        if not wanted:
+            return [None] * len(platform_ids)
+        
+        # 投影中必须带回平台ID才能把结果对应到ID（已包含其上级字段时不能再加，否则路径冲突）
+        if projection and not any(field == key or field.startswith(key + ".") for key in projection):
+            projection = dict(projection, **{field: 1})
+        by_platform_id = {}
+        for user in self.collection.find({field: {"$in": wanted}}, projection):
+            by_platform_id[user["platforms"][platform]["id"]] = user
+        return [by_platform_id.get(platform_id) for platform_id in platform_ids]
+    
+    def platform_user_loader(self, platform: str, projection: Dict = None,
+                             max_batch_size: int = 1000) -> BatchLoader:
+        """
+        创建按平台ID读取的请求作用域批量加载器，收到多个平台用户的消息或提醒时一次查询读回
+        
+        Args:
+            platform: 平台名称
+            projection: 返回字段，None表示整个文档
+            max_batch_size: 一次查询最多的ID数
+        """
+        return BatchLoader(lambda platform_ids: self.get_users_by_platform_ids(platform, platform_ids, projection),
+                           max_batch_size)
     
-    def get_user_by_platform(self, platform: str, platform_id: str) -> Optional[Dict]:
+    def get_user_by_platform(self, platform: str, platform_id: str, projection: Dict = None) -> Optional[Dict]:
         """
         通过平台和平台ID获取用户
         
         Args:
             platform: 平台名称 (例如 "wechat")
             platform_id: 平台用户ID
+            projection: 返回字段，None表示整个文档
             
         Returns:
             Optional[Dict]: 用户数据或None
@@ -103,7 +203,7 @@ class UserDAO():
             return None
             
         query = {f"platforms.{platform}.id": platform_id}
-        return self.collection.find_one(query)
+        return self.collection.find_one(query, projection)
     
     def update_user(self, user_id: str, update_data: Dict) -> bool:
         """
@@ -200,7 +300,8 @@ class UserDAO():
         return result.modified_count > 0
     
     def find_users(self, query: Dict = None, limit: int = 0, 
-                  skip: int = 0, sort=None) -> Cursor:
+                  skip: int = 0, sort=None, projection: Dict = None,
+                  raw: bool = False) -> List[Dict]:
         """
         查找符合条件的用户
         
@@ -209,14 +310,30 @@ class UserDAO():
             limit: 最大返回数量
             skip: 跳过的文档数
             sort: 排序字段
+            projection: 返回字段，如 {"nickname": 1}；列表页只取需要的字段
+            raw: 返回只读的RawBSONDocument，首次访问字段时才解码；适合原样转发的文档，跳过大字段请用projection
+            
+        Returns:
+            List[Dict]: 用户列表
+        """
+        return list(self.iter_users(query, limit, skip, sort, projection, raw=raw))
+    
+    def iter_users(self, query: Dict = None, limit: int = 0, skip: int = 0, sort=None,
+                   projection: Dict = None, batch_size: int = 1000, raw: bool = False) -> Iterator[Dict]:
+        """
+        逐条迭代符合条件的用户，内存占用与结果总数无关
+        
+        Args:
+            batch_size: 每次从服务器取回的文档数
+            其余参数同 find_users
             
         Returns:
-            Cursor: MongoDB游标
+            Iterator[Dict]: 用户迭代器
         """
         if query is None:
             query = {}
             
-        cursor = self.collection.find(query)
+        cursor = self._read_collection("users", raw).find(query, projection)
         
         if skip > 0:
             cursor = cursor.skip(skip)
@@ -227,7 +344,7 @@ class UserDAO():
         if sort:
             cursor = cursor.sort(sort)
             
-        return list(cursor)
+        return self._iter_cursor(cursor, batch_size)
     
     def count_users(self, query: Dict = None) -> int:
         """
@@ -245,7 +362,7 @@ class UserDAO():
         return self.collection.count_documents(query)
     
     def find_users_by_platform(self, platform: str, query: Dict = None, 
-                              limit: int = 0) -> List[Dict]:
+                              limit: int = 0, projection: Dict = None) -> List[Dict]:
         """
         通过平台查找用户
         
@@ -253,10 +370,24 @@ class UserDAO():
             platform: 平台名称
             query: 平台相关的查询条件
             limit: 最大返回数量
+            projection: 返回字段
             
         Returns:
             List[Dict]: 用户列表
         """
+        return list(self.iter_users_by_platform(platform, query, limit, projection))
+    
+    def iter_users_by_platform(self, platform: str, query: Dict = None, limit: int = 0,
+                               projection: Dict = None, batch_size: int = 1000) -> Iterator[Dict]:
+        """
+        逐条迭代平台用户，参数同 find_users_by_platform
+        
+        Args:
+            batch_size: 每次从服务器取回的文档数
+            
+        Returns:
+            Iterator[Dict]: 用户迭代器
+        """
         if query is None:
             query = {}
             
@@ -265,28 +396,47 @@ class UserDAO():
         for key, value in query.items():
             platform_query[f"platforms.{platform}.{key}"] = value
             
-        cursor = self.collection.find(platform_query).limit(limit) if limit > 0 else self.collection.find(platform_query)
-        return list(cursor)
+        cursor = self.collection.find(platform_query, projection)
+        if limit > 0:
+            cursor = cursor.limit(limit)
+        return self._iter_cursor(cursor, batch_size)
     
-    def find_characters(self, query: Dict = None, limit: int = 0) -> List[Dict]:
+    def find_characters(self, query: Dict = None, limit: int = 0,
+                        projection: Dict = None) -> List[Dict]:
         """
         查找角色用户
         
         Args:
             query: 附加查询条件
             limit: 最大返回数量
+            projection: 返回字段，如 {"name": 1}；角色文档带有完整人设，只需名字时不要取整个文档
             
         Returns:
             List[Dict]: 角色用户列表
         """
+        return list(self.iter_characters(query, limit, projection))
+    
+    def iter_characters(self, query: Dict = None, limit: int = 0, projection: Dict = None,
+                        batch_size: int = 1000) -> Iterator[Dict]:
+        """
+        逐条迭代角色用户，参数同 find_characters
+        
+        Args:
+            batch_size: 每次从服务器取回的文档数
+            
+        Returns:
+            Iterator[Dict]: 角色用户迭代器
+        """
         if query is None:
             query = {}
             
         # 添加角色条件
         character_query = {**query, "is_character": True}
         
-        cursor = self.collection.find(character_query).limit(limit) if limit > 0 else self.collection.find(character_query)
-        return list(cursor)
+        cursor = self.collection.find(character_query, projection)
+        if limit > 0:
+            cursor = cursor.limit(limit)
+        return self._iter_cursor(cursor, batch_size)
     
     def bulk_update_users(self, query: Dict, update: Dict) -> int:
         """
@@ -313,18 +463,21 @@ class UserDAO():
         Returns:
             str: 用户ID
         """
-        result = self.collection.update_one(
-            query, 
-            {"$set": user_data}, 
-            upsert=True
-        )
-        
-        if result.upserted_id:
-            return str(result.upserted_id)
-        else:
-            # 获取匹配文档的ID
-            user = self.collection.find_one(query, {"_id": 1})
-            return str(user["_id"]) if user else None
+        # 一次往返完成更新或插入并返回_id；query字段上应有唯一索引（如platforms.wechat.id），
+        # 并发插入同一用户时后写入的一方报DuplicateKeyError，重试即变为更新
+        for attempt in range(3):
+            try:
+                user = self.collection.find_one_and_update(
+                    query,
+                    {"$set": user_data},
+                    projection={"_id": 1},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+                return str(user["_id"])
+            except DuplicateKeyError:
+                if attempt == 2:
+                    raise
     
     def add_platform_to_user(self, user_id: str, platform: str, 
                             platform_data: Dict) -> bool:
@@ -388,8 +541,8 @@ class UserDAO():
         return update_result.modified_count > 0
     
     def close(self):
-        """关闭MongoDB连接"""
-        self.client.close()
+        """共享的MongoClient由client_registry.close_all_clients关闭，这里无需释放"""
+        pass
 
 
 # 使用示例
@@ -425,8 +578,16 @@ if __name__ == "__main__":
     # platform_user = user_model.get_user_by_platform("wechat", "wx123456")
     # print(f"Found user by platform: {platform_user['name']}")
 
+    # # 批量获取群聊中所有成员：先登记ID，第一次取结果时一次$in查询
+    # loader = user_model.user_loader(projection={"name": 1})
+    # pending = loader.defer_many([talker["id"] for talker in conversation["talkers"]])
+    # members = [load.result() for load in pending]
+
     results = user_model.find_users(query={
-    }, limit=10)
+    }, limit=10, projection={"name": 1, "platforms": 1, "status": 1})
+
+    # # 列出角色名字：只取name字段
+    # characters = user_model.find_characters(limit=10, projection={"name": 1})
 
     for result in results:
         print(result)
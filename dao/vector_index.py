@@ -0,0 +1,207 @@
+"""
+In-process Vector Index
+进程内向量检索引擎：连续的float32归一化矩阵 + ID数组，一次矩阵向量乘完成打分
+"""
+import threading
+import logging
+from logging import getLogger
+logging.basicConfig(level=logging.INFO)
+logger = getLogger(__name__)
+
+import sys
+sys.path.append(".")
+
+from typing import Dict, List, Any, Optional, Iterable, Tuple
+import numpy as np
+
+# 批量检索时单个分数矩阵的最大元素数（float32约256MB）
+SCORE_BLOCK_ELEMENTS = 1 << 26
+
+
+def normalize_vectors(vectors) -> np.ndarray:
+    """
+    将向量（或向量矩阵）转为float32并做L2归一化
+    零向量保持为零，与余弦相似度"分母为0时返回0"的约定一致
+    """
+    matrix = np.array(vectors, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """用argpartition选出分数最高的top_k个下标，并按分数降序排列"""
+    if top_k <= 0 or scores.size == 0:
+        return np.empty(0, dtype=np.int64)
+    if top_k < scores.size:
+        selected = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        selected = np.arange(scores.size)
+    return selected[np.argsort(-scores[selected], kind="stable")]
+
+
+class VectorIndex:
+    """
+    暴力（精确）向量索引
+
+    向量在写入时归一化并按行存放在预分配的float32矩阵中，
+    查询时只需一次矩阵向量乘即可得到所有余弦相似度。
+    删除采用"末行交换"，矩阵始终保持连续。
+    """
+
+    def __init__(self, dimension: int = None, initial_capacity: int = 1024):
+        self.dimension = dimension
+        self._capacity = initial_capacity
+        self._matrix: Optional[np.ndarray] = None
+        self._ids: List[Any] = []
+        self._rows: Dict[Any, int] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self._rows
+
+    @property
+    def ids(self) -> List[Any]:
+        """按行顺序排列的文档ID"""
+        return self._ids
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """当前有效的归一化向量矩阵 (n, dimension)"""
+        if self._matrix is None:
+            return np.empty((0, self.dimension or 0), dtype=np.float32)
+        return self._matrix[:len(self._ids)]
+
+    def _ensure_capacity(self, size: int):
+        """按需扩容（容量翻倍）"""
+        if self._matrix is None:
+            self._matrix = np.zeros((max(self._capacity, size), self.dimension), dtype=np.float32)
+            return
+        if size <= self._matrix.shape[0]:
+            return
+        new_capacity = max(size, self._matrix.shape[0] * 2)
+        grown = np.zeros((new_capacity, self.dimension), dtype=np.float32)
+        grown[:len(self._ids)] = self._matrix[:len(self._ids)]
+        self._matrix = grown
+
+    def add(self, doc_id, vector) -> None:
+        """插入或覆盖单个向量"""
+        self.add_many([doc_id], [vector])
+
+    def add_many(self, doc_ids: List[Any], vectors) -> None:
+        """批量插入或覆盖向量"""
+        if len(doc_ids) == 0:
+            return
+        normalized = normalize_vectors(vectors)
+        if normalized.shape[0] != len(doc_ids):
+            raise ValueError("doc_ids和vectors长度不一致")
+
+        with self._lock:
+            if self.dimension is None:
+                self.dimension = normalized.shape[1]
+            elif normalized.shape[1] != self.dimension:
+                raise ValueError(f"向量维度应为{self.dimension}，实际为{normalized.shape[1]}")
+
+            self._ensure_capacity(len(self._ids) + len(doc_ids))
+            for doc_id, vector in zip(doc_ids, normalized):
+                row = self._rows.get(doc_id)
+                if row is None:
+                    row = len(self._ids)
+                    self._ids.append(doc_id)
+                    self._rows[doc_id] = row
+                self._matrix[row] = vector
+
+    def remove(self, doc_id) -> bool:
+        """删除向量，返回是否存在"""
+        with self._lock:
+            row = self._rows.pop(doc_id, None)
+            if row is None:
+                return False
+            last = len(self._ids) - 1
+            if row != last:
+                # 用最后一行填补空位，保持矩阵连续
+                moved_id = self._ids[last]
+                self._matrix[row] = self._matrix[last]
+                self._ids[row] = moved_id
+                self._rows[moved_id] = row
+            self._ids.pop()
+            return True
+
+    def rows_for(self, doc_ids: Iterable[Any]) -> np.ndarray:
+        """将文档ID转换为矩阵行号（忽略不在索引中的ID）"""
+        rows = [self._rows[doc_id] for doc_id in doc_ids if doc_id in self._rows]
+        return np.array(rows, dtype=np.int64)
+
+    def search(self, query_vector, top_k: int = 10,
+               candidate_ids: Iterable[Any] = None,
+               similarity_threshold: float = None) -> List[Tuple[Any, float]]:
+        """
+        余弦相似度检索
+        candidate_ids: 只在这些文档中检索（例如元数据过滤的结果），None表示全部
+        返回 [(doc_id, similarity), ...]，按相似度降序
+        """
+        query = normalize_vectors(query_vector)[0]
+
+        with self._lock:
+            if not self._ids:
+                return []
+            if query.shape[0] != self.dimension:
+                raise ValueError(f"查询向量维度应为{self.dimension}，实际为{query.shape[0]}")
+
+            if candidate_ids is None:
+                rows = None
+                scores = self.matrix @ query
+            else:
+                rows = self.rows_for(candidate_ids)
+                scores = self._matrix[rows] @ query
+
+            selected = top_k_indices(scores, top_k)
+            results = []
+            for i in selected:
+                score = float(scores[i])
+                if similarity_threshold is not None and score < similarity_threshold:
+                    break
+                row = i if rows is None else rows[i]
+                results.append((self._ids[row], score))
+            return results
+
+    def search_many(self, query_vectors, top_k: int = 10,
+                    candidate_ids_list: List[Optional[Iterable[Any]]] = None,
+                    similarity_threshold: float = None) -> List[List[Tuple[Any, float]]]:
+        """
+        批量余弦相似度检索：整个查询矩阵与向量矩阵做一次矩阵乘，再逐个查询取top_k
+        candidate_ids_list: 与查询一一对应的候选集，None（或其中某项为None）表示全部
+        返回与查询顺序一致的结果列表
+        """
+        queries = normalize_vectors(query_vectors)
+        if candidate_ids_list is not None and len(candidate_ids_list) != len(queries):
+            raise ValueError("candidate_ids_list和query_vectors长度不一致")
+
+        with self._lock:
+            if not self._ids:
+                return [[] for _ in range(len(queries))]
+            if queries.shape[1] != self.dimension:
+                raise ValueError(f"查询向量维度应为{self.dimension}，实际为{queries.shape[1]}")
+
+            # 分块计算，限制分数矩阵的大小
+            block_size = max(1, SCORE_BLOCK_ELEMENTS // len(self._ids))
+            results = []
+            for start in range(0, len(queries), block_size):
+                scores = queries[start:start + block_size] @ self.matrix.T
+                for offset, row_scores in enumerate(scores):
+                    candidate_ids = None if candidate_ids_list is None else candidate_ids_list[start + offset]
+                    rows = None if candidate_ids is None else self.rows_for(candidate_ids)
+                    if rows is not None:
+                        row_scores = row_scores[rows]
+
+                    hits = []
+                    for i in top_k_indices(row_scores, top_k):
+                        score = float(row_scores[i])
+                        if similarity_threshold is not None and score < similarity_threshold:
+                            break
+                        hits.append((self._ids[i if rows is None else rows[i]], score))
+                    results.append(hits)
+            return results
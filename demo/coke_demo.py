@@ -15,9 +15,13 @@ os.environ.setdefault('env', 'demo')
 # They'll work in memory mode for demo
 
 # Import Flask and other dependencies
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
 import json
+import time
+import queue
+import atexit
 import logging
+import threading
 from datetime import datetime
 
 # Setup logging
@@ -30,50 +34,172 @@ from coke.agent.coke_chat_agent import CokeChatAgent
 
 # Import actual DAO modules (they'll use in-memory MongoDB)
 from dao.mongo import MongoDBBase
-from dao.user_dao import UserDAO
+from dao.client_registry import close_all_clients
+from dao.cached_user_dao import CachedUserDAO
 from dao.conversation_dao import ConversationDAO
 
 # Import reminder scheduler
-from coke.scheduler.reminder_scheduler import ReminderScheduler
+from coke.scheduler.reminder_scheduler import ReminderScheduler, user_shard
 from coke.scheduler.background_runner import BackgroundReminderRunner
 
+# Import long-term conversation memory
+from coke.memory.conversation_memory import ConversationMemory
+from coke.memory.embedding import embedding_available
+from coke.memory.embedding_service import EmbeddingService, local_embedding, LOCAL_MODEL
+
 app = Flask(__name__)
 
 # Global background runner
 background_runner = None
 
-# Initialize MongoDB connection
+# Seconds between keepalive comments on an idle reminder stream
+SSE_KEEPALIVE_SECONDS = 15
+
+# MongoDB-backed services, created on the first request rather than at import time
+# so importing the app (or forking workers from it) opens no connections
 USE_MONGODB = False
 mongo_db = None
+user_dao = None
 conversation_collection = None
 reminder_scheduler = None
+conversation_memory = None
+embedding_service = None
+_services_initialized = False
+_services_lock = threading.Lock()
 
-try:
-    mongo_db = MongoDBBase()
-    # Test connection by trying a simple operation
-    mongo_db.db.list_collection_names()
-    conversation_collection = mongo_db.get_collection("coke_conversations")
-    
-    # Initialize reminder scheduler
-    reminder_scheduler = ReminderScheduler(mongo_db)
+# Demo users are identified by the user_id they send, stored as their platform ID
+WEB_PLATFORM = 'web'
+
+# After a failed connection attempt, requests use in-memory storage and retry
+# MongoDB after a delay that doubles up to the maximum
+INIT_RETRY_SECONDS = 5
+INIT_RETRY_MAX_SECONDS = 300
+_init_retry_delay = INIT_RETRY_SECONDS
+_next_init_attempt = 0.0
+
+def init_services():
+    """Connect to MongoDB and start the background services (once per process, retried after failures)."""
+    global USE_MONGODB, mongo_db, conversation_collection, reminder_scheduler
+    global conversation_memory, background_runner, embedding_service, user_dao
+    global _services_initialized, _init_retry_delay, _next_init_attempt
     
-    # Start background reminder checker (no need for global, already declared at module level)
-    background_runner = BackgroundReminderRunner(reminder_scheduler, check_interval=30)
-    background_runner.start()
+    if _services_initialized or time.monotonic() < _next_init_attempt:
+        return
+    with _services_lock:
+        if _services_initialized or time.monotonic() < _next_init_attempt:
+            return
+        
+        try:
+            # Memories are searched per user, so keep one vector index per user
+            mongo_db = MongoDBBase(vector_partition_field="user_id")
+            # Test connection by trying a simple operation
+            mongo_db.db.list_collection_names()
+            conversation_collection = mongo_db.get_collection("coke_conversations")
+            # Senders are resolved on every message; the cache keeps that off MongoDB in steady state
+            user_dao = CachedUserDAO()
+            user_dao.create_indexes(platforms=("wechat", WEB_PLATFORM))
+        
+            # Initialize reminder scheduler
+            reminder_scheduler = ReminderScheduler(mongo_db)
+            reminder_scheduler.create_indexes()
+            reminder_scheduler.migrate_timestamps()
+            reminder_scheduler.backfill_user_shards()
+        
+            # Start background reminder checker
+            # Run several processes with COKE_SHARD_COUNT=N and COKE_SHARD_INDEX=0..N-1 to split users;
+            # change stream positions are kept per host (or per COKE_WORKER_ID when set) and shard
+            background_runner = BackgroundReminderRunner(
+                reminder_scheduler,
+                check_interval=30,
+                worker_id=os.environ.get('COKE_WORKER_ID'),
+                shard_index=int(os.environ.get('COKE_SHARD_INDEX', '0')),
+                shard_count=int(os.environ.get('COKE_SHARD_COUNT', '1')),
+                event_driven=True  # Uses change streams on a replica set, polling otherwise
+            )
+            background_runner.start()
+        
+            # Long-term memory: older turns are embedded in the background and retrieved by relevance.
+            # Embeddings go through a batching, caching service; COKE_LOCAL_EMBEDDING=1 uses an
+            # offline deterministic model instead of the API
+            cache_dir = os.path.join(os.path.dirname(__file__), '.cache')
+            if os.environ.get('COKE_LOCAL_EMBEDDING') == '1':
+                embedding_service = EmbeddingService(local_embedding, model=LOCAL_MODEL,
+                                                     cache_path=os.path.join(cache_dir, 'embeddings_local.sqlite'))
+            elif embedding_available():
+                embedding_service = EmbeddingService(cache_path=os.path.join(cache_dir, 'embeddings.sqlite'))
+            if embedding_service:
+                conversation_memory = ConversationMemory(mongo_db, embed_fn=embedding_service)
+                conversation_memory.create_collection()
+                conversation_memory.start()
+        
+            USE_MONGODB = True
+            _services_initialized = True
+            _init_retry_delay = INIT_RETRY_SECONDS
+            print("✅ Connected to MongoDB - Using persistent storage")
+            print(f"   Database: {mongo_db.db.name}")
+            print(f"   Connection: mongodb://127.0.0.1:27017/")
+            print("✅ Reminder system enabled")
+            print("✅ Background reminder checker started (30s intervals)")
+            if conversation_memory:
+                print("✅ Long-term memory enabled")
+            else:
+                print("⚠️  Long-term memory disabled (set DASHSCOPE_API_KEY or COKE_LOCAL_EMBEDDING=1 to enable)")
+        except Exception as e:
+            print(f"⚠️  MongoDB not available, using in-memory storage")
+            print(f"   Error: {e}")
+            print(f"⚠️  Reminders disabled (requires MongoDB), retrying in {_init_retry_delay}s")
+            # Anything started before the failure must not keep running against a half-initialized setup
+            stop_services()
+            _next_init_attempt = time.monotonic() + _init_retry_delay
+            _init_retry_delay = min(_init_retry_delay * 2, INIT_RETRY_MAX_SECONDS)
+
+def stop_services():
+    """Stop the background services started by init_services."""
+    global USE_MONGODB, mongo_db, reminder_scheduler, conversation_memory
+    global background_runner, embedding_service, user_dao, _services_initialized
     
-    USE_MONGODB = True
-    print("✅ Connected to MongoDB - Using persistent storage")
-    print(f"   Database: {mongo_db.db.name}")
-    print(f"   Connection: mongodb://127.0.0.1:27017/")
-    print("✅ Reminder system enabled")
-    print("✅ Background reminder checker started (30s intervals)")
-except Exception as e:
-    print(f"⚠️  MongoDB not available, using in-memory storage")
-    print(f"   Error: {e}")
-    print("⚠️  Reminders disabled (requires MongoDB)")
     USE_MONGODB = False
-    mongo_db = None
+    _services_initialized = False
+    for service in (background_runner, conversation_memory):
+        if service:
+            try:
+                service.stop()
+            except Exception as e:
+                logger.error(f"Error stopping {type(service).__name__}: {e}")
+    if embedding_service:
+        embedding_service.close()
+    background_runner = None
+    conversation_memory = None
+    embedding_service = None
     reminder_scheduler = None
+    user_dao = None
+    mongo_db = None
+
+def shutdown():
+    """Process exit: stop background services, then close the shared MongoDB clients."""
+    stop_services()
+    close_all_clients()
+
+atexit.register(shutdown)
+
+@app.before_request
+def ensure_services():
+    """Initialize MongoDB and background services lazily on the first request."""
+    init_services()
+
+def resolve_user(user_id):
+    """Find the sender's user record, creating it on first contact (None without MongoDB)."""
+    if not user_dao:
+        return None
+    try:
+        user = user_dao.get_user_by_platform(WEB_PLATFORM, user_id)
+        if user is None:
+            user_dao.upsert_user({f"platforms.{WEB_PLATFORM}.id": user_id}, {"name": user_id, "status": "normal"})
+            user = user_dao.get_user_by_platform(WEB_PLATFORM, user_id)
+        return user
+    except Exception as e:
+        logger.error(f"Failed to resolve user {user_id}: {e}")
+        return None
 
 # Fallback: In-memory conversation history
 conversation_history = []
@@ -86,14 +212,12 @@ def get_conversation_history(user_id="demo_user", limit=5):
             docs = mongo_db.find_many(
                 "coke_conversations",
                 {"user_id": user_id},
-                limit=100
+                limit=limit,
+                sort=[("timestamp", -1)]
             )
             if docs:
-                # Sort by timestamp and get recent
-                sorted_docs = sorted(docs, key=lambda x: x.get("timestamp", ""), reverse=True)
-                recent = sorted_docs[:limit]
-                recent.reverse()  # Oldest first
-                return recent
+                docs.reverse()  # Oldest first
+                return docs
         except Exception as e:
             print(f"Error reading from MongoDB: {e}")
     
@@ -104,11 +228,12 @@ def get_conversation_history(user_id="demo_user", limit=5):
 
 def save_conversation_message(user_id, user_message, coke_response):
     """Save conversation to MongoDB or memory."""
+    now = datetime.now()
     message_data = {
         "user_id": user_id,
         "user": user_message,
         "coke": coke_response,
-        "timestamp": datetime.now().isoformat()
+        "timestamp": now
     }
     
     if USE_MONGODB and mongo_db:
@@ -116,12 +241,17 @@ def save_conversation_message(user_id, user_message, coke_response):
             # Save to MongoDB
             mongo_db.insert_one("coke_conversations", message_data)
             
+            # Embed the turn for long-term memory (in the background)
+            if conversation_memory:
+                conversation_memory.remember_turn(user_id, user_message, coke_response, now)
+            
             # Update last activity timestamp for this user
             existing = mongo_db.find_one("user_activity", {"user_id": user_id})
             activity_data = {
                 "user_id": user_id,
-                "last_message_time": datetime.now().isoformat(),
-                "updated_at": datetime.now().isoformat()
+                "last_message_time": now,
+                "updated_at": now,
+                "user_shard": user_shard(user_id)
             }
             
             if existing:
@@ -131,10 +261,13 @@ def save_conversation_message(user_id, user_message, coke_response):
                     activity_data["last_checkin_time"] = existing["last_checkin_time"]
                 mongo_db.replace_one("user_activity", {"user_id": user_id}, activity_data)
             else:
-                # Insert new
-                activity_data["last_checkin_time"] = ""
+                # Insert new (no last_checkin_time until the first check-in)
                 mongo_db.insert_one("user_activity", activity_data)
             
+            # Reminder messages generated ahead of time no longer reflect the latest chat
+            if reminder_scheduler:
+                reminder_scheduler.invalidate_pregenerated_messages(user_id)
+            
             print(f"💾 Saved to MongoDB: {user_message[:30]}...")
         except Exception as e:
             print(f"Error saving to MongoDB: {e}")
@@ -144,6 +277,19 @@ def save_conversation_message(user_id, user_message, coke_response):
         # Save to memory
         conversation_history.append(message_data)
 
+def prepare_reminder_for_client(reminder):
+    """Make a ready reminder JSON-serializable (messages are generated by the background runner)."""
+    if reminder.get("is_checkin") and not reminder.get("message"):
+        reminder = dict(reminder)
+        reminder["message"] = "hey，在干嘛呢？"
+    
+    # Serialize ObjectId to string for JSON
+    if '_id' in reminder:
+        reminder = dict(reminder)  # Make a copy if needed
+        reminder['_id'] = str(reminder['_id'])
+    
+    return reminder
+
 @app.route('/')
 def index():
     """Main page."""
@@ -159,8 +305,18 @@ def chat():
         if not user_message:
             return jsonify({'error': 'Message is required'}), 400
         
-        # Get conversation history (from MongoDB or memory)
+        # Stopped users get no replies or reminders
         user_id = data.get('user_id', 'demo_user')
+        user = resolve_user(user_id)
+        if user and user.get('status') == 'stopped':
+            return jsonify({
+                'responses': [],
+                'status': 'success',
+                'reminder_created': False,
+                'reminder_id': None
+            })
+        
+        # Get conversation history (from MongoDB or memory)
         recent_messages = get_conversation_history(user_id, limit=5)
         
         # Build conversation history string
@@ -171,10 +327,17 @@ def chat():
                 for msg in recent_messages
             ])
         
+        # Retrieve relevant older turns that fall outside the recent window
+        relevant_memories = ""
+        if conversation_memory:
+            before = recent_messages[0]["timestamp"] if recent_messages else None
+            relevant_memories = conversation_memory.build_context(user_id, user_message, before=before)
+        
         # Create context
         context = {
             "user_message": user_message,
             "conversation_history": history_str,
+            "relevant_memories": relevant_memories,
             "user_id": "demo_user",
             "current_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
@@ -253,6 +416,8 @@ def clear():
         try:
             deleted = mongo_db.delete_many("coke_conversations", {"user_id": user_id})
             print(f"🗑️  Cleared {deleted} messages from MongoDB")
+            if conversation_memory:
+                mongo_db.delete_many(conversation_memory.collection_name, {"metadata.user_id": user_id})
         except Exception as e:
             print(f"Error clearing MongoDB: {e}")
     
@@ -278,7 +443,7 @@ def history():
 
 @app.route('/api/check_reminders', methods=['GET'])
 def check_reminders():
-    """Check for pending reminders for a user."""
+    """Check for pending reminders for a user (polling fallback for /api/reminders/stream)."""
     user_id = request.args.get('user_id', 'demo_user')
     
     if not background_runner:
@@ -289,7 +454,7 @@ def check_reminders():
         })
     
     # Log the current state before retrieval
-    total_pending = len(background_runner.pending_reminders)
+    total_pending = len(background_runner.delivery_store)
     logger.info(f"🔔 Frontend polling for {user_id}. Total pending: {total_pending}")
     
     # Get pending reminders from background runner
@@ -300,54 +465,7 @@ def check_reminders():
     else:
         logger.debug(f"📭 No pending reminders for {user_id}")
     
-    # Process check-in reminders (generate AI message)
-    processed_reminders = []
-    for reminder in pending:
-        if reminder.get("is_checkin"):
-            # Generate contextual check-in message
-            try:
-                from coke.agent.coke_proactive_agent import CokeProactiveAgent
-                
-                # Get recent conversation for context
-                recent = get_conversation_history(user_id, limit=3)
-                history_str = "\n".join([
-                    f"用户: {msg['user']}\nCoke: {msg['coke']}"
-                    for msg in recent
-                ]) if recent else ""
-                
-                # Extract last task if any
-                last_task = ""
-                for msg in reversed(recent):
-                    if "学" in msg.get('user', '') or "做" in msg.get('user', ''):
-                        last_task = msg.get('user', '')
-                        break
-                
-                # Generate check-in message using proactive agent
-                checkin_context = {
-                    "message_type": "checkin",
-                    "conversation_history": history_str,
-                    "last_task": last_task
-                }
-                
-                checkin_agent = CokeProactiveAgent(checkin_context)
-                for result in checkin_agent.run():
-                    if result["status"] == "FINISHED":
-                        reminder["message"] = checkin_context.get("checkin_message", "hey，在干嘛呢？")
-                        break
-                
-                if not reminder.get("message"):
-                    reminder["message"] = "hey，在干嘛呢？"
-                    
-            except Exception as e:
-                logger.error(f"Failed to generate check-in message: {e}")
-                reminder["message"] = "hey，还好吗？"
-        
-        # Serialize ObjectId to string for JSON
-        if '_id' in reminder:
-            reminder = dict(reminder)  # Make a copy if needed
-            reminder['_id'] = str(reminder['_id'])
-        
-        processed_reminders.append(reminder)
+    processed_reminders = [prepare_reminder_for_client(reminder) for reminder in pending]
     
     return jsonify({
         'reminders': processed_reminders,
@@ -355,6 +473,47 @@ def check_reminders():
         'status': 'success'
     })
 
+@app.route('/api/reminders/stream', methods=['GET'])
+def reminder_stream():
+    """Server-Sent Events channel pushing reminders to the browser as soon as they are ready."""
+    user_id = request.args.get('user_id', 'demo_user')
+    
+    if not background_runner:
+        return jsonify({
+            'status': 'disabled',
+            'message': 'Reminder system requires MongoDB'
+        }), 503
+    
+    delivery_store = background_runner.delivery_store
+    # Messages already waiting are queued on the channel together with the subscription,
+    # so one added in between is not sent twice
+    channel = delivery_store.subscribe(user_id, replay_pending=True)
+    logger.info(f"📡 Push channel opened for {user_id}")
+    
+    def sse_event(reminder):
+        data = app.json.dumps(prepare_reminder_for_client(reminder))
+        return f"event: reminder\ndata: {data}\n\n"
+    
+    def generate():
+        try:
+            while True:
+                try:
+                    reminder = channel.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                    continue
+                yield sse_event(reminder)
+        finally:
+            delivery_store.unsubscribe(user_id, channel)
+            logger.info(f"📡 Push channel closed for {user_id}")
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/reminders/list', methods=['GET'])
 def list_reminders():
     """List all reminders for a user (pending and sent)."""
@@ -414,13 +573,22 @@ def debug_reminders():
         now = datetime.now().isoformat()
         
         # Serialize pending reminders too
-        pending_reminders = background_runner.pending_reminders if background_runner else []
+        pending_reminders = background_runner.delivery_store.snapshot() if background_runner else []
         serialized_pending = [serialize_reminder(dict(r)) for r in pending_reminders]
         
+        # Attach each reminder's user, loading all of them in one query
+        users = user_dao.platform_user_loader(WEB_PLATFORM, projection={"_id": 0, "name": 1, "status": 1})
+        reminders = serialized_reminders + serialized_pending
+        for reminder, user in zip(reminders, users.load_many([r.get('user_id') for r in reminders])):
+            reminder['user'] = {'name': user.get('name'), 'status': user.get('status')} if user else None
+        
         # Background runner status
         runner_status = {
             'running': background_runner.running if background_runner else False,
+            'worker_id': background_runner.worker_id if background_runner else None,
+            'shard': f"{background_runner.shard_index}/{background_runner.shard_count}" if background_runner else None,
             'check_interval': background_runner.check_interval if background_runner else 0,
+            'event_driven': background_runner.event_mode if background_runner else False,
             'pending_count': len(pending_reminders),
             'pending_reminders': serialized_pending
         }
@@ -430,6 +598,7 @@ def debug_reminders():
             'total_reminders': len(serialized_reminders),
             'all_reminders': serialized_reminders,
             'background_runner': runner_status,
+            'user_cache': user_dao.cache_stats(),
             'status': 'success'
         })
     except Exception as e:
@@ -450,14 +619,10 @@ def debug_trigger_check():
         })
     
     try:
-        # Manually check for due reminders
-        due_reminders = reminder_scheduler.get_due_reminders()
-        
-        logger.info(f"Manual check triggered: found {len(due_reminders)} due reminders")
+        # Claim, generate and deliver due reminders exactly as the runner's own check does
+        due_reminders = background_runner.trigger_check()
         
-        for reminder in due_reminders:
-            background_runner.pending_reminders.append(reminder)
-            reminder_scheduler.mark_reminder_sent(reminder["_id"])
+        logger.info(f"Manual check triggered: delivered {len(due_reminders)} due reminders")
         
         # Serialize ObjectIds for JSON
         def serialize_reminder(reminder):
@@ -471,7 +636,7 @@ def debug_trigger_check():
         return jsonify({
             'found_due': len(due_reminders),
             'due_reminders': serialized_due,
-            'pending_after': len(background_runner.pending_reminders),
+            'pending_after': len(background_runner.delivery_store),
             'status': 'success'
         })
     except Exception as e:
@@ -487,13 +652,9 @@ if __name__ == '__main__':
     print("🥤 Coke Agent Demo")
     print("=" * 60)
     print()
-    print("Storage Mode:", "📦 MongoDB (Persistent)" if USE_MONGODB else "💾 In-Memory (Session Only)")
-    if USE_MONGODB:
-        print("  ✅ Conversations will persist across restarts")
-        print("  ✅ Each user has separate conversation history")
-    else:
-        print("  ⚠️  Conversations reset when server restarts")
-        print("  💡 Install MongoDB for persistent storage")
+    print("Storage Mode: connects to MongoDB on the first request")
+    print("  ✅ With MongoDB, conversations persist and each user has separate history")
+    print("  💡 Without MongoDB, conversations reset when the server restarts")
     print()
     print("Starting Flask server on http://localhost:5001")
     print()
@@ -118,9 +118,9 @@ class MockMongoDBBase:
 def embedding_by_aliyun(text: str) -> list:
     """Mock embedding function."""
     logger.info(f"Mock embedding_by_aliyun: {text[:50]}...")
-    # Return a random 1536-dim vector
-    import random
-    return [random.random() for _ in range(1536)]
+    # Deterministic 1536-dim vector: the same text always gets the same embedding
+    from coke.memory.embedding_service import local_embedding
+    return local_embedding([text])[0]
 
 def aliyun_search(query: str, limit: int = 10) -> list:
     """Mock search function."""
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 模块按仓库根目录导入（from dao.xxx import ...）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,70 @@
+"""
+BatchLoader的合并与缓存测试；按平台ID批量读取的测试需要本地MongoDB，连不上时跳过
+"""
+import pytest
+from pymongo.errors import PyMongoError
+
+from conf.config import CONF
+from dao.batch_loader import BatchLoader
+from dao.user_dao import UserDAO
+
+TEST_DB_NAME = CONF["mongodb"]["mongodb_name"] + "_test"
+
+
+class FakeBatch:
+    def __init__(self, known):
+        self.known = known
+        self.calls = []
+
+    def __call__(self, keys):
+        self.calls.append(list(keys))
+        return [self.known.get(key) for key in keys]
+
+
+def test_deferred_ids_are_loaded_in_one_call():
+    batch_fn = FakeBatch({"a": {"name": "A"}, "b": {"name": "B"}})
+    loader = BatchLoader(batch_fn)
+    pending = loader.defer_many(["a", "b", "a", "missing"])
+
+    assert [load.result() for load in pending] == [{"name": "A"}, {"name": "B"}, {"name": "A"}, None]
+    assert batch_fn.calls == [["a", "b", "missing"]]
+
+    # 同一请求中再次读取（包括不存在的ID）不再查询
+    assert loader.load_many(["b", "missing"]) == [{"name": "B"}, None]
+    assert len(batch_fn.calls) == 1
+
+
+def test_large_batches_are_split_and_primed_ids_skipped():
+    batch_fn = FakeBatch({key: {"n": key} for key in range(5)})
+    loader = BatchLoader(batch_fn, max_batch_size=2)
+    loader.prime(0, {"n": "primed"})
+
+    assert loader.load_many(range(5))[0] == {"n": "primed"}
+    assert batch_fn.calls == [[1, 2], [3, 4]]
+
+    loader.clear(1)
+    loader.load(1)
+    assert batch_fn.calls[-1] == [1]
+
+
+@pytest.fixture
+def user_dao():
+    dao = UserDAO(db_name=TEST_DB_NAME, client_options={"serverSelectionTimeoutMS": 1000})
+    try:
+        dao.client.admin.command("ping")
+    except PyMongoError as e:
+        pytest.skip(f"MongoDB unavailable: {e}")
+    dao.client.drop_database(TEST_DB_NAME)
+    yield dao
+    dao.client.drop_database(TEST_DB_NAME)
+
+
+def test_platform_user_loader_reads_users_by_platform_id(user_dao):
+    user_dao.create_user({"name": "first", "platforms": {"web": {"id": "u1"}}})
+    user_dao.create_user({"name": "second", "platforms": {"web": {"id": "u2"}}})
+    loader = user_dao.platform_user_loader("web", projection={"_id": 0, "name": 1})
+
+    users = loader.load_many(["u2", "nobody", "u1"])
+
+    assert [user and user["name"] for user in users] == ["second", None, "first"]
+    assert loader.stats["queries"] == 1
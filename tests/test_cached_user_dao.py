@@ -0,0 +1,100 @@
+"""
+CachedUserDAO的缓存行为测试：UserDAO的数据库读写替换为内存中的假实现，不需要MongoDB
+"""
+import types
+
+import pytest
+from bson import ObjectId
+
+import dao.cached_user_dao as cached_user_dao
+from dao.cached_user_dao import CachedUserDAO
+from dao.user_dao import UserDAO
+
+
+class FakeUsers:
+    """替代UserDAO中用到的数据库操作，记录读取次数"""
+
+    def __init__(self):
+        self.users = {}
+        self.reads = 0
+
+    def find_platform(self, platform, platform_id):
+        self.reads += 1
+        for user in self.users.values():
+            if user.get("platforms", {}).get(platform, {}).get("id") == platform_id:
+                return dict(user)
+        return None
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(cached_user_dao, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    fake = FakeUsers()
+
+    def get_user_by_platform(self, platform, platform_id, projection=None):
+        return fake.find_platform(platform, platform_id)
+
+    def create_user(self, user_data):
+        user_data.setdefault("_id", ObjectId())
+        fake.users[user_data["_id"]] = dict(user_data)
+        return str(user_data["_id"])
+
+    def dedupe_platform_users(self, platform):
+        fake.users.clear()
+        return 1
+
+    monkeypatch.setattr(UserDAO, "get_user_by_platform", get_user_by_platform)
+    monkeypatch.setattr(UserDAO, "create_user", create_user)
+    monkeypatch.setattr(UserDAO, "dedupe_platform_users", dedupe_platform_users)
+    return fake
+
+
+def test_entries_expire_after_ttl(backend, clock):
+    dao = CachedUserDAO(ttl=10, negative_ttl=1)
+    dao.create_user({"name": "a", "platforms": {"web": {"id": "u1"}}})
+
+    for _ in range(3):
+        assert dao.get_user_by_platform("web", "u1")["name"] == "a"
+    assert backend.reads == 1
+    assert dao.hit_ratio() == pytest.approx(2 / 3)
+
+    clock[0] = 11
+    dao.get_user_by_platform("web", "u1")
+    assert backend.reads == 2
+    assert dao.cache_stats()["expired"] == 1
+
+
+def test_negative_entry_is_invalidated_by_create(backend, clock):
+    dao = CachedUserDAO(ttl=10, negative_ttl=5)
+    assert dao.get_user_by_platform("web", "u1") is None
+    assert dao.get_user_by_platform("web", "u1") is None
+    assert backend.reads == 1
+
+    dao.create_user({"name": "a", "platforms": {"web": {"id": "u1"}}})
+    assert dao.get_user_by_platform("web", "u1")["name"] == "a"
+    assert backend.reads == 2
+
+
+def test_negative_entry_expires_before_positive_ttl(backend, clock):
+    dao = CachedUserDAO(ttl=10, negative_ttl=5)
+    dao.get_user_by_platform("web", "u1")
+    backend.users["x"] = {"_id": "x", "name": "other process", "platforms": {"web": {"id": "u1"}}}
+
+    clock[0] = 6
+    assert dao.get_user_by_platform("web", "u1")["name"] == "other process"
+
+
+def test_dedupe_clears_cache(backend, clock):
+    dao = CachedUserDAO()
+    dao.create_user({"name": "a", "platforms": {"web": {"id": "u1"}}})
+    assert dao.get_user_by_platform("web", "u1") is not None
+
+    dao.dedupe_platform_users("web")
+    assert dao.get_user_by_platform("web", "u1") is None
+    assert backend.reads == 2
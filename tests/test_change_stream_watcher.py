@@ -0,0 +1,93 @@
+"""
+ChangeStreamWatcher的恢复测试，需要副本集（见change_stream_watcher.py中的单节点副本集说明），
+连不上MongoDB或不是副本集时跳过。使用单独的测试库，结束后删除
+"""
+import queue
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo.errors import PyMongoError
+
+from conf.config import CONF
+from dao.mongo import MongoDBBase
+from coke.scheduler.change_stream_watcher import ChangeStreamWatcher, TOKEN_COLLECTION
+
+TEST_DB_NAME = CONF["mongodb"]["mongodb_name"] + "_test"
+
+
+@pytest.fixture
+def mongo_db():
+    db = MongoDBBase(db_name=TEST_DB_NAME, client_options={"serverSelectionTimeoutMS": 1000})
+    try:
+        hello = db.client.admin.command("hello")
+    except PyMongoError as e:
+        pytest.skip(f"MongoDB unavailable: {e}")
+    if not hello.get("setName"):
+        pytest.skip("MongoDB is not a replica set, change streams unavailable")
+    db.client.drop_database(TEST_DB_NAME)
+    yield db
+    db.client.drop_database(TEST_DB_NAME)
+
+
+def start_watcher(mongo_db, events):
+    watcher = ChangeStreamWatcher(mongo_db, on_reminder=events.put, stream_id="test-host",
+                                  max_await_time_ms=100, token_save_interval=0)
+    assert watcher.start()
+    return watcher
+
+
+def insert_reminder(mongo_db, description):
+    mongo_db.get_collection("coke_reminders").insert_one({
+        "task_description": description,
+        "reminder_time": datetime.now(),
+        "status": "pending",
+        "message": ""
+    })
+
+
+def test_restarted_watcher_resumes_from_saved_token(mongo_db):
+    events = queue.Queue()
+    watcher = start_watcher(mongo_db, events)
+    try:
+        # 流打开之前写入的事件不会收到，重试直到第一条到达
+        for _ in range(50):
+            insert_reminder(mongo_db, "before restart")
+            try:
+                events.get(timeout=0.2)
+                break
+            except queue.Empty:
+                continue
+        else:
+            pytest.fail("watcher received no events")
+    finally:
+        watcher.stop()
+
+    token = mongo_db.find_one(TOKEN_COLLECTION, {"_id": "coke_reminders@test-host"})
+    assert token and token.get("resume_token")
+
+    # 停止期间写入的提醒在重启后从保存的位置补收
+    insert_reminder(mongo_db, "while stopped")
+    while not events.empty():
+        events.get_nowait()
+    watcher = start_watcher(mongo_db, events)
+    try:
+        received = []
+        while "while stopped" not in received:
+            received.append(events.get(timeout=10)["task_description"])
+    finally:
+        watcher.stop()
+    assert mongo_db.get_collection(TOKEN_COLLECTION).count_documents({}) == 1
+
+
+def test_start_deletes_stale_tokens(mongo_db):
+    tokens = mongo_db.get_collection(TOKEN_COLLECTION)
+    tokens.insert_one({"_id": "coke_reminders@retired-host", "resume_token": {"_data": "00"},
+                       "updated_at": datetime.now() - timedelta(days=30)})
+    tokens.insert_one({"_id": "coke_reminders@other-host", "resume_token": {"_data": "00"},
+                       "updated_at": datetime.now()})
+
+    watcher = start_watcher(mongo_db, queue.Queue())
+    watcher.stop()
+
+    assert tokens.find_one({"_id": "coke_reminders@retired-host"}) is None
+    assert tokens.find_one({"_id": "coke_reminders@other-host"}) is not None
@@ -0,0 +1,17 @@
+import framework.agent.llmagent.doubao_llmagent as doubao_llmagent
+from coke.agent.coke_response_agent import CokeResponseAgent
+
+
+def test_braces_in_memories_survive_prompt_formatting(monkeypatch):
+    monkeypatch.setattr(doubao_llmagent, "get_doubao_client", lambda: object())
+    memory = '用户说过: {"food": "咖啡"} 和 {name}'
+    agent = CokeResponseAgent(context={
+        "user_message": "还记得我喜欢什么吗 {}",
+        "conversation_history": "",
+        "relevant_memories": memory,
+    })
+
+    agent._prehandle()
+
+    assert memory in agent.context["userp"]
+    assert "还记得我喜欢什么吗 {}" in agent.context["userp"]
@@ -0,0 +1,41 @@
+import queue
+import threading
+
+from coke.scheduler.delivery_store import DeliveryStore
+
+
+def drain(channel):
+    items = []
+    while True:
+        try:
+            items.append(channel.get_nowait())
+        except queue.Empty:
+            return items
+
+
+def test_subscribe_replays_pending_then_pushes_new():
+    store = DeliveryStore()
+    store.add({"user_id": "u", "task_description": "first"})
+    store.add({"user_id": "other", "task_description": "not mine"})
+
+    channel = store.subscribe("u", replay_pending=True)
+    store.add({"user_id": "u", "task_description": "second"})
+
+    assert [r["task_description"] for r in drain(channel)] == ["first", "second"]
+
+
+def test_message_added_while_subscribing_arrives_once():
+    store = DeliveryStore()
+    count = 2000
+
+    def producer():
+        for i in range(count):
+            store.add({"user_id": "u", "n": i})
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    channel = store.subscribe("u", replay_pending=True)
+    thread.join()
+
+    received = [r["n"] for r in drain(channel)]
+    assert sorted(received) == list(range(count))
@@ -0,0 +1,57 @@
+import os
+import pickle
+
+import numpy as np
+
+from dao.embedding_store import EmbeddingStore
+
+
+def random_vectors(count, dimension=8, seed=0):
+    return np.random.default_rng(seed).normal(size=(count, dimension))
+
+
+def test_corrupt_wal_record_is_truncated_and_later_appends_survive(tmp_path):
+    path = str(tmp_path / "store")
+    vectors = random_vectors(10)
+    store = EmbeddingStore.open(path)
+    store.add_many([0, 1], vectors[:2])
+    with open(f"{path}.wal", "ab") as f:
+        f.write(b"\x10\x00\x00\x00garbage")
+    store.add(2, vectors[2])
+
+    reopened = EmbeddingStore.open(path)
+    assert sorted(reopened.ids) == [0, 1]
+
+    reopened.add(3, vectors[3])
+    assert sorted(EmbeddingStore.open(path).ids) == [0, 1, 3]
+
+
+def test_wal_is_compacted_past_threshold(tmp_path):
+    path = str(tmp_path / "store")
+    vectors = random_vectors(50)
+    store = EmbeddingStore.open(path, wal_compact_bytes=2000)
+    for i in range(50):
+        store.add(i, vectors[i])
+    store.remove(0)
+    store.wait_for_compaction()
+
+    assert len(store._base_ids) > 0
+    assert os.path.getsize(f"{path}.wal") < 50 * (len(pickle.dumps(vectors[0])) + 20)
+    reopened = EmbeddingStore.open(path)
+    assert sorted(reopened.ids) == list(range(1, 50))
+    assert reopened.search(vectors[7], 1)[0][0] == 7
+
+
+def test_compaction_keeps_writes_from_another_store(tmp_path):
+    path = str(tmp_path / "store")
+    vectors = random_vectors(4)
+    first = EmbeddingStore.open(path, wal_compact_bytes=None)
+    second = EmbeddingStore.open(path, wal_compact_bytes=None)
+    first.add(0, vectors[0])
+    second.add(1, vectors[1])
+
+    first.compact()
+    second.add(2, vectors[2])
+    second.compact()
+
+    assert sorted(EmbeddingStore.open(path).ids) == [0, 1, 2]
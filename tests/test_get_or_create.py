@@ -0,0 +1,119 @@
+"""
+get-or-create的并发与索引迁移测试，需要本地MongoDB（config.json中的地址），连不上时跳过。
+使用单独的测试库，结束后删除
+"""
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from pymongo.errors import PyMongoError
+
+from conf.config import CONF
+from dao.conversation_dao import ConversationDAO
+from dao.user_dao import UserDAO
+
+TEST_DB_NAME = CONF["mongodb"]["mongodb_name"] + "_test"
+CLIENT_OPTIONS = {"serverSelectionTimeoutMS": 1000}
+
+
+@pytest.fixture
+def conversation_dao():
+    dao = ConversationDAO(db_name=TEST_DB_NAME, client_options=CLIENT_OPTIONS)
+    try:
+        dao.client.admin.command("ping")
+    except PyMongoError as e:
+        pytest.skip(f"MongoDB unavailable: {e}")
+    dao.client.drop_database(TEST_DB_NAME)
+    yield dao
+    dao.client.drop_database(TEST_DB_NAME)
+
+
+@pytest.fixture
+def user_dao(conversation_dao):
+    return UserDAO(db_name=TEST_DB_NAME, client_options=CLIENT_OPTIONS)
+
+
+def test_concurrent_first_contact_creates_one_conversation(conversation_dao):
+    num_threads, num_pairs, platform = 32, 20, "stress_test"
+    conversation_dao.create_indexes()
+    pairs = [(f"user{i}", f"user{i + 1000}") for i in range(num_pairs)]
+    groups = [f"group{i}" for i in range(num_pairs)]
+
+    def first_contact(worker):
+        rng = random.Random(worker)
+        results = []
+        for i in rng.sample(range(num_pairs), num_pairs):
+            user_a, user_b = pairs[i] if worker % 2 else pairs[i][::-1]
+            results.append((("private", i), conversation_dao.get_or_create_private_conversation(
+                platform, user_a, user_a, user_b, user_b)))
+            results.append((("group", i), conversation_dao.get_or_create_group_conversation(
+                platform, groups[i], [{"id": user_a, "nickname": user_a}])))
+        return results
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        all_results = [item for results in executor.map(first_contact, range(num_threads)) for item in results]
+
+    ids, created = {}, {}
+    for key, (conversation_id, is_new) in all_results:
+        ids.setdefault(key, set()).add(conversation_id)
+        created[key] = created.get(key, 0) + int(is_new)
+
+    assert all(len(found) == 1 for found in ids.values())
+    assert all(count == 1 for count in created.values())
+    assert conversation_dao.count_conversations({"platform": platform}) == 2 * num_pairs
+
+
+def test_migrate_dedupe_marks_legacy_duplicate_conversations(conversation_dao):
+    collection = conversation_dao.collection
+    # 旧版本的非唯一同名索引和唯一索引之前产生的重复数据
+    collection.create_index([("platform", 1), ("chatroom_name", 1)])
+    first = collection.insert_one({"platform": "wechat", "chatroom_name": "room",
+                                   "talkers": [{"id": "a"}], "conversation_info": {"topic": "x"}}).inserted_id
+    second = collection.insert_one({"platform": "wechat", "chatroom_name": "room",
+                                    "talkers": [{"id": "b"}], "conversation_info": {"topic": "y", "mood": "z"}}).inserted_id
+    for talkers in ([{"id": "a"}, {"id": "b"}], [{"id": "b"}, {"id": "a"}]):
+        collection.insert_one({"platform": "wechat", "chatroom_name": None, "talkers": talkers,
+                               "private_key": "wechat|a|b", "conversation_info": {}})
+
+    conversation_dao.migrate(dedupe=True)
+
+    assert collection.index_information()["platform_1_chatroom_name_1"].get("unique")
+    assert collection.count_documents({}) == 4
+    assert collection.count_documents({"private_key": "wechat|a|b"}) == 1
+    assert collection.count_documents({"duplicate_of": {"$exists": True}}) == 2
+    assert collection.find_one({"_id": second})["duplicate_of"] == first
+    group = conversation_dao.get_group_conversation("wechat", "room")
+    assert group["_id"] == first
+    assert [talker["id"] for talker in group["talkers"]] == ["a", "b"]
+    assert group["conversation_info"] == {"topic": "x", "mood": "z"}
+    assert conversation_dao.get_or_create_private_conversation("wechat", "b", "b", "a", "a")[1] is False
+
+
+def test_create_indexes_detaches_duplicate_platform_users(user_dao):
+    collection = user_dao.collection
+    collection.create_index([("platforms.wechat.id", 1)])
+    first = user_dao.create_user({"name": "first", "platforms": {"wechat": {"id": "wx1"}}})
+    second = user_dao.create_user({"name": "second", "platforms": {"wechat": {"id": "wx1"}}})
+
+    user_dao.create_indexes()
+
+    assert collection.index_information()["platforms.wechat.id_1"].get("unique")
+    assert str(user_dao.get_user_by_platform("wechat", "wx1")["_id"]) == first
+    assert user_dao.get_user_by_id(second)["duplicate_of"] == user_dao.get_user_by_id(first)["_id"]
+
+
+def test_migrate_backfills_legacy_private_conversations(conversation_dao):
+    collection = conversation_dao.collection
+    legacy = collection.insert_one({"platform": "wechat", "chatroom_name": None,
+                                    "talkers": [{"id": "b"}, {"id": "a"}], "conversation_info": {}}).inserted_id
+    assert conversation_dao.get_private_conversation("wechat", "a", "b")["_id"] == legacy
+
+    collection.update_one({"_id": legacy}, {"$unset": {"private_key": ""}})
+    assert conversation_dao.migrate() == 1
+    assert collection.find_one({"_id": legacy})["private_key"] == "wechat|a|b"
+
+    # 迁移完成后没有键的单聊不再被查找
+    collection.insert_one({"platform": "wechat", "chatroom_name": None,
+                           "talkers": [{"id": "c"}, {"id": "d"}], "conversation_info": {}})
+    assert ConversationDAO(db_name=TEST_DB_NAME, client_options=CLIENT_OPTIONS).get_private_conversation(
+        "wechat", "c", "d") is None
@@ -0,0 +1,58 @@
+import numpy as np
+
+from dao.hnsw_index import HNSWIndex
+
+
+def random_vectors(count, dimension=16, seed=0):
+    return np.random.default_rng(seed).normal(size=(count, dimension))
+
+
+def test_small_index_searches_exactly_without_graph():
+    vectors = random_vectors(200)
+    index = HNSWIndex(min_graph_size=1000)
+    index.add_many(list(range(200)), vectors)
+
+    assert not index.graph_ready
+    assert [doc_id for doc_id, _ in index.search(vectors[7], 1)] == [7]
+    assert [hits[0][0] for hits in index.search_many(vectors[:3], 1)] == [0, 1, 2]
+
+
+def test_overwrites_count_towards_rebuild():
+    vectors = random_vectors(300)
+    index = HNSWIndex(min_graph_size=1000)
+    index.add_many(list(range(200)), vectors[:200])
+    for _ in range(2):
+        index.add_many(list(range(100)), vectors[200:])
+    index.wait_for_rebuild()
+
+    assert len(index) == 200
+    assert index._deleted_count == 0
+    assert index.search(vectors[200], 1)[0][0] == 0
+
+
+def test_graph_is_built_in_background_and_replays_concurrent_writes():
+    vectors = random_vectors(600)
+    index = HNSWIndex(min_graph_size=500)
+    index.add_many(list(range(400)), vectors[:400])
+    index.add_many(list(range(400, 600)), vectors[400:])
+    index.remove(599)
+    index.add(598, vectors[0])
+    index.wait_for_rebuild()
+
+    assert index.graph_ready
+    assert 599 not in index and len(index) == 599
+    assert {doc_id for doc_id, _ in index.search(vectors[0], 2)} == {0, 598}
+
+
+def test_snapshot_round_trip(tmp_path):
+    vectors = random_vectors(300)
+    index = HNSWIndex(min_graph_size=0)
+    index.bulk_load([(list(range(300)), vectors)])
+    path = str(tmp_path / "index.hnsw")
+    index.save(path)
+
+    loaded = HNSWIndex.load(path)
+    assert loaded.graph_ready and len(loaded) == 300
+    assert loaded.search(vectors[42], 1)[0][0] == 42
+    loaded.add(1000, vectors[42])
+    assert {doc_id for doc_id, _ in loaded.search(vectors[42], 2)} == {42, 1000}
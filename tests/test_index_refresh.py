@@ -0,0 +1,73 @@
+"""
+进程内索引的增量同步测试：另一个MongoDBBase（相当于另一个进程）和通用写方法的写入在下次检索时可见。
+需要本地MongoDB，连不上时跳过。使用单独的测试库，结束后删除
+"""
+import pytest
+from bson import ObjectId
+from pymongo.errors import PyMongoError
+
+from conf.config import CONF
+from dao.mongo import MongoDBBase
+
+TEST_DB_NAME = CONF["mongodb"]["mongodb_name"] + "_test"
+COLLECTION = "memories"
+
+
+@pytest.fixture
+def databases():
+    reader = MongoDBBase(db_name=TEST_DB_NAME, client_options={"serverSelectionTimeoutMS": 1000},
+                         index_refresh_interval=0)
+    try:
+        reader.client.admin.command("ping")
+    except PyMongoError as e:
+        pytest.skip(f"MongoDB unavailable: {e}")
+    reader.client.drop_database(TEST_DB_NAME)
+    writer = MongoDBBase(db_name=TEST_DB_NAME, client_options={"serverSelectionTimeoutMS": 1000})
+    reader.create_vector_collection(COLLECTION)
+    yield reader, writer
+    reader.client.drop_database(TEST_DB_NAME)
+
+
+def search_ids(db, query, **kwargs):
+    return [str(doc["_id"]) for doc in db.vector_search(COLLECTION, query, top_k=10, similarity_threshold=-1.0,
+                                                         include_embeddings=False, **kwargs)]
+
+
+def test_writes_from_another_instance_are_visible(databases):
+    reader, writer = databases
+    first = reader.insert_vector(COLLECTION, "a", "a", [1.0, 0.0], [1.0, 0.0], {"user_id": "u"})
+    assert search_ids(reader, [1.0, 0.0]) == [first]
+
+    second = writer.insert_vector(COLLECTION, "b", "b", [0.0, 1.0], [0.0, 1.0], {"user_id": "u"})
+    assert search_ids(reader, [0.0, 1.0])[0] == second
+
+    writer.delete_vector(COLLECTION, second)
+    assert search_ids(reader, [0.0, 1.0]) == [first]
+
+
+def test_generic_writes_are_visible(databases):
+    reader, writer = databases
+    first = reader.insert_vector(COLLECTION, "a", "a", [1.0, 0.0], [1.0, 0.0], {"user_id": "u"})
+    search_ids(reader, [1.0, 0.0])
+
+    other = writer.insert_one(COLLECTION, {"key": "c", "value": "c", "key_embedding": [0.0, 1.0],
+                                           "value_embedding": [0.0, 1.0], "metadata": {"user_id": "w"}})
+    assert search_ids(reader, [0.0, 1.0], metadata_filters={"user_id": "w"}) == [other]
+
+    writer.update_one(COLLECTION, {"_id": ObjectId(first)}, {"$set": {"key_embedding": [0.0, 1.0]}})
+    assert set(search_ids(reader, [0.0, 1.0])) == {first, other}
+    assert reader.vector_search(COLLECTION, [0.0, 1.0], top_k=2)[1]["similarity"] == pytest.approx(1.0)
+
+    writer.delete_many(COLLECTION, {"metadata.user_id": "w"})
+    assert search_ids(reader, [0.0, 1.0]) == [first]
+
+
+def test_update_of_missing_document_is_not_indexed(databases):
+    reader, _ = databases
+    reader.insert_vector(COLLECTION, "a", "a", [1.0, 0.0], [1.0, 0.0], {})
+    search_ids(reader, [1.0, 0.0])
+
+    missing = str(ObjectId())
+    assert not reader.update_vector(COLLECTION, missing, key="ghost", key_embedding=[0.0, 1.0])
+    assert missing not in search_ids(reader, [0.0, 1.0])
+    assert reader.text_search(COLLECTION, "ghost") == []
@@ -0,0 +1,25 @@
+from dao.metadata_bitmap import MetadataBitmaps, SPARSE_MIN
+
+
+def test_match_across_sparse_and_dense_values():
+    bitmaps = MetadataBitmaps()
+    for i in range(1000):
+        bitmaps.add(i, {"user_id": f"u{i % 4}", "timestamp": i, "tags": ["even" if i % 2 == 0 else "odd"]})
+
+    assert not isinstance(bitmaps._bitmaps[("user_id", "u1")], set)
+    assert isinstance(bitmaps._bitmaps[("timestamp", 7)], set)
+    assert bitmaps.match({"user_id": "u1", "timestamp": 5}) == [5]
+    assert bitmaps.match({"user_id": "u1", "timestamp": 6}) == []
+    assert bitmaps.match({"user_id": "u2", "tags": "even"}) == list(range(2, 1000, 4))
+
+
+def test_dense_value_turns_sparse_after_removals():
+    bitmaps = MetadataBitmaps()
+    for i in range(SPARSE_MIN * 4):
+        bitmaps.add(i, {"role": "memory"})
+    assert not isinstance(bitmaps._bitmaps[("role", "memory")], set)
+
+    for i in range(SPARSE_MIN * 4 - 3):
+        bitmaps.remove(i)
+    assert isinstance(bitmaps._bitmaps[("role", "memory")], set)
+    assert sorted(bitmaps.match({"role": "memory"})) == list(range(SPARSE_MIN * 4 - 3, SPARSE_MIN * 4))
@@ -0,0 +1,29 @@
+from dao.text_index import TextIndex
+
+
+def build_index():
+    index = TextIndex()
+    index.add("a", "用户在学英语")
+    index.add("b", "用户每天早上跑步")
+    index.add("c", "用户的猫叫咖啡豆")
+    return index
+
+
+def test_keyword_search_with_candidates_returns_only_matches():
+    index = build_index()
+    unrestricted = index.search("英语", 10, mode="keyword")
+    restricted = index.search("英语", 10, ["a", "b", "c"], mode="keyword")
+    assert [doc_id for doc_id, _ in unrestricted] == ["a"]
+    assert restricted == unrestricted
+
+
+def test_keyword_search_candidates_limit_results():
+    index = build_index()
+    assert index.search("英语 跑步", 10, ["b", "c"], mode="keyword") == index.search("跑步", 10, mode="keyword")
+    assert index.search("英语", 10, ["b", "c"], mode="keyword") == []
+
+
+def test_substring_search_with_candidates():
+    index = build_index()
+    assert [doc_id for doc_id, _ in index.search("咖啡", 10, ["a", "c"])] == ["c"]
+    assert index.search("咖啡", 10, ["a", "b"]) == []